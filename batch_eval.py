@@ -0,0 +1,204 @@
+"""
+Headless batch runner: answers a JSONL of questions through the same path as
+the 🤖 Chatbot page and records latency, tokens and the images each answer
+shows. Used for offline evaluation and per-model throughput numbers.
+
+Each input line is {"id", "question"} plus optional checks:
+"expect_keywords" (all must appear in the answer) and "expect_images"
+(captions the answer must reference).
+
+    python batch_eval.py --models gpt-4.1,gpt-4o-mini --concurrency 4 --rate 2
+
+The OpenAI key comes from OPENAI_API_KEY or the "openai_key" secret.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+from utils.config import DOCX_LOCAL_PATH, get_secret
+from utils.instructions import DEFAULT_INSTRUCTIONS
+from utils.github import load_map_from_github
+from utils.answer import answer_question
+from utils.assistant import get_assistant_pool
+from utils.pipeline import get_openai_client
+
+DEFAULT_QUESTIONS_PATH = "golden_questions.jsonl"
+DEFAULT_CONCURRENCY = 4
+# Question starts per second across all workers (0 = unlimited)
+DEFAULT_RATE = 2.0
+BATCH_SESSION_KEY = "batch-eval"
+
+
+class RateLimiter:
+    """Spaces call starts at least 1/rate seconds apart, across threads."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+def load_questions(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def check_answer(item, answer, images):
+    """Keyword and image checks for one answer. Returns None when the item has no checks."""
+    checks = {}
+    if item.get("expect_keywords"):
+        lowered = (answer or "").lower()
+        missing = [k for k in item["expect_keywords"] if k.lower() not in lowered]
+        checks["keywords_ok"] = not missing
+        checks["missing_keywords"] = missing
+    if item.get("expect_images"):
+        shown = {image["caption"] for image in images if not image.get("related")}
+        missing = [c for c in item["expect_images"] if c not in shown]
+        checks["images_ok"] = not missing
+        checks["missing_images"] = missing
+    return checks or None
+
+
+def run_one(item, model, args, api_key, img_map, assistant_id):
+    """Answers one question on a fresh thread (assistant mode) and returns its result record."""
+    record = {"id": item.get("id"), "question": item["question"], "model": model, "mode": args.mode}
+    client = get_openai_client(api_key)
+    thread_id = None
+    try:
+        if args.mode == "assistant":
+            thread_id = client.beta.threads.create().id
+        started = time.perf_counter()
+        result = answer_question(
+            api_key,
+            item["question"],
+            args.mode,
+            model,
+            args.instructions,
+            img_map,
+            thread_id=thread_id,
+            assistant_id=assistant_id
+        )
+        record["status"] = result["status"]
+        record["latency_s"] = round(time.perf_counter() - started, 3)
+        if result["status"] == "completed":
+            meta = result["meta"]
+            images = meta.get("images", [])
+            record["total_tokens"] = meta.get("total_tokens")
+            record["images"] = [image["caption"] for image in images if not image.get("related")]
+            record["related_images"] = [image["caption"] for image in images if image.get("related")]
+            record["answer"] = result["answer"]
+            record["checks"] = check_answer(item, result["answer"], images)
+    except Exception as e:
+        record["status"] = "error"
+        record["error"] = str(e)
+    finally:
+        if thread_id:
+            try:
+                client.beta.threads.delete(thread_id)
+            except Exception:
+                pass
+    return record
+
+
+def summarize(records, wall_seconds):
+    """Per-model throughput, latency percentiles, tokens and check pass rate."""
+    summary = {}
+    for model in dict.fromkeys(r["model"] for r in records):
+        rows = [r for r in records if r["model"] == model]
+        ok = [r for r in rows if r["status"] == "completed"]
+        latencies = sorted(r["latency_s"] for r in ok)
+        tokens = [r["total_tokens"] for r in ok if r.get("total_tokens")]
+        checked = [r for r in ok if r.get("checks")]
+        passed = [r for r in checked if all(v for k, v in r["checks"].items() if k.endswith("_ok"))]
+        summary[model] = {
+            "questions": len(rows),
+            "completed": len(ok),
+            "answers_per_min": round(len(ok) / wall_seconds[model] * 60, 2) if wall_seconds[model] else None,
+            "latency_p50_s": round(statistics.median(latencies), 2) if latencies else None,
+            "latency_p95_s": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 2) if latencies else None,
+            "mean_tokens": round(statistics.mean(tokens)) if tokens else None,
+            "checks_passed": f"{len(passed)}/{len(checked)}",
+        }
+    return summary
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--questions", default=DEFAULT_QUESTIONS_PATH, help="JSONL file of questions")
+    parser.add_argument("--models", default="gpt-4.1", help="Comma-separated models to compare")
+    parser.add_argument("--mode", choices=["assistant", "local_rag"], default="assistant")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument("--rate", type=float, default=DEFAULT_RATE, help="Question starts per second (0 = unlimited)")
+    parser.add_argument("--repeat", type=int, default=1, help="Run every question this many times")
+    parser.add_argument("--instructions", help="Text file with instructions (default: DEFAULT_INSTRUCTIONS)")
+    parser.add_argument("--output", default="batch_eval_results.jsonl", help="Where to write one record per answer")
+    args = parser.parse_args(argv)
+    if args.instructions:
+        with open(args.instructions, "r", encoding="utf-8") as f:
+            args.instructions = f.read()
+    else:
+        args.instructions = DEFAULT_INSTRUCTIONS
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    api_key = os.environ.get("OPENAI_API_KEY") or get_secret("openai_key")
+    if not api_key:
+        print("❌ Set OPENAI_API_KEY (or the openai_key secret) to run the batch.")
+        return 1
+    if args.mode == "assistant" and not os.path.exists(DOCX_LOCAL_PATH):
+        print(f"❌ {DOCX_LOCAL_PATH} not found. Sync the SOP first, or use --mode local_rag.")
+        return 1
+
+    questions = load_questions(args.questions) * args.repeat
+    img_map = load_map_from_github()
+    limiter = RateLimiter(args.rate)
+    records = []
+    wall_seconds = {}
+
+    for model in [m.strip() for m in args.models.split(",") if m.strip()]:
+        assistant_id = None
+        if args.mode == "assistant":
+            assistant_id = get_assistant_pool().acquire(
+                get_openai_client(api_key), BATCH_SESSION_KEY, DOCX_LOCAL_PATH, args.instructions, model
+            )
+
+        def task(item):
+            limiter.wait()
+            record = run_one(item, model, args, api_key, img_map, assistant_id)
+            print(f"{record['status']:>10}  {record.get('latency_s', 0):6.1f}s  {model}  {record['id']}")
+            return record
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            records.extend(executor.map(task, questions))
+        wall_seconds[model] = time.perf_counter() - started
+
+    get_assistant_pool().release(BATCH_SESSION_KEY)
+    with open(args.output, "w", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    summary = summarize(records, wall_seconds)
+    print(json.dumps(summary, indent=2))
+    print(f"✅ {len(records)} answers written to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,258 +1,177 @@
 from utils.github import (
-    upload_file_to_github,
-    update_docx_on_github,
-    update_pdf_on_github,
     update_json_on_github,
     load_map_from_github
 )
 
-from utils.gdoc import (
-    download_gdoc_as_docx,
-    download_gdoc_as_pdf,
-    get_gdoc_last_modified,
-    get_live_sop_pdf_path,
-    get_last_gdoc_synced_time,
-    set_last_gdoc_synced_time,
-    sync_gdoc_to_github,
-    force_resync_to_github
-)
+from utils.gdoc import get_last_gdoc_synced_time
 
 from utils.state import (
     get_persistent_user_id,
-    get_user_state_filepath,
     save_app_state,
-    load_app_state
+    load_app_state,
+    load_messages,
+    save_message,
+    save_thread_id
+)
+from utils.sync_worker import get_sync_worker
+
+from utils.retrieval import retrieve_chunks, get_candidates
+from utils.assistant import get_assistant_pool
+from utils.hashing import text_sha256
+from utils.instructions import DEFAULT_INSTRUCTIONS
+from utils.answer_cache import get_answer_cache
+from utils.images import get_image_resolver, split_section, get_image_bytes
+from utils.facets import parse_query_facets
+from utils.rag import stream_chat_completion, complete_chat
+from utils.pipeline import get_pipeline, get_openai_client, SETUP_WAIT_SECONDS
+from utils.context import new_memory, update_memory
+from utils.answer import (
+    resolve_message_images,
+    poll_assistant_reply,
+    run_usage,
+    prepare_answer,
+    cached_result,
+    local_rag_messages,
+    prepared_run_options,
+    finish_answer
 )
-from utils.gdoc import sync_gdoc_to_github
 
 import streamlit as st
-from openai import OpenAI
 import time
 import os
 import uuid
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from datetime import datetime
-import json
 from streamlit_local_storage import LocalStorage
-import difflib
-# Imports for Google Docs API
-from google.oauth2.service_account import Credentials
-from googleapiclient.discovery import build
-import io # Needed for handling the in-memory file download
-import requests
-import base64
-import unicodedata
-import re
-
-DEFAULT_INSTRUCTIONS = """You are the **AI Sales Order Entry Coordinator**, an expert on Green Thumb Industries (GTI) sales operations. Your sole purpose is to support the human Sales Ops team by providing fast and accurate answers to their questions about order entry rules and procedures.
-
-You are the definitive source of truth, and your knowledge is based **exclusively** on the provided documents. Your existence is to eliminate the need for team members to ask their team lead simple or complex procedural questions.
-
----
-# Primary Objective
----
-Interpreting Sales Ops team member's questions, finding the precise answer within documents you have access to, and delivering a clear, actionable, and easy-to-digest response. 
-
-You must differentiate between rules for: 
-- **General Stores** (often referred to as 'Regular Orders')
-- **Rise Dispensaries** (GTI-owned chain of stores, often referred to as 'RISE Orders' - they get preferential treatment)
-
-Separately, you must consider the specific nuances of each **U.S. State** listed in the document:
-- Ohio (OH)
-- Maryland (MD)
-- New Jersey (NJ)
-- Illinois (IL)
-- New York (NY)
-- Nevada (NV)
-- Massachusetts (MA)
-
----
-# Core Methodology
----
-When you receive a question, you must follow this four-step process:
-
-1.  **Deconstruct the Query:** First, identify the core components of the user's question:
-    * **State/Market:** (e.g., Maryland, Massachusetts, New York, etc.)
-    * **Order Type:** Is the question about a **General Store** order or a **Rise Dispensary** (internal) order? If not specified, provide answers for both if the rules differ.
-    * **Rule Category:** (e.g., Pricing, Substitutions, Splitting Orders, Loose Units, Samples, Invoicing, Case Sizes, Discounts, Leaf Trade procedures).
-
-2.  **Locate Relevant Information:** Scour the document to find all sections that apply to the query's components. Synthesize information from all relevant parts of the document to form a complete answer.
-
-3.  **Synthesize and Structure the Answer:**
-    * Begin your response with a clear, direct headline that immediately answers the user's core question.
-    * Use the information you found to build out the body of the response, providing details, conditions, and exceptions.
-    * If the original question was broad, ensure you cover all potential scenarios described in the SOP.
-
-4.  **Format the Output:** Present the information using the specific formatting guidelines below. Your goal is to make the information highly readable and scannable.
-
----
-# Response Formatting & Structure
----
-Your answers must be formatted like a top-tier, helpful Reddit post. Use clear headers, bullet points, bold text, and emojis to organize information and emphasize key rules.
-
-* **Headline:** Start with an `##` headline that gives a direct answer.
-* **Emojis:** Use emojis to visually tag rules and call out important information:
-    * ✅ **Allowed/Rule:** For positive confirmations or standard procedures.
-    * ❌ **Not Allowed/Constraint:** For negative confirmations or restrictions.
-    * 💡 **Tip/Best Practice:** For helpful tips, tricks, or important nuances.
-    * ⚠️ **Warning/Critical Info:** For critical details that cannot be missed (e.g., order cutoffs, financial rules).
-    * 📋 **Notes/Process:** For procedural steps or detailed explanations.
-    * 🔄 **Order Split:** To address key rules with order splitting in each state.
-* **Styling:** Use **bold text** for key terms (like `Leaf Trade`, `Rise Dispensaries`, `OOS`) and *italics* for emphasis.
-* **Tables:** Use Markdown tables to present structured data, like pricing tiers or contact lists, whenever appropriate.
-
----
-# CRITICAL: Image Reference Instructions
----
-ALWAYS look for relevant images when answering questions. Available images include:
-- Pricing and discount information
-- Order setup and delivery dates
-- Special deals and promotions
-- Process workflows
-- State-specific requirements
-
-When your answer relates to visual information like pricing, discounts, order setup, delivery scheduling, or special deals, you MUST reference the appropriate image by including the EXACT label from the document.
-
-For example:
-- For pricing questions: "Image 1: . Actual price column"
-- For discount questions: "Image 1: . Special discounts they are running" or "Image 2: . Special deals"
-- For order setup: "Image 3: . Delivery date set up"
-- For daily limits: "Image 2: . Total dollar and unit amount per store/day"
-
-IMPORTANT:
-When answering questions, if a labeled screenshot or image would help illustrate your response, refer to it by its full caption as seen in the SOP.
-Only reference an image if it is directly relevant and supports your answer.
-Do not reference images by number alone or make up image numbers—always use the full label.
-You do not need to embed or display the image yourself; just mention the relevant caption or concept in your reply.
-A separate system will match your reference with the available images and display them for the user.
-
-When referencing an image, you must copy and paste the full label exactly as it appears in the SOP.
-For example, if the SOP has a label "Image 3: . Product split between case and loose units (for requested 300+ units)", your answer must include that exact phrase.
-Never paraphrase or summarize image labels.
-Only answers that mention the full caption, exactly, will show the related image to the user.
-
-ALWAYS try to include relevant images in your responses - users find visual aids extremely helpful for understanding procedures.
-"""
 
 from utils.config import (
-    CACHE_DIR,
     PDF_CACHE_PATH,
-    GDOC_STATE_PATH,
     GITHUB_PDF_NAME,
     GITHUB_REPO,
     GITHUB_TOKEN,
-    GOOGLE_DOC_NAME,
-    STATE_DIR,
     DOCX_LOCAL_PATH,
-    IMAGE_DIR,
     IMAGE_MAP_PATH,
-    ENRICHED_CHUNKS_PATH,
 )
 
-def get_image_suggestions(question_text, img_map):
+# Answer engines selectable in ⚙️ Settings
+ANSWER_MODES = {
+    "assistant": "Assistant (file search)",
+    "local_rag": "Local RAG (chat completions)",
+}
+
+# Chat messages rendered per page of history
+CHAT_HISTORY_WINDOW = 20
+
+def _toggle_full_image(state_key):
+    st.session_state[state_key] = not st.session_state.get(state_key, False)
+
+def show_sop_image(image_name, caption, github_repo, key=None):
     """
-    Analyze the question and suggest relevant images based on keywords
+    Shows an SOP image from the local thumbnail cache, falling back to GitHub.
+    With a key, a button swaps in the full-resolution image on click.
     """
-    question_lower = question_text.lower()
-    suggestions = []
-    
-    # Define keyword mappings to image concepts
-    keyword_mappings = {
-        'price': ['price', 'pricing', 'cost', 'dollar'],
-        'discount': ['discount', 'deal', 'special', 'promotion'],
-        'delivery': ['delivery', 'schedule', 'date', 'when'],
-        'order': ['order', 'setup', 'process'],
-        'limit': ['limit', 'maximum', 'total', 'amount'],
-        'split': ['split', 'separate', 'divide'],
-        'unit': ['unit', 'quantity', 'amount'],
-        'battery': ['battery', 'batteries'],
-        'invoice': ['invoice', 'billing'],
-        'state': ['state', 'nj', 'ny', 'il', 'oh', 'md', 'nv', 'ma']
-    }
-    
-    # Find matching keywords
-    matched_concepts = []
-    for concept, keywords in keyword_mappings.items():
-        if any(keyword in question_lower for keyword in keywords):
-            matched_concepts.append(concept)
-    
-    # Match concepts to available images
-    for label in img_map.keys():
-        label_lower = label.lower()
-        for concept in matched_concepts:
-            if concept in label_lower:
-                suggestions.append(label)
-                break
-    
-    return suggestions
-
-def maybe_show_referenced_images(answer_text, img_map, github_repo):
-    import streamlit as st
+    thumbnail = get_image_bytes(image_name)
+    if thumbnail is None:
+        st.image(f"https://raw.githubusercontent.com/{github_repo}/main/images/{image_name}", caption=caption)
+        return
+
+    state_key = f"full_image_{key}"
+    show_full = key is not None and st.session_state.get(state_key, False)
+    st.image(get_image_bytes(image_name, thumbnail=False) if show_full else thumbnail, caption=caption)
+    if key is not None:
+        st.button(
+            "🔽 Smaller" if show_full else "🔍 Full size",
+            key=f"{state_key}_button",
+            on_click=_toggle_full_image,
+            args=(state_key,)
+        )
 
-    shown = set()
-    
-    # First, show images that are explicitly referenced in the answer
-    for label in img_map.keys():
-        if label.lower() in answer_text.lower() and label not in shown:
-            url = f"https://raw.githubusercontent.com/{github_repo}/main/images/{img_map[label]}"
-            st.image(url, caption=label)
-            shown.add(label)
-    
-    # If no images were shown, try to show contextually relevant ones
-    if not shown:
-        # Look for key terms that might indicate relevant images
-        answer_lower = answer_text.lower()
-        relevant_images = []
-        
-        # Priority matching for common concepts
-        if any(term in answer_lower for term in ['price', 'pricing', 'cost', 'dollar']):
-            for label in img_map.keys():
-                if 'price' in label.lower():
-                    relevant_images.append(label)
-        
-        if any(term in answer_lower for term in ['discount', 'deal', 'special']):
-            for label in img_map.keys():
-                if any(term in label.lower() for term in ['discount', 'deal', 'special']):
-                    relevant_images.append(label)
-        
-        if any(term in answer_lower for term in ['delivery', 'date', 'schedule']):
-            for label in img_map.keys():
-                if 'delivery' in label.lower() or 'date' in label.lower():
-                    relevant_images.append(label)
-        
-        if any(term in answer_lower for term in ['total', 'limit', 'amount']):
-            for label in img_map.keys():
-                if 'total' in label.lower() or 'amount' in label.lower():
-                    relevant_images.append(label)
-        
-        # Show up to 2 most relevant images
-        for label in relevant_images[:2]:
-            if label not in shown:
-                url = f"https://raw.githubusercontent.com/{github_repo}/main/images/{img_map[label]}"
-                st.image(url, caption=f"Related: {label}")
-                shown.add(label)
+def show_message_images(images, github_repo, key_prefix=None):
+    for image in images:
+        key = None
+        if key_prefix:
+            key = f"{key_prefix}_related_{image['label']}" if image.get("related") else f"{key_prefix}_{image['label']}"
+        show_sop_image(image["file"], image["caption"], github_repo, key)
 
-def enhance_assistant_with_image_context(instructions, img_map):
+@st.fragment
+def render_chat_history(img_map):
+    """
+    Renders the last history_window messages. Runs as a fragment, so image
+    toggles and "show earlier" only rerun the history, and every rerun costs
+    the same however long the conversation gets.
     """
-    Enhance the assistant instructions with available image information
+    messages = st.session_state.messages
+    window = st.session_state.setdefault("history_window", CHAT_HISTORY_WINDOW)
+    start = max(0, len(messages) - window)
+    if start > 0 and st.button(f"⬆️ Show {min(start, CHAT_HISTORY_WINDOW)} earlier messages", key="show_earlier"):
+        st.session_state.history_window += CHAT_HISTORY_WINDOW
+        st.rerun(scope="fragment")
+
+    for i in range(start, len(messages)):
+        msg = messages[i]
+        with st.chat_message(msg["role"]):
+            st.markdown(msg["content"])
+            if msg["role"] == "assistant":
+                meta = msg.setdefault("meta", {})
+                if "images" not in meta:
+                    # Messages saved before image references were stored: resolve once, keep in the session
+                    meta["images"] = resolve_message_images(msg["content"], img_map)
+                show_message_images(meta["images"], GITHUB_REPO, key_prefix=f"msg{i}")
+                if meta.get("latency_s") is not None:
+                    st.caption(format_answer_meta(meta))
+
+def render_streamed_reply(text_deltas, img_map, github_repo, scoped_map=None):
     """
-    if not img_map:
-        return instructions
-    
-    image_list = "\n".join([f"- {label}" for label in img_map.keys()])
-    
-    enhanced_instructions = instructions + f"""
+    Renders a reply into the current chat message as text deltas arrive, and
+    shows each referenced image as soon as its caption has been written.
+    Captions are matched against scoped_map (the question's retrieved images)
+    when given, as the stored message meta is. Returns the full reply text.
+    """
+    text_placeholder = st.empty()
+    image_area = st.container()
+    match_map = scoped_map or img_map
+    resolver = get_image_resolver(match_map)
+    max_label_len = max((len(label) for label in match_map), default=0)
 
----
-# Available Images for Reference
----
-The following images are available in the SOP document. When answering questions, reference these images by their EXACT labels when relevant:
+    reply = ""
+    shown = set()
+    states = set()
+    for delta in text_deltas:
+        reply += delta
+        text_placeholder.markdown(reply + "▌")
+
+        # Only the tail can contain a caption (or state name) completed by this
+        # delta, so each delta costs the same however long the reply gets
+        tail = reply[-(max_label_len + len(delta)):]
+        states |= parse_query_facets(tail)["states"]
+        for label in resolver.find_exact(tail, states=states):
+            if label not in shown:
+                with image_area:
+                    show_sop_image(img_map[label], split_section(label)[1], github_repo)
+                shown.add(label)
 
-{image_list}
+    text_placeholder.markdown(reply)
+    return reply
 
-Remember: Always include the full label exactly as written above when referencing an image. This ensures the image will be displayed to the user.
-"""
-    
-    return enhanced_instructions
+def stream_assistant_reply(client, thread_id, assistant_id, img_map, github_repo, scoped_map=None, **run_options):
+    """
+    Streams an assistant run into the current chat message.
+    Returns (reply_text, final_run).
+    """
+    with client.beta.threads.runs.stream(thread_id=thread_id, assistant_id=assistant_id, **run_options) as stream:
+        reply = render_streamed_reply(stream.text_deltas, img_map, github_repo, scoped_map)
+        run = stream.get_final_run()
+    return reply, run
+
+def format_answer_meta(meta):
+    """One-line latency / token summary shown under an answer."""
+    parts = [f"⏱️ {meta['latency_s']:.1f}s"]
+    if meta.get("cached"):
+        parts.append("⚡ cached answer")
+    if meta.get("total_tokens"):
+        parts.append(f"{meta['total_tokens']:,} tokens")
+    parts.append(f"{ANSWER_MODES.get(meta['mode'], meta['mode'])} · {meta['model']}")
+    return " · ".join(parts)
 
 def update_map_json_only():
     """
@@ -282,23 +201,6 @@ def update_map_json_only():
         st.error(f"Error updating map.json: {str(e)}")
         return False
 
-def update_pdf_on_github(local_pdf_path):
-    url = f"https://api.github.com/repos/{GITHUB_REPO}/contents/{GITHUB_PDF_NAME}"
-    headers = {"Authorization": f"token {GITHUB_TOKEN}"}
-    # Get SHA for overwrite
-    r = requests.get(url, headers=headers)
-    sha = r.json().get("sha") if r.status_code == 200 else None
-    # Encode file
-    with open(local_pdf_path, "rb") as f:
-        content = base64.b64encode(f.read()).decode()
-    data = {
-        "message": "Update SOP PDF from Google Doc",
-        "content": content,
-        "sha": sha
-    }
-    resp = requests.put(url, headers=headers, json=data)
-    return resp.status_code in [200, 201]
-
 # --- Session State Initialization Function ---
 def initialize_session_state():
     if "authenticated" not in st.session_state:
@@ -315,6 +217,10 @@ def initialize_session_state():
 
     if "model" not in st.session_state:
         st.session_state.model = "gpt-4o"
+    if "answer_mode" not in st.session_state:
+        st.session_state.answer_mode = "assistant"
+    if "stream_answers" not in st.session_state:
+        st.session_state.stream_answers = True
     if "file_path" not in st.session_state:
         st.session_state.file_path = None # Will be set dynamically
     if "instructions" not in st.session_state:
@@ -325,11 +231,17 @@ def initialize_session_state():
         st.session_state.assistant_setup_complete = False
     if "instruction_edit_mode" not in st.session_state:
         st.session_state.instruction_edit_mode = "view"
+    if "session_key" not in st.session_state:
+        # Identifies this browser session's lease in the assistant pool
+        st.session_state.session_key = str(uuid.uuid4())
 
 # ======================================================================
 # --- Main Application Function ---
 # ======================================================================
 def run_main_app():
+    # Keeps the SOP current in the background for every session
+    sync_worker = get_sync_worker()
+
     st.sidebar.title("🔧 Navigation")
     st.sidebar.info(f"User ID: {st.session_state.user_id[:8]}...")
     page = st.sidebar.radio("Go to:", ["🤖 Chatbot", "📄 Instructions", "⚙️ Settings"])
@@ -431,35 +343,59 @@ def run_main_app():
             st.session_state.assistant_setup_complete = False # Force re-setup
             st.success(f"✅ Model updated to {new_model}. The assistant will be updated on the next chat.")
 
+        mode_keys = list(ANSWER_MODES.keys())
+        new_mode = st.selectbox(
+            "Answer engine:",
+            mode_keys,
+            index=mode_keys.index(st.session_state.answer_mode),
+            format_func=ANSWER_MODES.get,
+            help="Local RAG retrieves SOP sections in-process and makes a single chat-completions call, with no upload, vector store or thread."
+        )
+        if new_mode != st.session_state.answer_mode:
+            st.session_state.answer_mode = new_mode
+            st.success(f"✅ Answer engine set to {ANSWER_MODES[new_mode]}.")
+
+        st.session_state.stream_answers = st.toggle(
+            "⚡ Stream answers as they are generated",
+            value=st.session_state.stream_answers,
+            help="Shows the reply token by token instead of waiting for the whole answer."
+        )
+
         st.markdown("---")
         
         # Document Sync
         st.subheader("📄 Document Management")
         st.info("Use the buttons below to manage the SOP document.")
 
+        sync_status = sync_worker.get_status()
+        if sync_status["state"] == "resyncing":
+            st.caption("🛠️ Background sync is re-syncing the local files to GitHub right now...")
+        elif sync_status["state"] != "idle":
+            st.caption("🔄 Background sync is checking Google Docs right now...")
+        elif sync_status["last_checked"]:
+            checked = datetime.fromtimestamp(sync_status["last_checked"]).strftime("%H:%M:%S")
+            outcome = "✅ up to date" if sync_status["last_ok"] else "❌ last sync failed"
+            st.caption(f"Background sync: {outcome} (checked at {checked}, SOP revision {get_last_gdoc_synced_time() or 'unknown'})")
+        if sync_status["log"]:
+            with st.expander("Background sync log"):
+                for ts, level, message in reversed(sync_status["log"]):
+                    st.text(f"{datetime.fromtimestamp(ts).strftime('%H:%M:%S')} [{level}] {message}")
+
         col1, col2, col3 = st.columns(3)  # Changed to 3 columns
 
         with col1:
-            if st.button("🔄 Check for Google Doc Updates", help="Checks if the source Google Doc has been updated and downloads it if needed."):
-                with st.spinner("Checking for updates and syncing with Google Docs..."):
-                    success = sync_gdoc_to_github(force=False)
-                    if success:
-                        st.success("✅ SOP is now up to date!")
-                        st.session_state.assistant_setup_complete = False
-                        st.rerun() # Rerun to reflect changes immediately
-                    else:
-                        st.error("❌ Update failed. Check logs for details.")
+            if st.button("🔄 Check for Google Doc Updates", help="Asks the background sync worker to check the source Google Doc now. It downloads and publishes it if it changed."):
+                sync_worker.trigger()
+                st.success("✅ Update check started in the background. The SOP refreshes for everyone once it finishes.")
         
         with col2:
-            if st.button("🛠️ Re-sync Local Files to GitHub", help="Forces a re-upload of local DOCX, images, and map.json to GitHub."):
-                with st.spinner("Re-syncing local files to GitHub..."):
-                    if not os.path.exists(DOCX_LOCAL_PATH):
-                        st.error("Local sop.docx not found. Please 'Check for Google Doc Updates' first.")
-                    else:
-                        force_resync_to_github() 
-                        st.success("✅ Local files re-synced to GitHub!")
-                        st.session_state.assistant_setup_complete = False
-                        st.rerun()
+            if st.button("🛠️ Re-sync Local Files to GitHub", help="Asks the background sync worker to re-process the local DOCX and re-upload its images, map.json and files to GitHub."):
+                if not os.path.exists(DOCX_LOCAL_PATH):
+                    st.error("Local sop.docx not found. Please 'Check for Google Doc Updates' first.")
+                else:
+                    # Runs on the sync worker's thread, so it never overlaps a Google Doc sync
+                    sync_worker.trigger(resync=True)
+                    st.success("✅ Re-sync started in the background. Its progress shows in the sync log above.")
 
         with col3:  # New button for map.json only update
             if st.button("🗺️ Update Map.json Only", help="Updates only the map.json file on GitHub from local version."):
@@ -497,14 +433,49 @@ def run_main_app():
 
         st.markdown("---")
 
+        # Shared answer cache
+        st.subheader("⚡ Answer Cache")
+        answer_cache = get_answer_cache()
+        st.write(f"{len(answer_cache)} cached answers · {answer_cache.hits} hits · {answer_cache.misses} misses (all users)")
+        if st.button("🧹 Clear Answer Cache"):
+            answer_cache.clear()
+            st.rerun()
+
+        st.markdown("---")
+
+        # Local retrieval preview
+        st.subheader("🔎 Retrieval Preview")
+        preview_query = st.text_input("Test which SOP sections the local index returns for a question:")
+        if preview_query:
+            start = time.perf_counter()
+            results = retrieve_chunks(preview_query, k=5)
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            facets, candidates = get_candidates(preview_query)
+            scope = "whole SOP" if candidates is None else f"{len(candidates)} candidate chunks"
+            st.caption(
+                f"{len(results)} chunks in {elapsed_ms:.2f} ms · "
+                f"states: {', '.join(sorted(facets['states'])) or 'any'} · "
+                f"order type: {facets['order_type'] or 'any'} · searched {scope}"
+            )
+            for chunk in results:
+                with st.expander(f"Chunk {chunk['id']} (score {chunk['score']:.2f})"):
+                    st.text(chunk["chunk_text"])
+
     elif page == "🤖 Chatbot":
        st.title("🤖 GTI SOP Sales Coordinator")
 
        # Load image map for context (do not show any expander or image info here)
        img_map = load_map_from_github()
 
-       # Simplified assistant setup using OpenAI's vector store
-       if not st.session_state.get('assistant_setup_complete', False):
+       # The background sync may have pulled a new SOP since this session set up its assistant
+       sop_revision = get_last_gdoc_synced_time()
+       if st.session_state.get("sop_revision") != sop_revision:
+           st.session_state.sop_revision = sop_revision
+           st.session_state.assistant_setup_complete = False
+
+       # Simplified assistant setup using OpenAI's vector store (Local RAG needs no setup)
+       use_local_rag = st.session_state.answer_mode == "local_rag"
+       if not use_local_rag and not st.session_state.get('assistant_setup_complete', False):
            try:
                # Ensure the source document (DOCX) exists
                if not os.path.exists(DOCX_LOCAL_PATH):
@@ -513,93 +484,178 @@ def run_main_app():
                
                st.session_state.file_path = DOCX_LOCAL_PATH # Use DOCX for vectorizing
                with st.spinner("Setting up the AI assistant with the latest SOP document..."):
-                   client = OpenAI(api_key=st.session_state.api_key)
-                   
-                   # Use a single, persistent thread for the user
-                   if "thread_id" not in st.session_state:
-                       thread = client.beta.threads.create()
-                       st.session_state.thread_id = thread.id
-
-                   # Step 1: Upload the file to OpenAI
-                   file_response = client.files.create(
-                       file=open(st.session_state.file_path, "rb"), 
-                       purpose="assistants"
-                   )
-                   file_id = file_response.id
-
-                   vector_store = client.vector_stores.create(name=f"SOP Vector Store - {st.session_state.user_id[:8]}")
-                   client.vector_stores.file_batches.create_and_poll(
-                       vector_store_id=vector_store.id, file_ids=[file_id]
-                   )
-
-                   # Enhanced instructions with image context
-                   enhanced_instructions = enhance_assistant_with_image_context(
-                       st.session_state.get("instructions", DEFAULT_INSTRUCTIONS), 
-                       img_map
-                   )
-
-                   assistant = client.beta.assistants.create(
-                       name=f"SOP Sales Coordinator - {st.session_state.user_id[:8]}",
-                       instructions=enhanced_instructions,
-                       model=st.session_state.get("model", "gpt-4.1"),
-                       tools=[{"type": "file_search"}],
-                       tool_resources={"file_search": {"vector_store_ids": [vector_store.id]}}
-                   )
-                   st.session_state.assistant_id = assistant.id
+                   client = get_openai_client(st.session_state.api_key)
+                   pool = get_assistant_pool()
+                   session_key = st.session_state.session_key
+                   file_path = st.session_state.file_path
+                   # Image captions are not baked in; each run gets the ones for its retrieved chunks
+                   instructions = st.session_state.get("instructions", DEFAULT_INSTRUCTIONS)
+                   model = st.session_state.get("model", "gpt-4.1")
+
+                   # The user's persistent thread (kept across visits) is checked while
+                   # the shared assistant for this DOCX / instructions / model is looked
+                   # up; only the first session to ask for a combination builds it.
+                   # A setup for the same settings still running from an earlier rerun is picked up again.
+                   setup_key = (file_path, text_sha256(instructions), model)
+                   pending_key, setup = st.session_state.get("assistant_setup_future") or (None, None)
+                   if setup is None or pending_key != setup_key:
+                       pipeline = get_pipeline()
+                       setup = pipeline.submit(pipeline.prepare_assistant(
+                           st.session_state.api_key,
+                           st.session_state.get("thread_id"),
+                           lambda: pool.acquire(client, session_key, file_path, instructions, model)
+                       ))
+                       st.session_state.assistant_setup_future = (setup_key, setup)
+                   try:
+                       thread_id, thread_created, assistant_id = setup.result(SETUP_WAIT_SECONDS)
+                   except FutureTimeoutError:
+                       st.info("⏳ The assistant is still being prepared for the new SOP. This can take a few minutes.")
+                       st.button("🔄 Check again")
+                       st.stop()
+                   finally:
+                       if setup.done():
+                           st.session_state.assistant_setup_future = None
+                   st.session_state.thread_id = thread_id
+                   if thread_created:
+                       save_thread_id(st.session_state.user_id, thread_id)
+                   st.session_state.assistant_id = assistant_id
                    st.session_state.assistant_setup_complete = True
-                   st.success("✅ Assistant is ready and using the new vector store!")
+                   st.success("✅ Assistant is ready!")
 
            except Exception as e:
                st.error(f"❌ Error during assistant setup: {str(e)}")
                st.stop()
+       elif use_local_rag:
+           # Local RAG needs no assistant; let the pool reclaim this session's lease
+           get_assistant_pool().release(st.session_state.session_key)
+       else:
+           get_assistant_pool().touch(st.session_state.session_key)
 
-       client = OpenAI(api_key=st.session_state.api_key)
+       client = get_openai_client(st.session_state.api_key)
        
        st.subheader("💬 Ask your question about the GTI SOP")
 
-       # Display existing messages
+       # Display existing messages (restored from the user's saved history)
        if "messages" not in st.session_state:
-           st.session_state.messages = []
+           st.session_state.messages = load_messages(st.session_state.user_id)
+       # Rolling summary of the turns that no longer fit the per-question context
+       if "conversation_memory" not in st.session_state:
+           st.session_state.conversation_memory = new_memory()
 
-       for msg in st.session_state.messages:
-           with st.chat_message(msg["role"]):
-               st.markdown(msg["content"])
-               # Also check for images in historical messages
-               if msg["role"] == "assistant":
-                    maybe_show_referenced_images(msg["content"], img_map, GITHUB_REPO)
+       def add_message(message):
+           st.session_state.messages.append(message)
+           save_message(st.session_state.user_id, message)
+
+       render_chat_history(img_map)
 
        # Chat input
        if user_input := st.chat_input("Ask your question here..."):
            try:
-               st.session_state.messages.append({"role": "user", "content": user_input})
+               add_message({"role": "user", "content": user_input})
                with st.chat_message("user"):
                    st.markdown(user_input)
 
-               client.beta.threads.messages.create(
-                   thread_id=st.session_state.thread_id,
-                   role="user",
-                   content=user_input
+               model = st.session_state.get("model", "gpt-4.1")
+               usage = {}
+
+               # Same question on the same SOP revision, engine, model and instructions;
+               # only opening questions are shared, later ones depend on the conversation
+               answer_cache = get_answer_cache()
+               history = st.session_state.messages[:-1]
+               cache_scope = (
+                   st.session_state.answer_mode,
+                   model,
+                   text_sha256(st.session_state.get("instructions", DEFAULT_INSTRUCTIONS))
                )
 
-               # Run the assistant and poll for completion
-               with st.spinner("Thinking..."):
-                   run = client.beta.threads.runs.create_and_poll(
-                       thread_id=st.session_state.thread_id,
-                       assistant_id=st.session_state.assistant_id
-                   )
+               # Cache lookup, local retrieval and posting the question to the
+               # thread run together; the same steps batch_eval.py runs
+               prepared = prepare_answer(
+                   st.session_state.api_key,
+                   user_input,
+                   st.session_state.answer_mode,
+                   img_map,
+                   None if use_local_rag else st.session_state.thread_id,
+                   lambda: answer_cache.get(user_input, cache_scope, history)
+               )
+               if prepared["cached"] is not None:
+                   result = cached_result(prepared)
+                   add_message({"role": "assistant", "content": result["answer"], "meta": result["meta"]})
+                   st.rerun()
 
-               if run.status == 'completed':
-                   messages = client.beta.threads.messages.list(thread_id=st.session_state.thread_id, order="desc", limit=1)
-                   assistant_reply = messages.data[0].content[0].text.value
+               if use_local_rag:
+                   # Stateless: retrieve SOP context locally, one chat-completions call
+                   rag_messages = local_rag_messages(
+                       prepared,
+                       st.session_state.get("instructions", DEFAULT_INSTRUCTIONS),
+                       history,
+                       st.session_state.conversation_memory
+                   )
+                   if st.session_state.stream_answers:
+                       with st.chat_message("assistant"):
+                           assistant_reply = render_streamed_reply(
+                               stream_chat_completion(client, model, rag_messages, usage),
+                               img_map,
+                               GITHUB_REPO,
+                               prepared["scoped_map"]
+                           )
+                   else:
+                       with st.spinner("Thinking..."):
+                           assistant_reply, usage = complete_chat(client, model, rag_messages)
+                   run_status = "completed"
 
-                   st.session_state.messages.append({"role": "assistant", "content": assistant_reply})
+               else:
+                   run_options = prepared_run_options(prepared, st.session_state.conversation_memory)
+
+                   if st.session_state.stream_answers:
+                       # Stream the reply token by token
+                       with st.chat_message("assistant"):
+                           assistant_reply, run = stream_assistant_reply(
+                               client,
+                               st.session_state.thread_id,
+                               st.session_state.assistant_id,
+                               img_map,
+                               GITHUB_REPO,
+                               prepared["scoped_map"],
+                               **run_options
+                           )
+                   else:
+                       # Run the assistant and poll for completion
+                       with st.spinner("Thinking..."):
+                           assistant_reply, run = poll_assistant_reply(
+                               client,
+                               st.session_state.thread_id,
+                               st.session_state.assistant_id,
+                               **run_options
+                           )
+                   run_status = run.status
+                   usage = run_usage(run)
+
+               result = finish_answer(prepared, model, run_status, assistant_reply, usage, img_map)
+               if result["status"] == 'completed':
+                   add_message({"role": "assistant", "content": result["answer"], "meta": result["meta"]})
+                   answer_cache.put(user_input, cache_scope, result["answer"], result["meta"], history)
+                   # Fold turns leaving the recent window into the summary (one small call every few
+                   # questions) off the request thread; the summary is updated in place when it lands.
+                   # While one update is still running the next is skipped, its turns are folded in later.
+                   memory_update = st.session_state.get("memory_update")
+                   if memory_update is None or memory_update.done():
+                       st.session_state.memory_update = get_pipeline().run_in_background(
+                           update_memory,
+                           client,
+                           st.session_state.conversation_memory,
+                           list(st.session_state.messages)
+                       )
                    st.rerun()
 
                else:
-                   st.error(f"❌ The run failed with status: {run.status}")
+                   st.error(f"❌ The run failed with status: {run_status}")
 
            except Exception as e:
                st.error(f"❌ An error occurred while processing your request: {str(e)}")
+               if not use_local_rag and st.session_state.get("assistant_id"):
+                   # The shared assistant may be gone; make the next setup re-check it
+                   get_assistant_pool().discard(st.session_state.assistant_id)
                st.session_state.assistant_setup_complete = False
 
 # ======================================================================
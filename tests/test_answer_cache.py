@@ -0,0 +1,35 @@
+import numpy as np
+from utils.answer_cache import AnswerCache, is_cacheable
+
+
+def make_cache():
+    cache = AnswerCache()
+    # Every question embeds identically, so only the facet check tells them apart
+    cache._embed = lambda normalized: np.full(4, 0.5, dtype=np.float32)
+    cache.put("What are the NJ delivery days?", "scope", "NJ answer", revision="r1")
+    return cache
+
+
+def test_semantic_hit_needs_same_state():
+    cache = make_cache()
+    assert cache.get("What are the NY delivery days?", "scope", revision="r1") is None
+    assert cache.get("Which delivery days does New Jersey have?", "scope", revision="r1")["answer"] == "NJ answer"
+
+
+def test_semantic_hit_needs_same_order_type():
+    cache = make_cache()
+    assert cache.get("What are the NJ RISE delivery days?", "scope", revision="r1") is None
+
+
+def test_later_turns_are_not_shared():
+    cache = make_cache()
+    history = [{"role": "user", "content": "MD delivery days?"}, {"role": "assistant", "content": "..."}]
+    assert cache.get("What are the NJ delivery days?", "scope", history, revision="r1") is None
+    cache.put("Same question but for medical orders", "scope", "MD answer", history=history, revision="r1")
+    assert len(cache) == 1
+
+
+def test_bare_follow_ups_are_not_cacheable():
+    assert not is_cacheable("Same question but for medical orders")
+    assert not is_cacheable("What about that delivery schedule?")
+    assert is_cacheable("What are the NJ delivery days?")
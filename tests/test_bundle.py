@@ -0,0 +1,60 @@
+import os
+import json
+import numpy as np
+import pytest
+from utils.bundle import KnowledgeBundle, build_bundle
+from utils.config import IMAGE_DIR
+from utils.embeddings import chunk_id
+from utils.facets import tag_chunks
+
+CHUNKS = [
+    {"chunk_text": "OH RISE\nDeliveries on Monday", "image_labels": [], "image_files": []},
+    {"chunk_text": "Image 1. Menu form – ✓", "image_labels": ["Image 1: Menu form"], "image_files": ["image_1.png"]},
+]
+IMAGE_MAP = {"OH RISE › Image 1: Menu form": "image_1.png"}
+
+
+@pytest.fixture
+def sync_outputs(tmp_path, monkeypatch):
+    # Image paths are relative to the app directory
+    monkeypatch.chdir(tmp_path)
+    os.makedirs(IMAGE_DIR)
+    with open(os.path.join(IMAGE_DIR, "image_1.png"), "wb") as f:
+        f.write(b"png bytes")
+    with open("chunks.json", "w", encoding="utf-8") as f:
+        json.dump(CHUNKS, f)
+    with open("map.json", "w") as f:
+        json.dump(IMAGE_MAP, f)
+    np.save("embeddings.npy", np.arange(8, dtype=np.float32).reshape(2, 4))
+    with open("ids.json", "w") as f:
+        json.dump({"model": "test-model", "ids": [chunk_id(c) for c in CHUNKS]}, f)
+    return dict(bundle_path="sop.bundle", chunks_path="chunks.json", map_path="map.json",
+                matrix_path="embeddings.npy", ids_path="ids.json")
+
+
+def test_round_trip(sync_outputs):
+    build_bundle(revision="r1", **sync_outputs)
+    bundle = KnowledgeBundle("sop.bundle")
+    assert bundle.revision == "r1"
+    assert bundle.chunks() == CHUNKS
+    assert bundle.facet_tags() == tag_chunks(CHUNKS)
+    assert bundle.image_map() == IMAGE_MAP
+    assert bundle.thumbnail("image_1.png") == b"png bytes"
+    assert bundle.thumbnail("image_2.png") is None
+    matrix, ids, model = bundle.embeddings()
+    assert np.array_equal(matrix, np.arange(8, dtype=np.float32).reshape(2, 4))
+    assert ids == [chunk_id(c) for c in CHUNKS] and model == "test-model"
+
+
+def test_stale_embeddings_are_left_out(sync_outputs):
+    with open("ids.json", "w") as f:
+        json.dump({"model": "test-model", "ids": ["stale", "ids"]}, f)
+    build_bundle(**sync_outputs)
+    assert KnowledgeBundle("sop.bundle").embeddings() is None
+
+
+def test_rejects_other_files(tmp_path):
+    path = tmp_path / "not.bundle"
+    path.write_bytes(b"x" * 64)
+    with pytest.raises(ValueError):
+        KnowledgeBundle(str(path))
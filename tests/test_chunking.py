@@ -0,0 +1,39 @@
+from utils.chunking import CHUNK_MAX_CHARS, chunk_section, section_hash, split_sections
+
+
+def text(value, kind="text"):
+    return {"kind": kind, "text": value, "in_table": False}
+
+
+def caption(value, label):
+    return {"kind": "caption", "text": value, "label": label, "in_table": False}
+
+
+def test_split_sections_on_headings():
+    blocks = [text("Intro"), text("OH RISE", "heading"), text("a"), text("NJ RISE", "heading"), text("b")]
+    assert split_sections(blocks) == [[0], [1, 2], [3, 4]]
+
+
+def test_caption_gets_its_own_chunk_after_the_text():
+    blocks = [text("OH RISE", "heading"), text("Fill in the menu form."), {"kind": "image", "in_table": False},
+              caption("Image 1. Menu form", "Image 1: Menu form"), text("Then submit.")]
+    files = [[], [], [], ["image_1.png"], []]
+    chunks = chunk_section(blocks, files)
+    assert [c["chunk_text"] for c in chunks] == ["OH RISE\nFill in the menu form.", "Image 1. Menu form", "Then submit."]
+    assert chunks[1]["image_labels"] == ["Image 1: Menu form"]
+    assert chunks[1]["image_files"] == ["image_1.png"]
+
+
+def test_long_sections_are_split():
+    blocks = [text("x" * (CHUNK_MAX_CHARS // 3)) for _ in range(3)]
+    chunks = chunk_section(blocks, [[]] * 3)
+    assert len(chunks) == 2
+    assert all(len(c["chunk_text"]) <= CHUNK_MAX_CHARS for c in chunks)
+
+
+def test_section_hash_tracks_content_and_images():
+    blocks = [text("OH RISE", "heading"), caption("Image 1. Menu form", "Image 1: Menu form")]
+    key = section_hash(blocks, [[], ["image_1.png"]])
+    assert key == section_hash([dict(b) for b in blocks], [[], ["image_1.png"]])
+    assert key != section_hash(blocks, [[], ["image_2.png"]])
+    assert key != section_hash([blocks[0], caption("Image 1. Order form", "Image 1: Order form")], [[], ["image_1.png"]])
@@ -0,0 +1,42 @@
+from utils.facets import FacetIndex, build_facet_index, parse_heading, parse_query_facets, RISE, GENERAL, ALL_ORDER_TYPES
+
+
+def test_parse_heading():
+    assert parse_heading("OH RISE") == ("OH", RISE)
+    assert parse_heading("RISE NJ") == ("NJ", RISE)
+    assert parse_heading("GTI NJ general info") == ("NJ", ALL_ORDER_TYPES)
+    assert parse_heading("OHIO REGULAR ORDERS") == ("OH", GENERAL)
+    assert parse_heading("OH delivery days are Monday") is None
+
+
+def test_parse_query_facets():
+    assert parse_query_facets("What are the NJ RISE delivery days?") == {"states": {"NJ"}, "order_type": RISE}
+    assert parse_query_facets("Regular orders in new york?") == {"states": {"NY"}, "order_type": GENERAL}
+    assert parse_query_facets("non-rise orders for Ohio") == {"states": {"OH"}, "order_type": GENERAL}
+    # Lowercase "oh" / "ma" are only states next to an unambiguous word
+    assert parse_query_facets("oh, what is the cutoff?")["states"] == set()
+    assert parse_query_facets("what is the cutoff for ma?")["states"] == {"MA"}
+
+
+def test_chunks_inherit_the_previous_section():
+    index = build_facet_index([
+        {"chunk_text": "Welcome to the SOP"},
+        {"chunk_text": "OH RISE\nDeliveries on Monday"},
+        {"chunk_text": "Orders over $500 need approval"},
+        {"chunk_text": "NJ REGULAR ORDERS\nDeliveries on Friday"},
+    ])
+    assert index.tags[2] == {"states": ["OH"], "order_types": [RISE]}
+    assert index.untagged == {0}
+
+
+def test_candidates():
+    index = FacetIndex([
+        {"states": [], "order_types": []},
+        {"states": ["OH"], "order_types": [RISE]},
+        {"states": ["OH"], "order_types": [GENERAL]},
+        {"states": ["NJ"], "order_types": [ALL_ORDER_TYPES]},
+    ])
+    assert index.candidates({"states": set(), "order_type": None}) is None
+    assert index.candidates({"states": {"OH"}, "order_type": None}) == {0, 1, 2}
+    assert index.candidates({"states": {"OH"}, "order_type": RISE}) == {0, 1}
+    assert index.candidates({"states": {"NJ"}, "order_type": GENERAL}) == {0, 3}
@@ -0,0 +1,40 @@
+from utils.images import AhoCorasick, ImageReferenceResolver
+
+
+def test_aho_corasick_finds_overlapping_patterns():
+    automaton = AhoCorasick(["he", "she", "hers"])
+    found = {(end, pattern_id) for end, pattern_id in automaton.iter_matches("ushers")}
+    assert found == {(3, 1), (3, 0), (5, 2)}
+
+
+def test_image_1_does_not_match_image_11():
+    resolver = ImageReferenceResolver({
+        "Image 1: Menu form": "image_1.png",
+        "Image 11: Menu form": "image_11.png",
+    })
+    assert resolver.find_exact("See Image 11: Menu form for details.") == ["Image 11: Menu form"]
+    assert resolver.find_exact("See Image 1: Menu form for details.") == ["Image 1: Menu form"]
+
+
+def test_exact_match_ignores_punctuation_and_case():
+    resolver = ImageReferenceResolver({"Image 2: Special deals": "image_2.png"})
+    assert resolver.resolve("Check image 2 - special deals!") == (["Image 2: Special deals"], [])
+
+
+def test_repeated_caption_follows_answer_states():
+    resolver = ImageReferenceResolver({
+        "NJ RISE › Image 1: Menu form": "image_1.png",
+        "NY RISE › Image 1: Menu form": "image_2.png",
+    })
+    assert resolver.find_exact("In NJ, use Image 1: Menu form") == ["NJ RISE › Image 1: Menu form"]
+    assert len(resolver.find_exact("Use Image 1: Menu form")) == 2
+
+
+def test_paraphrased_caption_and_related_fallback():
+    resolver = ImageReferenceResolver({
+        "Image 3: Leaf Trade order confirmation screen": "image_3.png",
+        "Image 4: Price list": "image_4.png",
+    })
+    referenced, _ = resolver.resolve("As shown in Image 3: Leaf Trade order confirmation screens, ...")
+    assert referenced == ["Image 3: Leaf Trade order confirmation screen"]
+    assert resolver.resolve("The pricing is set by the brand.") == ([], ["Image 4: Price list"])
@@ -0,0 +1,54 @@
+import os
+import json
+import pytest
+from utils.rag import context_image_map, select_context_chunks
+from utils.images import normalize_caption, split_section
+from utils.facets import parse_query_facets
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(autouse=True)
+def in_repo(monkeypatch):
+    # Config paths are relative to the app directory
+    monkeypatch.chdir(REPO_DIR)
+
+
+def load_json(name):
+    with open(os.path.join(REPO_DIR, name), "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def test_labelled_chunks_scope_to_map_keys():
+    img_map = load_json("map.json")
+    captions = {normalize_caption(split_section(key)[1]) for key in img_map}
+    for chunk in load_json("enriched_chunks.json"):
+        labels = [label for label in chunk.get("image_labels", []) if normalize_caption(label) in captions]
+        if labels:
+            assert context_image_map([chunk], img_map), labels
+
+
+def test_image_files_link_wins_over_labels():
+    img_map = {"Image 1: . Menu form": "image_1.png", "Image 2: . Special deals": "image_2.png"}
+    chunk = {"image_labels": ["Image 1: . Menu form"], "image_files": [{"label": "x", "file": "image_2.png"}]}
+    assert context_image_map([chunk], img_map) == {"Image 2: . Special deals": "image_2.png"}
+
+
+def test_repeated_caption_narrowed_to_question_states():
+    img_map = {
+        "NJ RISE › Image 1: . Menu form": "image_1.png",
+        "NY RISE › Image 1: . Menu form": "image_2.png",
+    }
+    chunk = {"image_labels": ["Image 1. Menu form"], "image_files": []}
+    assert context_image_map([chunk], img_map, states={"NJ"}) == {"NJ RISE › Image 1: . Menu form": "image_1.png"}
+    assert len(context_image_map([chunk], img_map)) == 2
+
+
+def test_golden_questions_get_captions():
+    img_map = load_json("map.json")
+    with open(os.path.join(REPO_DIR, "golden_questions.jsonl"), "r", encoding="utf-8") as f:
+        questions = [json.loads(line)["question"] for line in f if line.strip()]
+    for question in questions:
+        chunks = select_context_chunks(question)
+        states = parse_query_facets(question)["states"]
+        assert context_image_map(chunks, img_map, states), question
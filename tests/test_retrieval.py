@@ -0,0 +1,33 @@
+from utils.retrieval import BM25Index, tokenize
+
+
+def test_tokenize_expands_sop_shorthand():
+    terms = tokenize("LT orders for NJ")
+    assert "leaf" in terms and "trade" in terms
+    assert "new" in terms and "jersey" in terms
+    # Stopwords are dropped and plurals folded
+    assert "for" not in terms
+    assert "order" in terms
+
+
+def test_shorthand_in_question_matches_expanded_chunk():
+    index = BM25Index([
+        {"chunk_text": "Place the order in Leaf Trade before noon."},
+        {"chunk_text": "Substitutions need the buyer's approval."},
+    ])
+    assert index.search("how do I submit an LT order?", k=1)[0][0] == 0
+
+
+def test_search_ranks_and_respects_candidates():
+    index = BM25Index([
+        {"chunk_text": "Delivery days for Ohio are Monday and Thursday."},
+        {"chunk_text": "Delivery days for Maryland are Tuesday."},
+        {"chunk_text": "Menu forms are sent every Friday."},
+    ])
+    assert [doc_id for doc_id, _ in index.search("Maryland delivery days")][0] == 1
+    assert [doc_id for doc_id, _ in index.search("delivery days", candidates={0})] == [0]
+    assert index.search("pineapple") == []
+
+
+def test_empty_index():
+    assert BM25Index([]).search("delivery days") == []
@@ -0,0 +1,64 @@
+import os
+import json
+import sqlite3
+import pytest
+import utils.state_store as state_store
+from utils.state import CONVERSATION_ID, _migrate_json_state, get_user_state_filepath
+from utils.state_store import StateStore
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    # Legacy state files are relative to the app directory
+    monkeypatch.chdir(tmp_path)
+    return StateStore(str(tmp_path / "state.db"))
+
+
+def test_reads_see_queued_writes(store):
+    store.put_instruction("u1", "Short", "Be brief.")
+    store.update_user("u1", current_instruction_name="Short", thread_id="thread_1")
+    store.append_message("u1", "main", {"role": "user", "content": "hi"})
+    store.append_message("u1", "main", {"role": "assistant", "content": "hello", "meta": {"mode": "local_rag"}})
+    assert store.load_user("u1") == {
+        "current_instruction_name": "Short", "thread_id": "thread_1", "instructions": {"Short": "Be brief."},
+    }
+    assert store.load_messages("u1", "main", limit=1) == [{"role": "assistant", "content": "hello", "meta": {"mode": "local_rag"}}]
+    assert store.load_user("u2") is None
+
+
+def test_flush_waits_out_a_locked_database(tmp_path, monkeypatch):
+    # Fail fast on a lock instead of waiting out the 30s busy timeout
+    connect = state_store._connect
+    monkeypatch.setattr(state_store, "_connect", lambda path: connect(path).execute("PRAGMA busy_timeout=10").connection)
+    monkeypatch.setattr(state_store, "COMMIT_BACKOFF_SECONDS", 0.01)
+    store = StateStore(str(tmp_path / "state.db"))
+    locker = sqlite3.connect(store.path)
+    locker.execute("BEGIN EXCLUSIVE")
+    store.append_message("u1", "main", {"role": "user", "content": "kept"})
+    assert not store.flush(timeout=0.5)
+    locker.rollback()
+    locker.close()
+    assert store.flush()
+    assert store.load_messages("u1", "main") == [{"role": "user", "content": "kept"}]
+
+
+def test_rejected_statement_does_not_drop_the_batch(store):
+    store._enqueue("INSERT INTO missing_table VALUES (?)", (1,))
+    store.append_message("u1", "main", {"role": "user", "content": "hi"})
+    assert store.flush()
+    assert store.load_messages("u1", "main") == [{"role": "user", "content": "hi"}]
+
+
+def test_migrates_legacy_json_once(store):
+    filepath = get_user_state_filepath("u1")
+    with open(filepath, "w") as f:
+        json.dump({
+            "custom_instructions": {"Default": "ignored", "Short": "Be brief."},
+            "current_instruction_name": "Short",
+            "threads": [{"role": "user", "content": "hi"}, "not a message"],
+        }, f)
+    assert _migrate_json_state("u1", store)
+    assert store.load_user("u1")["instructions"] == {"Short": "Be brief."}
+    assert store.load_messages("u1", CONVERSATION_ID) == [{"role": "user", "content": "hi"}]
+    assert os.path.exists(filepath + ".migrated")
+    assert not _migrate_json_state("u1", store)
@@ -0,0 +1,211 @@
+import time
+from functools import partial
+from utils.images import get_image_resolver, split_section
+from utils.facets import parse_query_facets
+from utils.context import CONTEXT_RECENT_MESSAGES, memory_block
+from utils.rag import select_context_chunks, context_image_map, build_rag_messages, complete_chat
+from utils.pipeline import get_pipeline, get_openai_client
+
+
+def resolve_message_images(answer_text, img_map, scoped_map=None):
+    """
+    Works out which SOP images an answer shows: the captions it references,
+    or up to 2 contextually related images when it references none. Done
+    once when the message is added and stored with it.
+
+    With scoped_map (the images of the chunks retrieved for the question),
+    matching runs against those images first; only an exact caption outside
+    them is looked up in the full map.
+    """
+    # Compiled once per map version, then a single pass over the answer
+    if scoped_map:
+        referenced, related = get_image_resolver(scoped_map).resolve(answer_text)
+        if not referenced:
+            referenced = get_image_resolver(img_map).find_exact(answer_text)
+            if referenced:
+                related = []
+    else:
+        referenced, related = get_image_resolver(img_map).resolve(answer_text)
+    images = [{"label": label, "file": img_map[label], "caption": split_section(label)[1]} for label in referenced]
+    images += [
+        {"label": label, "file": img_map[label], "caption": f"Related: {split_section(label)[1]}", "related": True}
+        for label in related
+    ]
+    return images
+
+
+def assistant_run_options(memory, scoped_map=None):
+    """
+    Per-run context bounds for the assistant thread: the model only reads the
+    last few thread messages, and older turns come in as the summary block.
+    The captions of the images retrieved for this question ride along.
+    """
+    options = {"truncation_strategy": {"type": "last_messages", "last_messages": CONTEXT_RECENT_MESSAGES}}
+    block = memory_block(memory) + image_context_block(scoped_map)
+    if block:
+        options["additional_instructions"] = block
+    return options
+
+
+def image_context_block(img_map):
+    """
+    Instructions block listing the given images by their exact labels ("" for none).
+    Called with the images of the retrieved chunks, not the whole map.
+    """
+    if not img_map:
+        return ""
+
+    image_lines = []
+    for key in img_map.keys():
+        section, label = split_section(key)
+        image_lines.append(f"- {label} (section: {section})" if section else f"- {label}")
+    image_list = "\n".join(image_lines)
+
+    return f"""
+
+---
+# Available Images for Reference
+---
+The following SOP images belong to the passages retrieved for this question. When answering questions, reference these images by their EXACT labels when relevant:
+
+{image_list}
+
+Remember: Always include the full label exactly as written above when referencing an image. This ensures the image will be displayed to the user.
+"""
+
+
+def enhance_assistant_with_image_context(instructions, img_map):
+    """
+    Enhance the assistant instructions with available image information
+    """
+    return instructions + image_context_block(img_map)
+
+
+def poll_assistant_reply(client, thread_id, assistant_id, **run_options):
+    """
+    Runs the assistant on the thread and waits for it.
+    Returns (reply_text or None, run).
+    """
+    run = client.beta.threads.runs.create_and_poll(
+        thread_id=thread_id,
+        assistant_id=assistant_id,
+        **run_options
+    )
+    if run.status != "completed":
+        return None, run
+    messages = client.beta.threads.messages.list(thread_id=thread_id, order="desc", limit=1)
+    return messages.data[0].content[0].text.value, run
+
+
+def run_usage(run):
+    """Token usage of an assistant run, in the shape complete_chat returns."""
+    if run.usage is None:
+        return {}
+    return {"total_tokens": run.usage.total_tokens}
+
+
+def answer_meta(mode, model, started, usage, reply, img_map, scoped_map=None):
+    """The meta stored with an answer: engine, latency, tokens and the images it shows."""
+    return {
+        "mode": mode,
+        "model": model,
+        "latency_s": time.perf_counter() - started,
+        "total_tokens": usage.get("total_tokens"),
+        # Worked out once here instead of on every rerun
+        "images": resolve_message_images(reply, img_map, scoped_map),
+    }
+
+
+# --- Answer steps, shared by the Chatbot page (which streams) and answer_question() ---
+
+def prepare_answer(api_key, question, mode, img_map, thread_id=None, cache_lookup=None):
+    """
+    Everything before the model call: the answer-cache lookup, local
+    retrieval and (in assistant mode) posting the question to the thread run
+    together; the retrieved chunks then pick the image captions for the prompt.
+    Assistant mode only needs those captions (file_search finds the text),
+    so it retrieves with BM25 and facets alone, without encoding the question.
+
+    Returns:
+        dict: {"question", "mode", "started", "cached", "context_chunks", "scoped_map"}
+    """
+    started = time.perf_counter()
+    pipeline = get_pipeline()
+    prepared = pipeline.run(pipeline.prepare_question(
+        api_key,
+        question,
+        None if mode == "local_rag" else thread_id,
+        cache_lookup or (lambda: None),
+        partial(select_context_chunks, semantic=mode == "local_rag")
+    ))
+    context_chunks = prepared["context_chunks"]
+    return {
+        "question": question,
+        "mode": mode,
+        "started": started,
+        "cached": prepared["cached"],
+        "context_chunks": context_chunks,
+        "scoped_map": context_image_map(context_chunks, img_map, parse_query_facets(question)["states"]),
+    }
+
+
+def cached_result(prepared):
+    """The result for a cache hit, with this request's latency."""
+    cached = prepared["cached"]
+    meta = dict(cached["meta"], latency_s=time.perf_counter() - prepared["started"], total_tokens=None, cached=True)
+    return {"status": "completed", "answer": cached["answer"], "meta": meta}
+
+
+def local_rag_messages(prepared, instructions, history=None, memory=None):
+    """The Local RAG prompt: instructions with the scoped captions, SOP context, history and question."""
+    return build_rag_messages(
+        prepared["question"],
+        enhance_assistant_with_image_context(instructions, prepared["scoped_map"]),
+        prepared["context_chunks"],
+        history,
+        memory
+    )
+
+
+def prepared_run_options(prepared, memory=None):
+    """assistant_run_options for this question's scoped captions."""
+    return assistant_run_options(memory, prepared["scoped_map"])
+
+
+def finish_answer(prepared, model, status, reply, usage, img_map):
+    """
+    Returns:
+        dict: {"status", "answer", "meta"}; answer and meta are None unless status is "completed".
+    """
+    if status != "completed":
+        return {"status": status, "answer": None, "meta": None}
+    meta = answer_meta(prepared["mode"], model, prepared["started"], usage, reply, img_map, prepared["scoped_map"])
+    return {"status": status, "answer": reply, "meta": meta}
+
+
+def answer_question(api_key, question, mode, model, instructions, img_map,
+                    thread_id=None, assistant_id=None, memory=None, history=None, cache_lookup=None):
+    """
+    Answers one question without any UI, through the same steps as the
+    Chatbot page, with a non-streaming Local RAG completion or assistant run.
+
+    Args:
+        mode (str): "assistant" (needs thread_id and assistant_id) or "local_rag".
+        cache_lookup (callable, optional): Returns a cached {"answer", "meta"} or None.
+
+    Returns:
+        dict: {"status", "answer", "meta"}; answer is None unless status is "completed".
+    """
+    client = get_openai_client(api_key)
+    prepared = prepare_answer(api_key, question, mode, img_map, thread_id, cache_lookup)
+    if prepared["cached"] is not None:
+        return cached_result(prepared)
+
+    if mode == "local_rag":
+        reply, usage = complete_chat(client, model, local_rag_messages(prepared, instructions, history, memory))
+        status = "completed"
+    else:
+        reply, run = poll_assistant_reply(client, thread_id, assistant_id, **prepared_run_options(prepared, memory))
+        status = run.status
+        usage = run_usage(run)
+    return finish_answer(prepared, model, status, reply, usage, img_map)
@@ -0,0 +1,180 @@
+import re
+import time
+import threading
+from collections import OrderedDict
+import numpy as np
+import streamlit as st
+from utils.retrieval import tokenize, get_chunks_version
+from utils.facets import parse_query_facets
+from utils.gdoc import get_last_gdoc_synced_time
+from utils.log import logger
+
+# === Answer cache settings ===
+ANSWER_CACHE_MAX_ENTRIES = 512
+ANSWER_CACHE_TTL_SECONDS = 12 * 3600
+# Cosine similarity above which two questions count as the same question
+ANSWER_CACHE_SIMILARITY = 0.92
+# Shorter questions ("what about NV?") usually lean on the conversation, so they are never cached
+ANSWER_CACHE_MIN_TERMS = 3
+# Phrases that make a question lean on the previous turn ("what about RISE?", "same for MD")
+FOLLOW_UP_PATTERN = re.compile(r"\b(what about|how about|same|that|those|it|this|these|them)\b", re.IGNORECASE)
+
+
+def normalize_question(question):
+    """Folds case, punctuation, stopwords and SOP shorthand so trivial rewordings share a key."""
+    return " ".join(tokenize(question))
+
+
+def is_cacheable(question, history=None):
+    """
+    Whether a question's answer can be shared across users. Only the first
+    question of a conversation qualifies, since later answers depend on
+    earlier turns, and never a follow-up that names no state or order type.
+    """
+    if history:
+        return False
+    if len(normalize_question(question).split()) < ANSWER_CACHE_MIN_TERMS:
+        return False
+    facets = parse_query_facets(question)
+    if not facets["states"] and facets["order_type"] is None and FOLLOW_UP_PATTERN.search(question):
+        return False
+    return True
+
+
+def get_sop_revision():
+    """The Google Doc modified_time of the last sync, or the chunk file version before any sync."""
+    return get_last_gdoc_synced_time() or get_chunks_version()
+
+
+class AnswerCache:
+    """
+    Process-wide LRU/TTL cache of answers, keyed by normalized question, SOP
+    revision and scope (engine, model, instructions). Near-duplicate questions
+    are matched by embedding similarity when sentence-transformers is available,
+    but only when both name the same states and order type: "NJ delivery
+    days" and "NY delivery days" embed almost identically.
+    """
+
+    def __init__(self, max_entries=ANSWER_CACHE_MAX_ENTRIES, ttl_seconds=ANSWER_CACHE_TTL_SECONDS,
+                 similarity=ANSWER_CACHE_SIMILARITY):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.similarity = similarity
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._revision = None
+        self._semantic = True
+        self.hits = 0
+        self.misses = 0
+
+    def _embed(self, normalized):
+        if not self._semantic:
+            return None
+        try:
+            from utils.embeddings import embed_texts
+            return embed_texts([normalized])[0]
+        except Exception as e:
+            # No sentence-transformers here: fall back to exact matching for good
+            logger.warning("Semantic answer cache disabled: %s", e)
+            self._semantic = False
+            return None
+
+    def warm(self):
+        """Loads the embedding model now, so the first question doesn't wait for it."""
+        self._embed(normalize_question("warm up the answer cache"))
+
+    def _sync_revision(self, revision):
+        # A new SOP revision makes every cached answer stale
+        if revision != self._revision:
+            self._entries.clear()
+            self._revision = revision
+
+    def _evict_expired(self, now):
+        expired = [key for key, entry in self._entries.items() if now - entry["created_at"] > self.ttl_seconds]
+        for key in expired:
+            del self._entries[key]
+
+    def get(self, question, scope, history=None, revision=None):
+        """
+        Returns the cached entry ({"answer", "meta", ...}) for a question, or None.
+        history is the conversation before the question (see is_cacheable).
+        """
+        if not is_cacheable(question, history):
+            return None
+        normalized = normalize_question(question)
+        revision = revision if revision is not None else get_sop_revision()
+        facets = parse_query_facets(question)
+        now = time.time()
+
+        with self._lock:
+            self._sync_revision(revision)
+            self._evict_expired(now)
+            key = (scope, normalized)
+            entry = self._entries.get(key)
+            if entry is not None and entry["facets"] == facets:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            has_candidates = any(
+                k[0] == scope and e["vector"] is not None and e["facets"] == facets
+                for k, e in self._entries.items()
+            )
+
+        # Embedding the question happens outside the lock
+        vector = self._embed(normalized) if has_candidates else None
+        if vector is not None:
+            with self._lock:
+                best_key, best_score = None, self.similarity
+                for k, e in self._entries.items():
+                    if k[0] != scope or e["vector"] is None or e["facets"] != facets:
+                        continue
+                    score = float(np.dot(vector, e["vector"]))
+                    if score >= best_score:
+                        best_key, best_score = k, score
+                if best_key is not None:
+                    self._entries.move_to_end(best_key)
+                    self.hits += 1
+                    return self._entries[best_key]
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, question, scope, answer, meta=None, history=None, revision=None):
+        if not is_cacheable(question, history):
+            return
+        normalized = normalize_question(question)
+        revision = revision if revision is not None else get_sop_revision()
+        vector = self._embed(normalized)
+        with self._lock:
+            self._sync_revision(revision)
+            self._entries[(scope, normalized)] = {
+                "answer": answer,
+                "meta": meta or {},
+                "vector": vector,
+                "facets": parse_query_facets(question),
+                "created_at": time.time(),
+            }
+            self._entries.move_to_end((scope, normalized))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+@st.cache_resource
+def get_answer_cache():
+    """
+    The answer cache for this process. Built once, with the embedding model
+    loaded up front so no question pays for it.
+    """
+    cache = AnswerCache()
+    cache.warm()
+    return cache
@@ -0,0 +1,487 @@
+import os
+import json
+import time
+import uuid
+import threading
+from contextlib import contextmanager
+from functools import lru_cache
+import openai
+import streamlit as st
+try:
+    import fcntl
+except ImportError:  # Windows: the registry is only locked within the process
+    fcntl = None
+from utils.config import ASSISTANT_REGISTRY_PATH, DOCX_LOCAL_PATH, get_secret
+from utils.hashing import file_sha256, text_sha256
+from utils.log import logger
+from utils.pipeline import get_openai_client
+
+# Assistants that nobody has asked for in this long are deleted by the GC
+ASSISTANT_IDLE_TTL = 7 * 24 * 3600
+# A session's hold on its pooled assistant lapses if it is not renewed for this long
+SESSION_LEASE_TTL = 2 * 3600
+# How often the pool sweeper runs; must stay below SESSION_LEASE_TTL, since each pass renews leases in the registry
+SWEEP_INTERVAL = 3600
+# Unregistered resources younger than this may still be mid-setup
+ORPHAN_GRACE_SECONDS = 3600
+# Metadata key tagging assistants and vector stores with the registry that created them
+DEPLOYMENT_METADATA_KEY = "sop_deployment"
+
+ASSISTANT_NAME_PREFIX = "SOP Sales Coordinator"
+VECTOR_STORE_NAME_PREFIX = "SOP Vector Store"
+
+_registry_lock = threading.Lock()
+
+
+@contextmanager
+def registry_lock():
+    """
+    Serialises registry read-modify-write cycles across threads and, through
+    an flock on a sidecar file, across processes sharing the cache directory.
+    """
+    with _registry_lock:
+        if fcntl is None:
+            yield
+            return
+        os.makedirs(os.path.dirname(ASSISTANT_REGISTRY_PATH) or ".", exist_ok=True)
+        with open(ASSISTANT_REGISTRY_PATH + ".lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def account_fingerprint(api_key):
+    """Short hash of an API key, so resources are keyed by the account that owns them."""
+    return text_sha256(api_key or "")[:16]
+
+
+@lru_cache(maxsize=8)
+def _docx_sha256(path, mtime_ns, size):
+    return file_sha256(path)
+
+
+def docx_sha256(path):
+    """file_sha256, hashed once per file version."""
+    stat = os.stat(path)
+    return _docx_sha256(path, stat.st_mtime_ns, stat.st_size)
+
+
+def load_registry():
+    """
+    Reads the setup registry.
+
+    Layout:
+        documents:  "account:docx hash" -> {account, docx_hash, file_id, vector_store_id, created_at}
+        assistants: "account:docx hash:instructions hash:model" -> {account, assistant_id, docx_hash, created_at, last_used}
+
+    Entries written before accounts were recorded belong to the app's own key.
+    deployment_id tags every resource this registry creates. Call with
+    registry_lock() held.
+    """
+    if os.path.exists(ASSISTANT_REGISTRY_PATH):
+        try:
+            with open(ASSISTANT_REGISTRY_PATH, "r") as f:
+                registry = json.load(f)
+        except (json.JSONDecodeError, OSError):
+            registry = {}
+    else:
+        registry = {}
+    registry.setdefault("documents", {})
+    registry.setdefault("assistants", {})
+    registry.setdefault("deployment_id", uuid.uuid4().hex)
+    legacy = [
+        (section, key) for section in ("documents", "assistants")
+        for key, entry in registry[section].items() if "account" not in entry
+    ]
+    if legacy:
+        account = account_fingerprint(get_secret("openai_key"))
+        for section, key in legacy:
+            entry = registry[section].pop(key)
+            entry["account"] = account
+            if section == "documents":
+                entry["docx_hash"] = key
+            registry[section][f"{account}:{key}"] = entry
+    return registry
+
+
+def save_registry(registry):
+    os.makedirs(os.path.dirname(ASSISTANT_REGISTRY_PATH), exist_ok=True)
+    tmp_path = ASSISTANT_REGISTRY_PATH + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(registry, f, indent=2)
+    os.replace(tmp_path, ASSISTANT_REGISTRY_PATH)
+
+
+def _exists(retrieve, resource_id):
+    try:
+        retrieve(resource_id)
+        return True
+    except openai.NotFoundError:
+        return False
+
+
+def _delete_quietly(delete, resource_id):
+    try:
+        delete(resource_id)
+    except openai.NotFoundError:
+        pass
+    except Exception as e:
+        logger.warning("Could not delete %s: %s", resource_id, e)
+
+
+def _deployment_metadata(registry):
+    return {DEPLOYMENT_METADATA_KEY: registry["deployment_id"]}
+
+
+def _create_document_resources(client, docx_path, docx_hash, metadata):
+    """Uploads the DOCX and indexes it in a new vector store."""
+    with open(docx_path, "rb") as f:
+        file_response = client.files.create(file=f, purpose="assistants")
+    vector_store = client.vector_stores.create(
+        name=f"{VECTOR_STORE_NAME_PREFIX} - {docx_hash[:8]}", metadata=metadata
+    )
+    client.vector_stores.file_batches.create_and_poll(
+        vector_store_id=vector_store.id, file_ids=[file_response.id]
+    )
+    return {"file_id": file_response.id, "vector_store_id": vector_store.id, "created_at": time.time()}
+
+
+def collect_garbage(client, registry, current_docx_hash, now=None, in_use=()):
+    """
+    Drops the entries the registry no longer needs: everything built from a
+    superseded DOCX, and assistants idle for longer than ASSISTANT_IDLE_TTL.
+    Assistants in in_use (this process's leases) or used within
+    SESSION_LEASE_TTL (possibly leased by another process) are kept, with
+    their documents. Only entries of the client's own account are considered.
+
+    Returns:
+        list: (kind, id) of the resources to pass to delete_resources() once
+        the registry lock is released.
+    """
+    now = now or time.time()
+    account = account_fingerprint(client.api_key)
+    garbage = []
+    for key, entry in list(registry["assistants"].items()):
+        if entry["account"] != account or entry["assistant_id"] in in_use:
+            continue
+        last_used = entry.get("last_used", entry["created_at"])
+        if now - last_used < SESSION_LEASE_TTL:
+            continue
+        superseded = entry["docx_hash"] != current_docx_hash
+        idle = now - last_used > ASSISTANT_IDLE_TTL
+        if superseded or idle:
+            garbage.append(("assistant", entry["assistant_id"]))
+            del registry["assistants"][key]
+
+    needed = {current_docx_hash} | {
+        entry["docx_hash"] for entry in registry["assistants"].values() if entry["account"] == account
+    }
+    for key, doc in list(registry["documents"].items()):
+        if doc["account"] == account and doc["docx_hash"] not in needed:
+            garbage.append(("vector_store", doc["vector_store_id"]))
+            garbage.append(("file", doc["file_id"]))
+            del registry["documents"][key]
+    return garbage
+
+
+def delete_resources(client, resources):
+    """Deletes (kind, id) pairs from collect_garbage, ignoring ones already gone."""
+    deletes = {
+        "assistant": client.beta.assistants.delete,
+        "vector_store": client.vector_stores.delete,
+        "file": client.files.delete,
+    }
+    for kind, resource_id in resources:
+        _delete_quietly(deletes[kind], resource_id)
+
+
+def _create_assistant(client, key, instructions, model, vector_store_id, metadata):
+    return client.beta.assistants.create(
+        name=f"{ASSISTANT_NAME_PREFIX} - {text_sha256(key)[:8]}",
+        instructions=instructions,
+        model=model,
+        tools=[{"type": "file_search"}],
+        tool_resources={"file_search": {"vector_store_ids": [vector_store_id]}},
+        metadata=metadata
+    ).id
+
+
+def get_or_create_assistant(client, docx_path, instructions, model, in_use=(), attempts=3):
+    """
+    Returns an assistant id for (account, DOCX content, instructions, model),
+    reusing the uploaded file, vector store and assistant from any earlier
+    session or user on the same account when they still exist.
+
+    The registry lock is only held to read and to record: uploads, indexing
+    and assistant creation run without it, so one cold build doesn't stall
+    other setups or the sweeper. If another process recorded the same
+    resources meanwhile, ours are deleted and theirs are used.
+    """
+    account = account_fingerprint(client.api_key)
+    docx_hash = docx_sha256(docx_path)
+    key = AssistantPool.key(account, docx_hash, instructions, model)
+    doc_key = f"{account}:{docx_hash}"
+
+    for _ in range(attempts):
+        with registry_lock():
+            registry = load_registry()
+            seen_entry = registry["assistants"].get(key)
+            seen_doc = registry["documents"].get(doc_key)
+            metadata = _deployment_metadata(registry)
+
+        if seen_entry and _exists(client.beta.assistants.retrieve, seen_entry["assistant_id"]):
+            with registry_lock():
+                registry = load_registry()
+                entry = registry["assistants"].get(key)
+                if entry and entry["assistant_id"] == seen_entry["assistant_id"]:
+                    entry["last_used"] = time.time()
+                    save_registry(registry)
+            return seen_entry["assistant_id"]
+
+        doc = seen_doc
+        created_doc = None
+        if not doc or not _exists(client.vector_stores.retrieve, doc["vector_store_id"]):
+            created_doc = _create_document_resources(client, docx_path, docx_hash, metadata)
+            created_doc.update(account=account, docx_hash=docx_hash)
+            doc = created_doc
+        assistant_id = _create_assistant(client, key, instructions, model, doc["vector_store_id"], metadata)
+        ours = [("assistant", assistant_id)]
+        if created_doc:
+            ours += [("vector_store", created_doc["vector_store_id"]), ("file", created_doc["file_id"])]
+
+        with registry_lock():
+            registry = load_registry()
+            entry = registry["assistants"].get(key)
+            current_doc = registry["documents"].get(doc_key)
+            lost_assistant = (entry or {}).get("assistant_id") != (seen_entry or {}).get("assistant_id")
+            lost_doc = (current_doc or {}).get("vector_store_id") != (seen_doc or {}).get("vector_store_id")
+            if lost_assistant or lost_doc:
+                # Another process got here first; its resources win
+                winner = entry["assistant_id"] if lost_assistant and entry else None
+                garbage = ours
+            else:
+                if created_doc:
+                    registry["documents"][doc_key] = created_doc
+                registry["assistants"][key] = {
+                    "account": account,
+                    "assistant_id": assistant_id,
+                    "docx_hash": docx_hash,
+                    "created_at": time.time(),
+                    "last_used": time.time(),
+                }
+                garbage = collect_garbage(client, registry, docx_hash, in_use=in_use)
+                save_registry(registry)
+                winner = assistant_id
+
+        delete_resources(client, garbage)
+        if winner:
+            return winner
+    raise RuntimeError("Could not record the assistant: the registry kept changing during setup.")
+
+
+def sweep_orphans(client, registry, now=None):
+    """
+    Deletes assistants and vector stores (with their files) that this
+    registry created, as proven by their deployment metadata, but no longer
+    lists, e.g. after a setup that crashed before the registry was saved.
+    Resources without our tag are never touched. registry may be a snapshot:
+    ORPHAN_GRACE_SECONDS outlasts any setup that could record after it.
+
+    Returns:
+        dict: Number of deleted assistants, vector stores and files.
+    """
+    now = now or time.time()
+    deployment_id = registry["deployment_id"]
+    known_assistants = {entry["assistant_id"] for entry in registry["assistants"].values()}
+    known_stores = {doc["vector_store_id"] for doc in registry["documents"].values()}
+    known_files = {doc["file_id"] for doc in registry["documents"].values()}
+    deleted = {"assistants": 0, "vector_stores": 0, "files": 0}
+
+    def orphaned(resource, known):
+        metadata = resource.metadata or {}
+        return (
+            metadata.get(DEPLOYMENT_METADATA_KEY) == deployment_id
+            and resource.id not in known
+            and now - resource.created_at > ORPHAN_GRACE_SECONDS
+        )
+
+    for assistant in client.beta.assistants.list(limit=100):
+        if orphaned(assistant, known_assistants):
+            _delete_quietly(client.beta.assistants.delete, assistant.id)
+            deleted["assistants"] += 1
+
+    for store in client.vector_stores.list(limit=100):
+        if orphaned(store, known_stores):
+            # Files only ever get into our stores through _create_document_resources
+            for store_file in client.vector_stores.files.list(vector_store_id=store.id):
+                if store_file.id not in known_files:
+                    _delete_quietly(client.files.delete, store_file.id)
+                    deleted["files"] += 1
+            _delete_quietly(client.vector_stores.delete, store.id)
+            deleted["vector_stores"] += 1
+    return deleted
+
+
+class AssistantPool:
+    """
+    Process-wide pool handing out one shared assistant per (account,
+    instructions, model, SOP revision). Sessions hold a lease on the assistant they use, so
+    a returning key costs no API call; the reference count is the number of
+    live leases. Sessions never say goodbye, so leases lapse after
+    SESSION_LEASE_TTL unless renewed.
+
+    A daemon sweeper periodically refreshes the registry's last_used for
+    leased assistants (more often than SESSION_LEASE_TTL, which is what
+    keeps other processes from collecting them), collects unused ones and
+    deletes orphaned resources.
+    It only ever works with the app's own key (the openai_key secret), never
+    with a key a user logged in with.
+    """
+
+    def __init__(self, sweep_interval=SWEEP_INTERVAL):
+        self.sweep_interval = sweep_interval
+        self._lock = threading.Lock()
+        self._creating = {}   # key -> lock, so concurrent sessions build a key once
+        self._entries = {}    # key -> {"assistant_id", "docx_hash", "leases": {session_id: last_seen}}
+        self._sessions = {}   # session_id -> key
+        self._sweeper = None
+
+    @staticmethod
+    def key(account, docx_hash, instructions, model):
+        return f"{account}:{docx_hash}:{text_sha256(instructions)}:{model}"
+
+    def _lease(self, key, session_id, now):
+        previous = self._sessions.get(session_id)
+        if previous is not None and previous != key and previous in self._entries:
+            self._entries[previous]["leases"].pop(session_id, None)
+        self._entries[key]["leases"][session_id] = now
+        self._sessions[session_id] = key
+
+    def acquire(self, client, session_id, docx_path, instructions, model):
+        """
+        Returns the shared assistant id for this session's setup, creating it
+        (once, across all waiting sessions) only on a pool miss.
+        """
+        docx_hash = docx_sha256(docx_path)
+        key = self.key(account_fingerprint(client.api_key), docx_hash, instructions, model)
+        with self._lock:
+            self._start_sweeper()
+            if key in self._entries:
+                self._lease(key, session_id, time.time())
+                return self._entries[key]["assistant_id"]
+            creating = self._creating.setdefault(key, threading.Lock())
+
+        with creating:
+            with self._lock:
+                if key in self._entries:
+                    self._lease(key, session_id, time.time())
+                    return self._entries[key]["assistant_id"]
+                in_use = self.in_use()
+            assistant_id = get_or_create_assistant(client, docx_path, instructions, model, in_use=in_use)
+            with self._lock:
+                self._entries[key] = {"assistant_id": assistant_id, "docx_hash": docx_hash, "leases": {}}
+                self._lease(key, session_id, time.time())
+                self._creating.pop(key, None)
+            return assistant_id
+
+    def touch(self, session_id):
+        """Renews the session's lease."""
+        with self._lock:
+            key = self._sessions.get(session_id)
+            if key in self._entries:
+                self._entries[key]["leases"][session_id] = time.time()
+
+    def release(self, session_id):
+        with self._lock:
+            key = self._sessions.pop(session_id, None)
+            if key in self._entries:
+                self._entries[key]["leases"].pop(session_id, None)
+
+    def discard(self, assistant_id):
+        """Forgets a pooled assistant (e.g. after a failed run), so the next acquire re-checks it."""
+        with self._lock:
+            for key, entry in list(self._entries.items()):
+                if entry["assistant_id"] == assistant_id:
+                    del self._entries[key]
+
+    def refcount(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            return len(entry["leases"]) if entry else 0
+
+    def in_use(self):
+        """Assistant ids with at least one live lease. Call with the lock held."""
+        return {entry["assistant_id"] for entry in self._entries.values() if entry["leases"]}
+
+    def _expire_leases(self, now):
+        for key, entry in self._entries.items():
+            for session_id, last_seen in list(entry["leases"].items()):
+                if now - last_seen > SESSION_LEASE_TTL:
+                    del entry["leases"][session_id]
+                    if self._sessions.get(session_id) == key:
+                        del self._sessions[session_id]
+
+    def sweep(self, client=None, current_docx_path=DOCX_LOCAL_PATH):
+        """
+        One sweeper pass: drops lapsed leases and unleased pool entries, then
+        runs the registry GC (sparing leased assistants) and the orphan sweep
+        for the app's account.
+        """
+        if client is None:
+            api_key = get_secret("openai_key")
+            if not api_key:
+                return None
+            client = get_openai_client(api_key)
+        now = time.time()
+        with self._lock:
+            self._expire_leases(now)
+            leased = {}
+            for key, entry in list(self._entries.items()):
+                if entry["leases"]:
+                    leased[key] = entry["assistant_id"]
+                else:
+                    del self._entries[key]
+        if os.path.exists(current_docx_path):
+            current_docx_hash = docx_sha256(current_docx_path)
+        else:
+            current_docx_hash = None
+
+        # Only the registry update is locked; API calls run after it
+        garbage = []
+        with registry_lock():
+            registry = load_registry()
+            # Renewed every sweep, so other processes' GC sees these leases as recent use
+            for key in leased:
+                if key in registry["assistants"]:
+                    registry["assistants"][key]["last_used"] = now
+            if current_docx_hash is not None:
+                garbage = collect_garbage(client, registry, current_docx_hash, now=now, in_use=set(leased.values()))
+            save_registry(registry)
+        delete_resources(client, garbage)
+        return sweep_orphans(client, registry, now=now)
+
+    def _start_sweeper(self):
+        if self._sweeper is None:
+            self._sweeper = threading.Thread(target=self._sweep_loop, name="assistant-pool-sweeper", daemon=True)
+            self._sweeper.start()
+
+    def _sweep_loop(self):
+        while True:
+            time.sleep(self.sweep_interval)
+            try:
+                deleted = self.sweep()
+                if deleted and any(deleted.values()):
+                    logger.info("Assistant sweep deleted %s", deleted)
+            except Exception as e:
+                logger.warning("Assistant sweep failed: %s", e)
+
+
+@st.cache_resource
+def get_assistant_pool():
+    """
+    The assistant pool. One instance, so its reference counts cover every
+    session that holds one of the pooled assistants.
+    """
+    return AssistantPool()
@@ -0,0 +1,235 @@
+import os
+import json
+import mmap
+import time
+import struct
+from functools import lru_cache
+import numpy as np
+from utils.config import (
+    BUNDLE_PATH,
+    ENRICHED_CHUNKS_PATH,
+    IMAGE_MAP_PATH,
+    EMBEDDINGS_PATH,
+    EMBEDDING_IDS_PATH,
+    IMAGE_DIR,
+    THUMBNAIL_DIR,
+)
+from utils.facets import tag_chunks
+from utils.log import logger
+
+# File layout: MAGIC | uint64 TOC length | TOC JSON | sections, each aligned to SECTION_ALIGN
+BUNDLE_MAGIC = b"SOPBNDL\x00"
+BUNDLE_FORMAT_VERSION = 1
+SECTION_ALIGN = 64
+_header = struct.Struct("<8sQ")
+
+
+def _pad(n):
+    return (-n) % SECTION_ALIGN
+
+
+def build_bundle(
+    revision=None,
+    bundle_path=BUNDLE_PATH,
+    chunks_path=ENRICHED_CHUNKS_PATH,
+    map_path=IMAGE_MAP_PATH,
+    matrix_path=EMBEDDINGS_PATH,
+    ids_path=EMBEDDING_IDS_PATH,
+):
+    """
+    Packs the sync outputs into one memory-mappable file: chunk text and
+    offsets, chunk image metadata, facet tags, the image map, the embedding
+    matrix and the image thumbnails.
+
+    Args:
+        revision (str, optional): SOP revision the bundle was built from.
+
+    Returns:
+        dict: The bundle's table of contents.
+    """
+    with open(chunks_path, "r", encoding="utf-8") as f:
+        chunks = json.load(f)
+    image_map = {}
+    if os.path.exists(map_path):
+        with open(map_path, "r") as f:
+            image_map = json.load(f)
+
+    sections = []  # (name, bytes, extra TOC fields)
+
+    texts = [c.get("chunk_text", "").encode("utf-8") for c in chunks]
+    offsets = np.zeros(len(texts) + 1, dtype="<u8")
+    np.cumsum([len(t) for t in texts], out=offsets[1:])
+    sections.append(("chunk_text", b"".join(texts), {"format": "utf8"}))
+    sections.append(("chunk_offsets", offsets.tobytes(), {"format": "array", "dtype": "<u8", "shape": [len(offsets)]}))
+    meta = [{"image_labels": c.get("image_labels", []), "image_files": c.get("image_files", [])} for c in chunks]
+    sections.append(("chunk_meta", json.dumps(meta).encode("utf-8"), {"format": "json"}))
+    sections.append(("facet_tags", json.dumps(tag_chunks(chunks)).encode("utf-8"), {"format": "json"}))
+    sections.append(("image_map", json.dumps(image_map).encode("utf-8"), {"format": "json"}))
+
+    # Embeddings are only bundled when they were built from exactly these chunks
+    if os.path.exists(matrix_path) and os.path.exists(ids_path):
+        from utils.embeddings import chunk_id
+        with open(ids_path, "r") as f:
+            id_map = json.load(f)
+        if id_map["ids"] == [chunk_id(c) for c in chunks]:
+            matrix = np.ascontiguousarray(np.load(matrix_path))
+            sections.append(("embeddings", matrix.tobytes(), {
+                "format": "array", "dtype": matrix.dtype.str, "shape": list(matrix.shape),
+                "model": id_map.get("model"), "ids": id_map["ids"],
+            }))
+        else:
+            logger.warning("Embedding index is out of date, bundling without embeddings.")
+
+    # Whichever of the thumbnail and the original is smaller, as get_image_bytes serves it
+    blobs = []
+    thumbnail_index = {}
+    position = 0
+    for image_name in sorted(set(image_map.values())):
+        path = os.path.join(IMAGE_DIR, image_name)
+        if not os.path.exists(path):
+            continue
+        thumbnail_path = os.path.join(THUMBNAIL_DIR, f"{os.path.splitext(image_name)[0]}.webp")
+        if os.path.exists(thumbnail_path) and os.path.getsize(thumbnail_path) < os.path.getsize(path):
+            path = thumbnail_path
+        with open(path, "rb") as f:
+            data = f.read()
+        thumbnail_index[image_name] = [position, len(data)]
+        blobs.append(data)
+        position += len(data)
+    sections.append(("thumbnails", b"".join(blobs), {"format": "bytes", "index": thumbnail_index}))
+
+    # Lay the sections out after the TOC. The TOC's own length depends on the
+    # offsets, so offsets are relative to the data start and fixed up on read.
+    toc = {
+        "format_version": BUNDLE_FORMAT_VERSION,
+        "revision": revision,
+        "created_at": time.time(),
+        "chunk_count": len(chunks),
+        "sections": {},
+    }
+    relative = 0
+    for name, data, extra in sections:
+        toc["sections"][name] = dict(extra, offset=relative, length=len(data))
+        relative += len(data) + _pad(len(data))
+    toc_bytes = json.dumps(toc).encode("utf-8")
+    data_start = _header.size + len(toc_bytes)
+    data_start += _pad(data_start)
+
+    os.makedirs(os.path.dirname(bundle_path) or ".", exist_ok=True)
+    tmp_path = bundle_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(_header.pack(BUNDLE_MAGIC, len(toc_bytes)))
+        f.write(toc_bytes)
+        f.write(b"\0" * (data_start - _header.size - len(toc_bytes)))
+        for _, data, _ in sections:
+            f.write(data)
+            f.write(b"\0" * _pad(len(data)))
+    os.replace(tmp_path, bundle_path)
+    return toc
+
+
+class KnowledgeBundle:
+    """
+    Read-only view of a bundle file. The file is mmapped once and arrays are
+    numpy views straight onto the mapping, so every process on the host
+    shares the same page-cache pages.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, toc_length = _header.unpack_from(self._mm, 0)
+        if magic != BUNDLE_MAGIC:
+            raise ValueError(f"{path} is not an SOP knowledge bundle")
+        self.toc = json.loads(self._mm[_header.size:_header.size + toc_length])
+        if self.toc["format_version"] != BUNDLE_FORMAT_VERSION:
+            raise ValueError(f"Unsupported bundle format {self.toc['format_version']}")
+        data_start = _header.size + toc_length
+        self._data_start = data_start + _pad(data_start)
+        self.revision = self.toc.get("revision")
+        self._chunks = None
+        self._image_map = None
+
+    def has(self, name):
+        return name in self.toc["sections"]
+
+    def _span(self, name):
+        section = self.toc["sections"][name]
+        start = self._data_start + section["offset"]
+        return start, section["length"]
+
+    def raw(self, name):
+        """Zero-copy memoryview of a section."""
+        start, length = self._span(name)
+        return memoryview(self._mm)[start:start + length]
+
+    def array(self, name):
+        section = self.toc["sections"][name]
+        start, _ = self._span(name)
+        count = int(np.prod(section["shape"]))
+        return np.frombuffer(self._mm, dtype=np.dtype(section["dtype"]), count=count, offset=start).reshape(section["shape"])
+
+    def json(self, name):
+        return json.loads(bytes(self.raw(name)))
+
+    def chunk_text(self, i):
+        offsets = self.array("chunk_offsets")
+        start, _ = self._span("chunk_text")
+        return self._mm[start + int(offsets[i]):start + int(offsets[i + 1])].decode("utf-8")
+
+    def chunks(self):
+        """Chunk dicts in the enriched_chunks.json layout (decoded once)."""
+        if self._chunks is None:
+            meta = self.json("chunk_meta")
+            self._chunks = [dict(m, chunk_text=self.chunk_text(i)) for i, m in enumerate(meta)]
+        return self._chunks
+
+    def facet_tags(self):
+        return self.json("facet_tags")
+
+    def image_map(self):
+        """The image map the bundle was built with (decoded once), or None for bundles without one."""
+        if self._image_map is None and self.has("image_map"):
+            self._image_map = self.json("image_map")
+        return self._image_map
+
+    def embeddings(self):
+        """(matrix view, ids, model name), or None if the bundle has no embeddings."""
+        if not self.has("embeddings"):
+            return None
+        section = self.toc["sections"]["embeddings"]
+        return self.array("embeddings"), section["ids"], section.get("model")
+
+    def thumbnail(self, image_name):
+        """Display bytes of an image, or None if it is not bundled."""
+        entry = self.toc["sections"]["thumbnails"]["index"].get(image_name)
+        if entry is None:
+            return None
+        start, _ = self._span("thumbnails")
+        return self._mm[start + entry[0]:start + entry[0] + entry[1]]
+
+
+def get_bundle_version(path=BUNDLE_PATH):
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    return f"{stat.st_mtime_ns}-{stat.st_size}"
+
+
+@lru_cache(maxsize=2)
+def open_bundle(path, version):
+    """Opens a bundle once per file version."""
+    return KnowledgeBundle(path)
+
+
+def get_bundle(path=BUNDLE_PATH):
+    """The current bundle, or None if there is none or it can't be read."""
+    version = get_bundle_version(path)
+    if version is None:
+        return None
+    try:
+        return open_bundle(path, version)
+    except (ValueError, OSError, KeyError) as e:
+        logger.warning("Ignoring knowledge bundle: %s", e)
+        return None
@@ -0,0 +1,130 @@
+import os
+import json
+import hashlib
+from utils.config import ENRICHED_CHUNKS_PATH, CHUNK_SECTIONS_PATH
+from utils.docx_blocks import load_docx_model
+
+# Text chunks are closed once they would grow past this many characters
+CHUNK_MAX_CHARS = 1500
+# Bump when the chunk layout changes, so cached sections are rebuilt
+CHUNKER_VERSION = 2
+
+
+def split_sections(blocks):
+    """
+    Splits the block list on state/section headings.
+
+    Returns:
+        list: Lists of block indices; each starts with its heading, except
+        the content before the first heading.
+    """
+    sections = [[]]
+    for i, block in enumerate(blocks):
+        if block["kind"] == "heading" and sections[-1]:
+            sections.append([])
+        sections[-1].append(i)
+    return [section for section in sections if section]
+
+
+def section_hash(section_blocks, image_files):
+    """Content hash of a section: its text, table placement and extracted image names."""
+    h = hashlib.sha1(f"chunker-{CHUNKER_VERSION}-{CHUNK_MAX_CHARS}".encode("utf-8"))
+    for block, files in zip(section_blocks, image_files):
+        h.update(json.dumps([block["kind"], block.get("text"), block["in_table"], files]).encode("utf-8"))
+    return h.hexdigest()
+
+
+def chunk_section(section_blocks, image_files):
+    """
+    Turns one section into chunks in the enriched_chunks.json layout.
+
+    Text is packed into chunks of up to CHUNK_MAX_CHARS. Every caption closes
+    the running text chunk and becomes its own chunk carrying the caption as
+    image label and the files of the images it describes, so it sits right
+    after the text it illustrates.
+
+    Args:
+        section_blocks (list): The section's text and image blocks, in order.
+        image_files (list): Per block, the image files captioned by it (empty for non-captions).
+    """
+    chunks = []
+    lines = []
+    size = 0
+
+    def flush():
+        nonlocal lines, size
+        if lines:
+            chunks.append({"chunk_text": "\n".join(lines), "image_labels": [], "image_files": []})
+        lines, size = [], 0
+
+    for block, files in zip(section_blocks, image_files):
+        if block["kind"] == "image":
+            continue
+        if block["kind"] == "caption":
+            flush()
+            chunks.append({"chunk_text": block["text"], "image_labels": [block["label"]], "image_files": files})
+            continue
+        if lines and size + len(block["text"]) + 1 > CHUNK_MAX_CHARS:
+            flush()
+        lines.append(block["text"])
+        size += len(block["text"]) + 1
+    flush()
+    return chunks
+
+
+def _load_section_cache(cache_path):
+    if os.path.exists(cache_path):
+        try:
+            with open(cache_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (json.JSONDecodeError, OSError):
+            return {}
+    return {}
+
+
+def _write_json(path, data):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=1)
+    os.replace(tmp_path, path)
+
+
+def build_chunks(docx_path, output_path=ENRICHED_CHUNKS_PATH, cache_path=CHUNK_SECTIONS_PATH):
+    """
+    Regenerates enriched_chunks.json from the DOCX.
+
+    Sections whose content hash is unchanged since the last build reuse their
+    cached chunks; only edited sections are re-chunked.
+
+    Returns:
+        dict: {"chunks": int, "sections": int, "rebuilt": int}
+    """
+    model = load_docx_model(docx_path)
+    blocks = model.blocks
+
+    # Caption block index -> files of the images it captions
+    captioned = {}
+    for image_index, caption_index in model.image_captions().items():
+        if caption_index is not None:
+            captioned.setdefault(caption_index, []).append(model.image_name(blocks[image_index]))
+
+    cache = _load_section_cache(cache_path)
+    new_cache = {}
+    chunks = []
+    rebuilt = 0
+    sections = split_sections(blocks)
+    for section in sections:
+        section_blocks = [blocks[i] for i in section]
+        image_files = [captioned.get(i, []) for i in section]
+        key = section_hash(section_blocks, image_files)
+        section_chunks = cache.get(key)
+        if section_chunks is None:
+            section_chunks = chunk_section(section_blocks, image_files)
+            rebuilt += 1
+        new_cache[key] = section_chunks
+        chunks.extend(section_chunks)
+
+    _write_json(output_path, chunks)
+    _write_json(cache_path, new_cache)
+    return {"chunks": len(chunks), "sections": len(sections), "rebuilt": rebuilt}
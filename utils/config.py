@@ -1,10 +1,23 @@
 import os
 import streamlit as st
 
+
+def get_secret(name, default=None):
+    """
+    A Streamlit secret, falling back to the environment variable of the same
+    name when there is no secrets file (headless runs such as batch_eval.py).
+    """
+    try:
+        return st.secrets[name]
+    except Exception:
+        return os.environ.get(name, default)
+
+
 # === Directories ===
 CACHE_DIR = "cache"
 STATE_DIR = "user_data"
 IMAGE_DIR = os.path.join(CACHE_DIR, "images")
+THUMBNAIL_DIR = os.path.join(CACHE_DIR, "thumbnails")
 
 # === File Paths ===
 PDF_CACHE_PATH = os.path.join(CACHE_DIR, "cached_sop.pdf")
@@ -12,11 +25,32 @@ DOCX_LOCAL_PATH = os.path.join(CACHE_DIR, "sop.docx")
 GDOC_STATE_PATH = os.path.join(CACHE_DIR, "gdoc_state.json")
 ENRICHED_CHUNKS_PATH = os.path.join(CACHE_DIR, "enriched_chunks.json")
 IMAGE_MAP_PATH = os.path.join(CACHE_DIR, "image_map.json")
+# Last map.json fetched from GitHub; kept apart so a fetch never overwrites a fresh sync
+GITHUB_MAP_CACHE_PATH = os.path.join(CACHE_DIR, "github_map.json")
+REPO_CHUNKS_PATH = "enriched_chunks.json"
+EMBEDDINGS_PATH = os.path.join(CACHE_DIR, "chunk_embeddings.npy")
+EMBEDDING_IDS_PATH = os.path.join(CACHE_DIR, "chunk_embedding_ids.json")
+CHUNK_SECTIONS_PATH = os.path.join(CACHE_DIR, "chunk_sections.json")
+BUNDLE_PATH = os.path.join(CACHE_DIR, "sop_knowledge.bundle")
+ASSISTANT_REGISTRY_PATH = os.path.join(CACHE_DIR, "assistant_registry.json")
+ASSET_MANIFEST_PATH = os.path.join(CACHE_DIR, "asset_manifest.json")
+STATE_DB_PATH = os.path.join(STATE_DIR, "state.db")
+
+# === Embeddings ===
+EMBEDDING_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+
+# === Image map ===
+# Captions that repeat across SOP sections are keyed "<section heading> › <caption>"
+IMAGE_SECTION_SEPARATOR = " › "
+# Longest side of the WebP thumbnails shown in chat
+THUMBNAIL_MAX_PX = 640
 
 # === GitHub ===
 GITHUB_REPO = "FadeevMax/SOP_sales_chatbot"
 GITHUB_PDF_NAME = "Live_GTI_SOP.pdf"
-GITHUB_TOKEN = st.secrets["GitHub_API"]
+GITHUB_DOCX_NAME = "Live_GTI_SOP.docx"
+GITHUB_BRANCH = "main"
+GITHUB_TOKEN = get_secret("GitHub_API")
 
 # === Google Docs ===
 GOOGLE_DOC_NAME = "GTI Data Base and SOP"
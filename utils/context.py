@@ -0,0 +1,83 @@
+# === Conversation context budget ===
+# Recent messages sent verbatim with every question
+CONTEXT_RECENT_MESSAGES = 6
+# Token budget for those recent messages; older ones are dropped first
+CONTEXT_HISTORY_TOKEN_BUDGET = 2000
+# Older turns are folded into the summary once this many have piled up
+SUMMARY_BATCH_MESSAGES = 4
+SUMMARY_MAX_TOKENS = 300
+# Cap on the text sent to one summarization call
+SUMMARY_INPUT_CHAR_LIMIT = 12000
+SUMMARY_MODEL = "gpt-4o-mini"
+
+SUMMARY_PROMPT = """You maintain the running memory of a conversation between a Sales Ops team member and an SOP assistant.
+Merge the existing memory with the new turns into a compact summary (at most {max_words} words).
+Keep: the states, order types and topics discussed, rules or numbers the assistant gave, and any open follow-ups.
+Drop greetings, formatting and repetition. Write plain bullet points."""
+
+MEMORY_BLOCK = """
+---
+# Conversation memory
+---
+Earlier in this conversation (summarized):
+{summary}
+"""
+
+
+def estimate_tokens(text):
+    """Rough token count (about 4 characters per token for English)."""
+    return len(text) // 4 + 1
+
+
+def new_memory():
+    """Empty conversation memory: the summary and how many messages it covers."""
+    return {"summary": "", "summarized_upto": 0}
+
+
+def recent_messages(messages, max_messages=CONTEXT_RECENT_MESSAGES, token_budget=CONTEXT_HISTORY_TOKEN_BUDGET):
+    """The newest messages that fit both the message count and the token budget, oldest first."""
+    selected = []
+    used = 0
+    for msg in reversed(messages[-max_messages:]):
+        cost = estimate_tokens(msg["content"])
+        if selected and used + cost > token_budget:
+            break
+        selected.append(msg)
+        used += cost
+    return list(reversed(selected))
+
+
+def memory_block(memory):
+    """Instructions addendum carrying the summary of older turns ("" when there is none)."""
+    if not memory or not memory.get("summary"):
+        return ""
+    return MEMORY_BLOCK.format(summary=memory["summary"])
+
+
+def update_memory(client, memory, messages, model=SUMMARY_MODEL):
+    """
+    Folds messages that have left the recent window into the rolling summary.
+
+    Runs a summarization call only once SUMMARY_BATCH_MESSAGES older messages
+    are pending, so most questions cost nothing extra. Updates memory in place.
+
+    Returns:
+        bool: True if the summary was updated.
+    """
+    older_end = max(0, len(messages) - CONTEXT_RECENT_MESSAGES)
+    pending = messages[memory["summarized_upto"]:older_end]
+    if len(pending) < SUMMARY_BATCH_MESSAGES:
+        return False
+
+    transcript = "\n\n".join(f"{m['role'].upper()}: {m['content']}" for m in pending)[-SUMMARY_INPUT_CHAR_LIMIT:]
+    response = client.chat.completions.create(
+        model=model,
+        max_tokens=SUMMARY_MAX_TOKENS,
+        messages=[
+            {"role": "system", "content": SUMMARY_PROMPT.format(max_words=SUMMARY_MAX_TOKENS * 3 // 4)},
+            {"role": "user", "content": f"Existing memory:\n{memory['summary'] or '(none)'}\n\nNew turns:\n{transcript}"},
+        ],
+    )
+    memory["summary"] = response.choices[0].message.content.strip()
+    memory["summarized_upto"] = older_end
+    return True
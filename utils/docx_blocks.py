@@ -0,0 +1,219 @@
+import re
+import zipfile
+import posixpath
+import unicodedata
+from functools import lru_cache
+from lxml import etree
+from utils.hashing import file_sha256
+from utils.facets import parse_heading
+
+W_NS = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
+A_NS = "http://schemas.openxmlformats.org/drawingml/2006/main"
+R_NS = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+PKG_REL_NS = "http://schemas.openxmlformats.org/package/2006/relationships"
+CT_NS = "http://schemas.openxmlformats.org/package/2006/content-types"
+OFFICE_DOCUMENT_REL = R_NS + "/officeDocument"
+IMAGE_REL = R_NS + "/image"
+
+W_P = f"{{{W_NS}}}p"
+W_TBL = f"{{{W_NS}}}tbl"
+W_TR = f"{{{W_NS}}}tr"
+W_TC = f"{{{W_NS}}}tc"
+W_R = f"{{{W_NS}}}r"
+W_T = f"{{{W_NS}}}t"
+W_TAB = f"{{{W_NS}}}tab"
+W_BR = f"{{{W_NS}}}br"
+W_CR = f"{{{W_NS}}}cr"
+W_HYPERLINK = f"{{{W_NS}}}hyperlink"
+W_DRAWING = f"{{{W_NS}}}drawing"
+A_BLIP = f"{{{A_NS}}}blip"
+R_EMBED = f"{{{R_NS}}}embed"
+
+caption_pattern = re.compile(r"^Image\s+(\d+):?\s*(.*)", re.IGNORECASE)
+
+
+def clean_caption(text):
+    cleaned = unicodedata.normalize('NFKC', text)
+    cleaned = re.sub(r"\s+", " ", cleaned).strip()
+    cleaned = cleaned.replace("–", "-").replace("—", "-").replace(""", '"').replace(""", '"')
+    cleaned = cleaned.replace("'", "'").replace("'", "'")
+    return cleaned
+
+
+def extract_label(text):
+    text = clean_caption(text)
+    m = caption_pattern.match(text)
+    if m:
+        idx = int(m.group(1))
+        desc = m.group(2).strip().rstrip(".")
+        return f"Image {idx}: {desc}" if desc else f"Image {idx}"
+    return None
+
+
+def _run_text(run):
+    # Same characters python-docx's Run.text produces for the common run content
+    parts = []
+    for el in run:
+        if el.tag == W_T:
+            parts.append(el.text or "")
+        elif el.tag == W_TAB:
+            parts.append("\t")
+        elif el.tag in (W_BR, W_CR):
+            parts.append("\n")
+    return "".join(parts)
+
+
+def _paragraph_runs(p):
+    for child in p:
+        if child.tag == W_R:
+            yield child
+        elif child.tag == W_HYPERLINK:
+            yield from (r for r in child if r.tag == W_R)
+
+
+class DocxModel:
+    """
+    Ordered block model of a DOCX body, built in one lxml pass over
+    word/document.xml without python-docx wrappers.
+
+    Each block is a dict with "kind" ("heading", "paragraph", "caption" or
+    "image"), "section" (the last state/section heading seen, e.g. "NJ RISE")
+    and "in_table". Text blocks carry "text"; captions also carry "label";
+    images carry "rel_id", "content_type", "part_name" and "number".
+    """
+
+    def __init__(self, docx_path, docx_hash=None):
+        self.path = docx_path
+        self.hash = docx_hash or file_sha256(docx_path)
+        with zipfile.ZipFile(docx_path) as z:
+            content_types = self._read_content_types(z)
+            self.document_part = self._find_document_part(z)
+            self.images = self._read_image_rels(z, content_types)
+            root = etree.fromstring(z.read(self.document_part))
+        body = root.find(f"{{{W_NS}}}body")
+        self.blocks = list(self._iter_blocks(body)) if body is not None else []
+        # Images are numbered in document order; the number names the extracted file
+        for number, block in enumerate((b for b in self.blocks if b["kind"] == "image"), start=1):
+            block["number"] = number
+
+    @staticmethod
+    def _read_content_types(z):
+        root = etree.fromstring(z.read("[Content_Types].xml"))
+        defaults = {el.get("Extension").lower(): el.get("ContentType") for el in root.iter(f"{{{CT_NS}}}Default")}
+        overrides = {el.get("PartName").lstrip("/"): el.get("ContentType") for el in root.iter(f"{{{CT_NS}}}Override")}
+        return defaults, overrides
+
+    @staticmethod
+    def _find_document_part(z):
+        root = etree.fromstring(z.read("_rels/.rels"))
+        for rel in root.iter(f"{{{PKG_REL_NS}}}Relationship"):
+            if rel.get("Type") == OFFICE_DOCUMENT_REL:
+                return rel.get("Target").lstrip("/")
+        return "word/document.xml"
+
+    def _read_image_rels(self, z, content_types):
+        defaults, overrides = content_types
+        part_dir = posixpath.dirname(self.document_part)
+        rels_path = posixpath.join(part_dir, "_rels", posixpath.basename(self.document_part) + ".rels")
+        images = {}
+        if rels_path not in z.namelist():
+            return images
+        for rel in etree.fromstring(z.read(rels_path)).iter(f"{{{PKG_REL_NS}}}Relationship"):
+            if rel.get("Type") != IMAGE_REL or rel.get("TargetMode") == "External":
+                continue
+            part_name = posixpath.normpath(posixpath.join(part_dir, rel.get("Target")))
+            ext = posixpath.splitext(part_name)[1].lstrip(".").lower()
+            content_type = overrides.get(part_name) or defaults.get(ext, f"image/{ext}")
+            images[rel.get("Id")] = {"part_name": part_name, "content_type": content_type}
+        return images
+
+    def _paragraph_blocks(self, p, section, in_table):
+        texts = []
+        images = []
+        for run in _paragraph_runs(p):
+            texts.append(_run_text(run))
+            for drawing in run.iter(W_DRAWING):
+                for blip in drawing.iter(A_BLIP):
+                    rel_id = blip.get(R_EMBED)
+                    if rel_id in self.images:
+                        images.append(dict(self.images[rel_id], kind="image", rel_id=rel_id,
+                                           section=section, in_table=in_table))
+        return images, "".join(texts).strip()
+
+    def _iter_blocks(self, body):
+        section = None
+        for child in body:
+            if child.tag == W_P:
+                images, text = self._paragraph_blocks(child, section, False)
+                yield from images
+                if text:
+                    if parse_heading(text):
+                        section = text
+                        yield {"kind": "heading", "text": text, "section": section, "in_table": False}
+                    else:
+                        yield self._text_block(text, section, False)
+            elif child.tag == W_TBL:
+                yield from self._table_blocks(child, section)
+
+    def _table_blocks(self, tbl, section):
+        # Walking w:tc directly visits each merged cell once, unlike
+        # python-docx's row.cells which repeats spanned cells
+        for tr in tbl.iterchildren(W_TR):
+            for tc in tr.iterchildren(W_TC):
+                for child in tc:
+                    if child.tag == W_P:
+                        images, text = self._paragraph_blocks(child, section, True)
+                        yield from images
+                        if text:
+                            yield self._text_block(text, section, True)
+                    elif child.tag == W_TBL:
+                        yield from self._table_blocks(child, section)
+
+    @staticmethod
+    def _text_block(text, section, in_table):
+        label = extract_label(text)
+        if label:
+            return {"kind": "caption", "text": text, "label": label, "section": section, "in_table": in_table}
+        return {"kind": "paragraph", "text": text, "section": section, "in_table": in_table}
+
+    def read_image(self, rel_id):
+        """Bytes of an embedded image."""
+        with zipfile.ZipFile(self.path) as z:
+            return z.read(self.images[rel_id]["part_name"])
+
+    def text_blocks(self):
+        return [b for b in self.blocks if b["kind"] != "image"]
+
+    @staticmethod
+    def image_name(block):
+        """File name the image is extracted to, e.g. "image_3.png"."""
+        extension = block["content_type"].split('/')[-1]
+        if extension == 'jpeg':
+            extension = 'jpg'
+        return f"image_{block['number']}.{extension}"
+
+    def image_captions(self):
+        """
+        Maps each image block's index to the index of its caption block (the
+        first caption within the next two blocks), or None if it has none.
+        """
+        captions = {}
+        for i, block in enumerate(self.blocks):
+            if block["kind"] != "image":
+                continue
+            captions[i] = None
+            for j in range(i + 1, min(i + 3, len(self.blocks))):
+                if self.blocks[j]["kind"] == "caption":
+                    captions[i] = j
+                    break
+        return captions
+
+
+@lru_cache(maxsize=4)
+def _load_model(docx_path, docx_hash):
+    return DocxModel(docx_path, docx_hash)
+
+
+def load_docx_model(docx_path):
+    """Returns the block model of a DOCX, parsed once per file content."""
+    return _load_model(docx_path, file_sha256(docx_path))
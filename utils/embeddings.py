@@ -0,0 +1,189 @@
+import os
+import json
+import hashlib
+from functools import lru_cache
+import numpy as np
+from utils.config import EMBEDDINGS_PATH, EMBEDDING_IDS_PATH, EMBEDDING_MODEL_NAME
+from utils.retrieval import load_chunks, get_chunks_version, get_chunks_path, is_bundle
+from utils.bundle import open_bundle
+
+# Rows scored per block, so a float16 matrix is never upcast in one piece
+SEARCH_BLOCK_ROWS = 8192
+
+
+def chunk_id(chunk):
+    """Stable id for a chunk, derived from its text."""
+    return hashlib.sha1(chunk.get("chunk_text", "").encode("utf-8")).hexdigest()[:16]
+
+
+@lru_cache(maxsize=1)
+def get_embedding_model(model_name=EMBEDDING_MODEL_NAME):
+    # Imported lazily: torch/sentence-transformers take seconds to import and
+    # query-time search only needs them to encode the question.
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(model_name)
+
+
+def embed_texts(texts, model_name=EMBEDDING_MODEL_NAME):
+    """Encodes a list of texts into L2-normalised float32 vectors."""
+    model = get_embedding_model(model_name)
+    vectors = model.encode(list(texts), batch_size=32, normalize_embeddings=True, convert_to_numpy=True)
+    return np.asarray(vectors, dtype=np.float32)
+
+
+def _load_existing_vectors(matrix_path, ids_path, dtype):
+    """{chunk id: vector} from the previous build, if it used the same model and dtype."""
+    if not (os.path.exists(matrix_path) and os.path.exists(ids_path)):
+        return {}
+    try:
+        with open(ids_path, "r") as f:
+            id_map = json.load(f)
+        if id_map.get("model") != EMBEDDING_MODEL_NAME or id_map.get("dtype") != dtype:
+            return {}
+        matrix = np.load(matrix_path)
+    except (OSError, ValueError, json.JSONDecodeError):
+        return {}
+    return {cid: matrix[row] for row, cid in enumerate(id_map["ids"]) if row < len(matrix)}
+
+
+def build_embedding_index(chunks=None, matrix_path=EMBEDDINGS_PATH, ids_path=EMBEDDING_IDS_PATH, dtype="float16"):
+    """
+    Embeds the chunks and saves the normalised matrix plus its id map.
+    Chunks whose text is unchanged since the last build keep their vectors,
+    so only new or edited chunks go through the model.
+
+    Args:
+        chunks (list, optional): Chunk dicts; defaults to the current enriched chunks.
+        matrix_path (str): Where to write the .npy matrix.
+        ids_path (str): Where to write the id map JSON.
+        dtype (str): "float16" (half the size) or "float32".
+
+    Returns:
+        int: Number of chunks that had to be embedded.
+    """
+    chunks = load_chunks() if chunks is None else chunks
+    if not chunks:
+        return 0
+
+    ids = [chunk_id(c) for c in chunks]
+    vectors = _load_existing_vectors(matrix_path, ids_path, dtype)
+    missing = [i for i, cid in enumerate(ids) if cid not in vectors]
+    if missing:
+        fresh = embed_texts([chunks[i].get("chunk_text", "") for i in missing]).astype(dtype)
+        vectors.update((ids[i], vector) for i, vector in zip(missing, fresh))
+    matrix = np.stack([vectors[cid] for cid in ids]).astype(dtype)
+    id_map = {
+        "model": EMBEDDING_MODEL_NAME,
+        "dtype": dtype,
+        "dim": int(matrix.shape[1]),
+        "ids": ids,
+    }
+
+    # Write next to the target and rename, so readers never mmap a half-written file
+    os.makedirs(os.path.dirname(matrix_path), exist_ok=True)
+    tmp_matrix = matrix_path + ".tmp"
+    with open(tmp_matrix, "wb") as f:
+        np.save(f, matrix)
+    tmp_ids = ids_path + ".tmp"
+    with open(tmp_ids, "w") as f:
+        json.dump(id_map, f)
+    os.replace(tmp_matrix, matrix_path)
+    os.replace(tmp_ids, ids_path)
+    return len(missing)
+
+
+class EmbeddingIndex:
+    """Memory-mapped chunk embeddings with blockwise dot-product search."""
+
+    def __init__(self, matrix, ids, model_name=EMBEDDING_MODEL_NAME):
+        self.matrix = matrix
+        self.ids = ids
+        self.model_name = model_name
+
+    def search_vectors(self, query_vectors, k=5, candidates=None):
+        """
+        Scores one or more query vectors against every chunk.
+
+        Args:
+            query_vectors (np.ndarray): Shape (dim,) or (n_queries, dim), L2-normalised.
+            k (int): Results per query.
+            candidates (set, optional): Chunk ids (row numbers) to restrict to.
+
+        Returns:
+            list: One list of (chunk_id, score) tuples per query, best first.
+        """
+        queries = np.atleast_2d(np.asarray(query_vectors, dtype=np.float32))
+        n_rows = self.matrix.shape[0]
+        scores = np.empty((n_rows, queries.shape[0]), dtype=np.float32)
+        for start in range(0, n_rows, SEARCH_BLOCK_ROWS):
+            block = np.asarray(self.matrix[start:start + SEARCH_BLOCK_ROWS], dtype=np.float32)
+            scores[start:start + len(block)] = block @ queries.T
+
+        if candidates is not None:
+            mask = np.full(n_rows, -np.inf, dtype=np.float32)
+            rows = [i for i in candidates if 0 <= i < n_rows]
+            mask[rows] = 0.0
+            scores += mask[:, None]
+
+        results = []
+        k = min(k, n_rows)
+        for col in range(scores.shape[1]):
+            column = scores[:, col]
+            top = np.argpartition(-column, k - 1)[:k] if k < n_rows else np.arange(n_rows)
+            top = top[np.argsort(-column[top])]
+            results.append([(int(i), float(column[i])) for i in top if np.isfinite(column[i])])
+        return results
+
+    def search(self, queries, k=5, candidates=None):
+        """Encodes one question (str) or a batch (list of str) and searches."""
+        single = isinstance(queries, str)
+        vectors = embed_texts([queries] if single else queries, self.model_name)
+        results = self.search_vectors(vectors, k=k, candidates=candidates)
+        return results[0] if single else results
+
+
+def _file_version(path):
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    return f"{stat.st_mtime_ns}-{stat.st_size}"
+
+
+@lru_cache(maxsize=2)
+def _open_index(matrix_path, ids_path, version, chunks_version):
+    with open(ids_path, "r") as f:
+        id_map = json.load(f)
+    # Never serve vectors that belong to a different version of the chunks
+    chunks = load_chunks()
+    if id_map["ids"] != [chunk_id(c) for c in chunks]:
+        return None
+    # mmap_mode="r" shares the pages between every process on the host
+    matrix = np.load(matrix_path, mmap_mode="r")
+    return EmbeddingIndex(matrix, id_map["ids"], id_map.get("model", EMBEDDING_MODEL_NAME))
+
+
+@lru_cache(maxsize=2)
+def _open_bundle_index(path, version):
+    embeddings = open_bundle(path, version).embeddings()
+    if embeddings is None:
+        return None
+    matrix, ids, model_name = embeddings
+    return EmbeddingIndex(matrix, ids, model_name or EMBEDDING_MODEL_NAME)
+
+
+def get_embedding_index(matrix_path=EMBEDDINGS_PATH, ids_path=EMBEDDING_IDS_PATH):
+    """
+    Returns the embedding index for the current chunks, or None if it is
+    missing or was built from a different version of the chunks.
+    """
+    chunks_path = get_chunks_path()
+    if is_bundle(chunks_path):
+        # The bundle's matrix was checked against its own chunks when it was built
+        index = _open_bundle_index(chunks_path, get_chunks_version(chunks_path))
+        if index is not None:
+            return index
+    matrix_version = _file_version(matrix_path)
+    ids_version = _file_version(ids_path)
+    if matrix_version is None or ids_version is None:
+        return None
+    return _open_index(matrix_path, ids_path, f"{matrix_version}/{ids_version}", get_chunks_version())
@@ -0,0 +1,170 @@
+import re
+
+# State abbreviation -> full name, as used in the SOP headings
+STATES = {
+    "OH": "OHIO",
+    "MD": "MARYLAND",
+    "NJ": "NEW JERSEY",
+    "IL": "ILLINOIS",
+    "NY": "NEW YORK",
+    "NV": "NEVADA",
+    "MA": "MASSACHUSETTS",
+}
+STATE_BY_NAME = {name: abbr for abbr, name in STATES.items()}
+
+RISE = "RISE"
+GENERAL = "GENERAL"
+# Sections such as "general info" or "account details" apply to both order types
+ALL_ORDER_TYPES = "ALL"
+
+# Text after the state in a heading -> order type of that section
+SECTION_ORDER_TYPES = {
+    "": ALL_ORDER_TYPES,
+    "rise": RISE,
+    "rise orders": RISE,
+    "regular orders": GENERAL,
+    "general info": ALL_ORDER_TYPES,
+    "account details": ALL_ORDER_TYPES,
+    "accounts": ALL_ORDER_TYPES,
+    "lingo": ALL_ORDER_TYPES,
+    "tips & tricks": ALL_ORDER_TYPES,
+    "onboarding notes": ALL_ORDER_TYPES,
+}
+
+_abbr = "|".join(STATES)
+_names = "|".join(STATES.values())
+abbr_heading_pattern = re.compile(rf"^(?:GTI\s+)?({_abbr})\b:?\s*(.*)$")
+name_heading_pattern = re.compile(rf"^({_names})\s+(.*)$", re.IGNORECASE)
+rise_heading_pattern = re.compile(rf"^RISE\s+({_abbr})$")
+
+# Question parsing
+query_name_pattern = re.compile(rf"\b({_names})\b", re.IGNORECASE)
+query_abbr_pattern = re.compile(rf"\b({_abbr})\b")
+# Lowercase abbreviations ("oh", "ma") are ordinary words, so only trust them
+# next to words that make the state reading obvious.
+query_lower_abbr_pattern = re.compile(
+    rf"(?:\b({_abbr.lower()})\b(?=[\s\-]+(?:rise|regular|general|orders?|stores?|accounts?)\b)"
+    rf"|\b(?:in|for)\s+({_abbr.lower()})\b)"
+)
+query_general_pattern = re.compile(r"\b(?:non[\s-]?rise|general|regular|wholesale)\b", re.IGNORECASE)
+query_rise_pattern = re.compile(r"\brise\b", re.IGNORECASE)
+
+
+def parse_heading(line):
+    """
+    Recognises SOP section headings such as "OH RISE", "GTI NJ general info"
+    or "OHIO REGULAR ORDERS".
+
+    Returns:
+        tuple: (state, order_type) or None if the line is not a heading.
+    """
+    line = line.strip()
+    if not line or len(line) > 40:
+        return None
+    m = rise_heading_pattern.match(line)
+    if m:
+        return m.group(1), RISE
+    m = abbr_heading_pattern.match(line)
+    if m:
+        state, rest = m.group(1), m.group(2)
+    else:
+        m = name_heading_pattern.match(line)
+        if not m:
+            return None
+        state, rest = STATE_BY_NAME[m.group(1).upper()], m.group(2)
+    order_type = SECTION_ORDER_TYPES.get(rest.strip().lower())
+    if order_type is None:
+        return None
+    return state, order_type
+
+
+def tag_chunks(chunks):
+    """
+    Tags every chunk with the states and order types of the sections it covers.
+
+    Chunks are in document order, so text before a chunk's first heading
+    belongs to the section the previous chunk ended in.
+
+    Returns:
+        list: One {"states": [...], "order_types": [...]} dict per chunk.
+    """
+    tags = []
+    current = None
+    for chunk in chunks:
+        states, order_types = set(), set()
+        lines = [line for line in chunk.get("chunk_text", "").splitlines() if line.strip()]
+        if current and not (lines and parse_heading(lines[0])):
+            states.add(current[0])
+            order_types.add(current[1])
+        for line in lines:
+            heading = parse_heading(line)
+            if heading:
+                current = heading
+                states.add(heading[0])
+                order_types.add(heading[1])
+        tags.append({"states": sorted(states), "order_types": sorted(order_types)})
+    return tags
+
+
+class FacetIndex:
+    """Inverted index from state / order type to chunk ids."""
+
+    def __init__(self, tags):
+        self.tags = tags
+        self.by_state = {}
+        self.by_order_type = {}
+        self.untagged = set()
+        for chunk_id, tag in enumerate(tags):
+            if not tag["states"]:
+                self.untagged.add(chunk_id)
+            for state in tag["states"]:
+                self.by_state.setdefault(state, set()).add(chunk_id)
+            for order_type in tag["order_types"]:
+                self.by_order_type.setdefault(order_type, set()).add(chunk_id)
+
+    def candidates(self, facets):
+        """
+        Chunk ids matching the parsed question facets, or None for "no filter".
+
+        Chunks before the first state heading apply everywhere and are always kept.
+        """
+        states = facets.get("states")
+        order_type = facets.get("order_type")
+        if not states and not order_type:
+            return None
+
+        selected = None
+        if states:
+            selected = set(self.untagged)
+            for state in states:
+                selected |= self.by_state.get(state, set())
+        if order_type:
+            typed = self.by_order_type.get(order_type, set()) | self.by_order_type.get(ALL_ORDER_TYPES, set()) | self.untagged
+            selected = typed if selected is None else selected & typed
+        return selected
+
+
+def build_facet_index(chunks):
+    return FacetIndex(tag_chunks(chunks))
+
+
+def parse_query_facets(question):
+    """
+    Pulls the state(s) and order type out of a question.
+
+    Returns:
+        dict: {"states": set of abbreviations, "order_type": "RISE", "GENERAL" or None}
+    """
+    states = {STATE_BY_NAME[m.upper()] for m in query_name_pattern.findall(question)}
+    states.update(query_abbr_pattern.findall(question))
+    for groups in query_lower_abbr_pattern.findall(question):
+        states.update(g.upper() for g in groups if g)
+
+    is_general = bool(query_general_pattern.search(question))
+    is_rise = bool(query_rise_pattern.search(query_general_pattern.sub(" ", question)))
+    order_type = None
+    if is_rise and not is_general:
+        order_type = RISE
+    elif is_general and not is_rise:
+        order_type = GENERAL
+    return {"states": states, "order_type": order_type}
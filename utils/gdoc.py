@@ -3,6 +3,7 @@ from openai import OpenAI
 import time
 import os
 import uuid
+import threading
 from datetime import datetime, timedelta
 import json
 from streamlit_local_storage import LocalStorage
@@ -10,117 +11,74 @@ import difflib
 # Imports for Google Docs API
 from google.oauth2.service_account import Credentials
 from googleapiclient.discovery import build
+from googleapiclient.http import MediaIoBaseDownload
+from googleapiclient.errors import HttpError
+import google_auth_httplib2
+import httplib2
+from concurrent.futures import ThreadPoolExecutor
 import io # Needed for handling the in-memory file download
 import requests
 import base64
 import unicodedata
-from utils.config import GDOC_STATE_PATH, GOOGLE_DOC_NAME, CACHE_DIR, PDF_CACHE_PATH, DOCX_LOCAL_PATH, IMAGE_DIR, IMAGE_MAP_PATH, ENRICHED_CHUNKS_PATH, GITHUB_REPO, GITHUB_TOKEN
+from utils.config import GDOC_STATE_PATH, GOOGLE_DOC_NAME, CACHE_DIR, PDF_CACHE_PATH, DOCX_LOCAL_PATH, IMAGE_DIR, IMAGE_MAP_PATH, ENRICHED_CHUNKS_PATH, GITHUB_REPO, GITHUB_TOKEN, IMAGE_SECTION_SEPARATOR, THUMBNAIL_DIR, THUMBNAIL_MAX_PX, GITHUB_PDF_NAME, GITHUB_DOCX_NAME
 import re
-from docx import Document
-from docx.oxml.table import CT_Tbl
-from docx.oxml.text.paragraph import CT_P
-from docx.table import Table
-from docx.text.paragraph import Paragraph
-from docx.oxml.ns import qn
-from utils.github import update_pdf_on_github, update_docx_on_github, update_json_on_github, upload_file_to_github
-
-caption_pattern = re.compile(r"^Image\s+(\d+):?\s*(.*)", re.IGNORECASE)
-
-def clean_caption(text):
-    cleaned = unicodedata.normalize('NFKC', text)
-    cleaned = re.sub(r"\s+", " ", cleaned).strip()
-    cleaned = cleaned.replace("–", "-").replace("—", "-").replace(""", '"').replace(""", '"')
-    cleaned = cleaned.replace("'", "'").replace("'", "'")
-    return cleaned
-
-def extract_label(text):
-    text = clean_caption(text)
-    m = caption_pattern.match(text)
-    if m:
-        idx = int(m.group(1))
-        desc = m.group(2).strip().rstrip(".")
-        return f"Image {idx}: {desc}" if desc else f"Image {idx}"
-    return None
+from PIL import Image
+from utils.github import update_pdf_on_github, update_docx_on_github, update_json_on_github, upload_file_to_github, sync_assets_to_github
+from utils.embeddings import build_embedding_index
+from utils.chunking import build_chunks
+from utils.bundle import build_bundle
+from utils.docx_blocks import load_docx_model, clean_caption, extract_label
+from utils.log import logger
+
+def make_thumbnail(image_path, thumbnail_dir=THUMBNAIL_DIR, max_px=THUMBNAIL_MAX_PX):
+    """Writes a resized WebP copy of an image. Returns its path, or None if Pillow can't read the image."""
+    os.makedirs(thumbnail_dir, exist_ok=True)
+    stem = os.path.splitext(os.path.basename(image_path))[0]
+    thumbnail_path = os.path.join(thumbnail_dir, f"{stem}.webp")
+    try:
+        with Image.open(image_path) as img:
+            img.thumbnail((max_px, max_px))
+            if img.mode not in ("RGB", "RGBA"):
+                img = img.convert("RGBA")
+            img.save(thumbnail_path, "WEBP", quality=80, method=4)
+        return thumbnail_path
+    except Exception as e:
+        logger.warning("Could not create thumbnail for %s: %s", image_path, e)
+        return None
 
 def extract_images_and_labels_from_docx(docx_path, image_output_dir, mapping_output_path, debug=False):
     """Extract images and their labels from a DOCX file"""
     os.makedirs(image_output_dir, exist_ok=True)
-    doc = Document(docx_path)
+    model = load_docx_model(docx_path)
     image_map = {}
-    items = []
-    
-    # Collect all blocks in order
-    body = doc.element.body
-    for child in body.iterchildren():
-        if isinstance(child, CT_P):
-            para = Paragraph(child, doc)
-            # Check for images in paragraph
-            has_image = False
-            for run in para.runs:
-                if 'graphic' in run._element.xml:
-                    for drawing in run._element.findall(".//w:drawing", namespaces=run._element.nsmap):
-                        for blip in drawing.findall(".//a:blip", namespaces=run._element.nsmap):
-                            rel_id = blip.get(qn('r:embed'))
-                            if rel_id and rel_id in doc.part.related_parts:
-                                image_part = doc.part.related_parts[rel_id]
-                                items.append(('image', image_part))
-                                has_image = True
-            
-            # Add text if it exists
-            if para.text.strip():
-                items.append(('text', para.text.strip()))
-                
-        elif isinstance(child, CT_Tbl):
-            table = Table(child, doc)
-            for row in table.rows:
-                for cell in row.cells:
-                    for para in cell.paragraphs:
-                        # Check for images in table cells
-                        for run in para.runs:
-                            if 'graphic' in run._element.xml:
-                                for drawing in run._element.findall(".//w:drawing", namespaces=run._element.nsmap):
-                                    for blip in drawing.findall(".//a:blip", namespaces=run._element.nsmap):
-                                        rel_id = blip.get(qn('r:embed'))
-                                        if rel_id and rel_id in doc.part.related_parts:
-                                            image_part = doc.part.related_parts[rel_id]
-                                            items.append(('image', image_part))
-                        
-                        if para.text.strip():
-                            items.append(('text', para.text.strip()))
+    blocks = model.blocks
 
     # Associate images with their following captions
-    image_counter = 1
-    i = 0
-    while i < len(items):
-        if items[i][0] == 'image':
-            image_part = items[i][1]
-            
-            # Look for the next text that might be a caption
-            label = None
-            for j in range(i + 1, min(i + 3, len(items))):  # Look ahead up to 2 items
-                if items[j][0] == 'text':
-                    potential_label = extract_label(items[j][1])
-                    if potential_label:
-                        label = potential_label
-                        break
-            
-            if not label:
-                label = f"Image {image_counter}"
-            
-            # Save image file
-            image_extension = image_part.content_type.split('/')[-1]
-            if image_extension == 'jpeg':
-                image_extension = 'jpg'
-            image_name = f"image_{image_counter}.{image_extension}"
-            image_path = os.path.join(image_output_dir, image_name)
-            
-            with open(image_path, "wb") as f:
-                f.write(image_part.blob)
-            
-            image_map[label] = image_name
-            image_counter += 1
-            
-        i += 1
+    extracted = []
+    for i, caption_index in model.image_captions().items():
+        block = blocks[i]
+        label = blocks[caption_index]["label"] if caption_index is not None else f"Image {block['number']}"
+
+        # Save image file
+        image_name = model.image_name(block)
+        image_path = os.path.join(image_output_dir, image_name)
+
+        with open(image_path, "wb") as f:
+            f.write(model.read_image(block["rel_id"]))
+        make_thumbnail(image_path)
+
+        extracted.append((label, block["section"], image_name))
+
+    # Captions repeat across state sections ("Image 1: . Menu form"), so
+    # qualify those with their section instead of letting them collide
+    label_counts = {}
+    for label, _, _ in extracted:
+        label_counts[label] = label_counts.get(label, 0) + 1
+    for label, image_section, image_name in extracted:
+        key = label
+        if label_counts[label] > 1 and image_section:
+            key = f"{image_section}{IMAGE_SECTION_SEPARATOR}{label}"
+        image_map.setdefault(key, image_name)
 
     # Save mapping
     with open(mapping_output_path, "w") as f:
@@ -133,57 +91,82 @@ def extract_images_and_labels_from_docx(docx_path, image_output_dir, mapping_out
     
     return image_map
 
-def force_resync_to_github():
+def get_sync_assets():
+    """Local files published to GitHub by a sync, as (local path, repo path) pairs."""
+    assets = []
+    if os.path.exists(IMAGE_MAP_PATH):
+        assets.append((IMAGE_MAP_PATH, "map.json"))
+    if os.path.isdir(IMAGE_DIR):
+        for file in sorted(os.listdir(IMAGE_DIR)):
+            assets.append((os.path.join(IMAGE_DIR, file), f"images/{file}"))
+    for local_path, repo_path in (
+        (DOCX_LOCAL_PATH, GITHUB_DOCX_NAME),
+        (PDF_CACHE_PATH, GITHUB_PDF_NAME),
+        (ENRICHED_CHUNKS_PATH, "enriched_chunks.json"),
+    ):
+        if os.path.exists(local_path):
+            assets.append((local_path, repo_path))
+    return assets
+
+def _st_notify(level, message):
+    getattr(st, level)(message)
+
+# A sync and a re-sync rewrite the same cache files and GitHub assets, so only one runs at a time
+_sync_lock = threading.Lock()
+
+def force_resync_to_github(notify=_st_notify):
     """
     Forces the re-processing of the local DOCX file and syncs all assets to GitHub.
     This skips the Google Doc check and works with the current local DOCX.
+
+    Args:
+        notify (callable): notify(level, message), as for sync_gdoc_to_github.
     """
     if not os.path.exists(DOCX_LOCAL_PATH):
-        st.error("Cannot re-sync: The local DOCX file does not exist.")
+        notify("error", "Cannot re-sync: The local DOCX file does not exist.")
         return False
 
-    try:
-        # Step 1: Re-extract images and create map.json from the local DOCX
-        st.write("Extracting images and labels from local DOCX...")
-        extract_images_and_labels_from_docx(DOCX_LOCAL_PATH, IMAGE_DIR, IMAGE_MAP_PATH, debug=True)
-        st.write("✅ Image extraction complete.")
-
-        # Step 2: Upload map.json to GitHub
-        st.write("Uploading map.json to GitHub...")
-        update_json_on_github(
-            local_json_path=IMAGE_MAP_PATH,
-            repo_json_path="map.json",
-            commit_message="Manual Re-sync: Update map.json",
-            github_repo=GITHUB_REPO,
-            github_token=GITHUB_TOKEN
-        )
-        st.write("✅ map.json uploaded.")
-
-        # Step 3: Upload all images from the local image directory
-        st.write("Uploading images to GitHub...")
-        for file in os.listdir(IMAGE_DIR):
-            local_path = os.path.join(IMAGE_DIR, file)
-            github_path = f"images/{file}"
-            upload_file_to_github(
-                local_path=local_path,
-                github_path=github_path,
-                commit_message=f"Manual Re-sync: Update {file}"
-            )
-        st.write("✅ Images uploaded.")
-
-        # Step 4: Upload the DOCX and PDF files
-        st.write("Uploading DOCX and PDF to GitHub...")
-        update_docx_on_github(DOCX_LOCAL_PATH)
-        if os.path.exists(PDF_CACHE_PATH):
-             update_pdf_on_github(PDF_CACHE_PATH)
-        st.write("✅ Document files uploaded.")
-
-        return True
+    with _sync_lock:
+        try:
+            # Step 1: Re-extract images and create map.json from the local DOCX
+            notify("info", "Extracting images and labels from local DOCX...")
+            extract_images_and_labels_from_docx(DOCX_LOCAL_PATH, IMAGE_DIR, IMAGE_MAP_PATH, debug=True)
+            notify("info", "✅ Image extraction complete.")
+
+            # Step 1b: Re-chunk the DOCX on its section headings
+            stats = build_chunks(DOCX_LOCAL_PATH)
+            notify("info", f"✅ {stats['chunks']} chunks from {stats['sections']} sections ({stats['rebuilt']} sections changed).")
+
+            # Step 1c: Re-embed the new or edited SOP chunks for semantic search
+            notify("info", "Embedding SOP chunks...")
+            try:
+                n_embedded = build_embedding_index()
+                notify("info", f"✅ Embedded {n_embedded} new or changed chunks.")
+            except Exception as e:
+                notify("warning", f"Could not build the chunk embedding index: {e}")
+
+            # Step 1d: Pack everything the app reads at runtime into the knowledge bundle
+            try:
+                build_bundle(revision=get_last_gdoc_synced_time())
+                notify("info", "✅ Knowledge bundle rebuilt.")
+            except Exception as e:
+                notify("warning", f"Could not build the knowledge bundle: {e}")
+
+            # Step 2: Publish map.json, images, DOCX and PDF in one commit - only the files that changed
+            notify("info", "Uploading changed files to GitHub...")
+            result = sync_assets_to_github(get_sync_assets(), "Manual Re-sync: Update SOP assets")
+            notify("info", f"✅ {len(result['uploaded'])} files uploaded, {result['skipped']} unchanged.")
+            if result["failed"]:
+                notify("error", f"❌ Failed to upload: {', '.join(result['failed'])}")
+                return False
+
+            notify("success", "Local files re-synced to GitHub!")
+            return True
+
+        except Exception as e:
+            notify("error", f"An error occurred during the re-sync process: {e}")
+            return False
 
-    except Exception as e:
-        st.error(f"An error occurred during the re-sync process: {e}")
-        return False
-        
 def get_creds():
     """Get credentials from Streamlit secrets or local JSON file."""
     try:
@@ -199,31 +182,98 @@ def get_creds():
             st.error("GCP service account credentials not found.")
             st.stop()
 
-def download_gdoc_as_docx(doc_id, creds, out_path):
-   drive_service = build('drive', 'v3', credentials=creds)
-   request = drive_service.files().export_media(fileId=doc_id, mimeType='application/vnd.openxmlformats-officedocument.wordprocessingml.document')
-   os.makedirs(os.path.dirname(out_path), exist_ok=True)
-   with open(out_path, "wb") as f:
-     f.write(request.execute())
-   return True
+PDF_MIME_TYPE = 'application/pdf'
+DOCX_MIME_TYPE = 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
+# Exports are streamed to disk in chunks of this size
+DRIVE_CHUNK_SIZE = 4 * 1024 * 1024
+DRIVE_NUM_RETRIES = 3
 
-def download_gdoc_as_pdf(doc_id, creds, out_path):
-    drive_service = build('drive', 'v3', credentials=creds)
-    request = drive_service.files().export_media(fileId=doc_id, mimeType='application/pdf')
+def get_drive_service(creds):
+    return build('drive', 'v3', credentials=creds, cache_discovery=False)
+
+def export_gdoc(drive_service, creds, doc_id, mime_type, out_path):
+    """
+    Streams a Google Doc export to out_path in DRIVE_CHUNK_SIZE pieces.
+
+    The file is written next to out_path and renamed into place, so readers
+    never see a half-written PDF/DOCX. Each call gets its own authorized
+    HTTP connection (httplib2 is not thread-safe), so exports can run in parallel.
+    """
     os.makedirs(os.path.dirname(out_path), exist_ok=True)
-    with open(out_path, "wb") as f:
-        f.write(request.execute())
+    request = drive_service.files().export_media(fileId=doc_id, mimeType=mime_type)
+    request.http = google_auth_httplib2.AuthorizedHttp(creds, http=httplib2.Http())
+    tmp_path = out_path + ".part"
+    try:
+        with open(tmp_path, "wb") as f:
+            downloader = MediaIoBaseDownload(f, request, chunksize=DRIVE_CHUNK_SIZE)
+            done = False
+            while not done:
+                _, done = downloader.next_chunk(num_retries=DRIVE_NUM_RETRIES)
+        os.replace(tmp_path, out_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
     return True
 
-def get_gdoc_last_modified(creds, doc_name):
-    drive_service = build('drive', 'v3', credentials=creds)
-    query = f"name='{doc_name}' and mimeType='application/vnd.google-apps.document'"
+def export_gdoc_files(doc_id, creds, exports, drive_service=None):
+    """
+    Runs several exports of one Google Doc concurrently over a single Drive service.
+
+    Args:
+        exports (dict): MIME type -> output path.
+
+    Returns:
+        dict: Output path -> True, or the exception that export raised.
+    """
+    drive_service = drive_service or get_drive_service(creds)
+
+    def run(item):
+        mime_type, out_path = item
+        try:
+            return export_gdoc(drive_service, creds, doc_id, mime_type, out_path)
+        except Exception as e:
+            logger.error("Export to %s failed: %s", out_path, e)
+            return e
+
+    with ThreadPoolExecutor(max_workers=len(exports)) as executor:
+        results = list(executor.map(run, exports.items()))
+    return dict(zip(exports.values(), results))
+
+def download_gdoc_as_docx(doc_id, creds, out_path):
+    return export_gdoc(get_drive_service(creds), creds, doc_id, DOCX_MIME_TYPE, out_path)
+
+def download_gdoc_as_pdf(doc_id, creds, out_path):
+    return export_gdoc(get_drive_service(creds), creds, doc_id, PDF_MIME_TYPE, out_path)
+
+def get_gdoc_last_modified(creds, doc_name, drive_service=None):
+    """
+    Returns (doc_id, modified_time) of the Google Doc.
+
+    The doc id is cached in the sync state, so the usual check is a single
+    files().get of the modifiedTime field; the name search only runs the
+    first time or after the cached document disappears.
+    """
+    drive_service = drive_service or get_drive_service(creds)
+    state = load_gdoc_state()
+    doc_id = state.get("doc_id") if state.get("doc_name") == doc_name else None
+    if doc_id:
+        try:
+            meta = drive_service.files().get(fileId=doc_id, fields="id, modifiedTime, trashed").execute()
+            if not meta.get("trashed"):
+                return doc_id, meta["modifiedTime"]
+        except HttpError as e:
+            if e.resp.status != 404:
+                raise
+        logger.warning("Cached Google Doc id %s is gone, searching by name again.", doc_id)
+
+    query = f"name='{doc_name}' and mimeType='application/vnd.google-apps.document' and trashed=false"
     results = drive_service.files().list(q=query, fields="files(id, modifiedTime)").execute()
     files = results.get('files', [])
     if not files:
         return None, None
     doc_id = files[0]['id']
     modified_time = files[0]['modifiedTime']
+    save_gdoc_state(doc_id=doc_id, doc_name=doc_name)
     return doc_id, modified_time
 
 def get_live_sop_pdf_path(doc_name: str) -> str:
@@ -235,36 +285,16 @@ def get_live_sop_pdf_path(doc_name: str) -> str:
     try:
         st.info("Checking for SOP updates from Google Docs...")
 
-        # Create cache directory if it doesn't exist
-        if not os.path.exists(CACHE_DIR):
-            os.makedirs(CACHE_DIR)
-
         creds = get_creds()
-        drive_service = build('drive', 'v3', credentials=creds)
-
-        query = f"name='{doc_name}' and mimeType='application/vnd.google-apps.document'"
-        response = drive_service.files().list(q=query, spaces='drive', fields='files(id, name)').execute()
-        files = response.get('files', [])
-
-        if not files:
+        drive_service = get_drive_service(creds)
+        doc_id, _ = get_gdoc_last_modified(creds, doc_name, drive_service)
+        if not doc_id:
             st.error(f"No Google Doc found with the name: '{doc_name}'.")
             return None
 
-        doc_id = files[0]['id']
-
-        # Export the document as PDF
-        request = drive_service.files().export_media(fileId=doc_id, mimeType='application/pdf')
-
-        # Download the file content into an in-memory buffer
-        fh = io.BytesIO()
-        downloader = io.BytesIO(request.execute())
-
-        # Define the path for the cached file
+        # Stream the PDF export straight into the cache
         cached_file_path = os.path.join(CACHE_DIR, "cached_sop.pdf")
-
-        # Write the downloaded content to the cached file
-        with open(cached_file_path, "wb") as f:
-            f.write(downloader.getbuffer())
+        export_gdoc(drive_service, creds, doc_id, PDF_MIME_TYPE, cached_file_path)
 
         st.success(f"✅ SOP updated successfully from Google Docs!")
         return cached_file_path
@@ -274,96 +304,101 @@ def get_live_sop_pdf_path(doc_name: str) -> str:
         return None
 
 
-def get_last_gdoc_synced_time():
+def load_gdoc_state():
+    """Sync state: last synced modifiedTime, plus the cached doc id and name."""
     if os.path.exists(GDOC_STATE_PATH):
-        with open(GDOC_STATE_PATH, "r") as f:
-            state = json.load(f)
-            return state.get("last_synced_modified_time")
-    return None
+        try:
+            with open(GDOC_STATE_PATH, "r") as f:
+                return json.load(f)
+        except (json.JSONDecodeError, OSError):
+            return {}
+    return {}
+
+def save_gdoc_state(**updates):
+    state = load_gdoc_state()
+    state.update(updates)
+    os.makedirs(os.path.dirname(GDOC_STATE_PATH) or ".", exist_ok=True)
+    tmp_path = GDOC_STATE_PATH + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, GDOC_STATE_PATH)
+
+def get_last_gdoc_synced_time():
+    return load_gdoc_state().get("last_synced_modified_time")
 
 def set_last_gdoc_synced_time(modified_time):
-    with open(GDOC_STATE_PATH, "w") as f:
-        json.dump({"last_synced_modified_time": modified_time}, f)
+    save_gdoc_state(last_synced_modified_time=modified_time)
 
-def sync_gdoc_to_github(force=False):
-    # Only check if a day has passed or force=True
+def sync_gdoc_to_github(force=False, notify=_st_notify):
+    """
+    Pulls the Google Doc and republishes its assets when it changed since
+    the last sync (or when forced).
+
+    Args:
+        force (bool): Sync even if the modifiedTime is unchanged.
+        notify (callable): notify(level, message) with level one of
+            "info", "success", "warning", "error". Defaults to st.* calls;
+            the background sync worker passes its own.
+    """
+    with _sync_lock:
+        return _sync_gdoc_to_github(force, notify)
+
+def _sync_gdoc_to_github(force, notify):
     last_synced = get_last_gdoc_synced_time()
-    now = datetime.utcnow()
-    last_checked_dt = datetime.fromisoformat(last_synced) if last_synced else None
 
     # Google API Auth
     creds = get_creds()
-    doc_id, modified_time = get_gdoc_last_modified(creds, GOOGLE_DOC_NAME)
+    drive_service = get_drive_service(creds)
+    doc_id, modified_time = get_gdoc_last_modified(creds, GOOGLE_DOC_NAME, drive_service)
     if not doc_id or not modified_time:
-        st.warning("Google Doc not found or can't fetch modified time.")
+        notify("warning", "Google Doc not found or can't fetch modified time.")
         return False
 
-    # Only update if new or forced or more than 1 day has passed
-    need_update = (
-        force or 
-        not last_synced or 
-        (now - last_checked_dt > timedelta(days=1)) or
-        (modified_time != last_synced)
-    )
+    # Only update if new or forced
+    need_update = force or not last_synced or modified_time != last_synced
     if not need_update:
-        st.info("No update needed. Using existing GitHub PDF.")
+        notify("info", "No update needed. Using existing GitHub PDF.")
         return True
 
-    # Download latest Google Doc as PDF and DOCX
-    pdf_success = download_gdoc_as_pdf(doc_id, creds, PDF_CACHE_PATH)
-    docx_success = download_gdoc_as_docx(doc_id, creds, DOCX_LOCAL_PATH)
+    # Download latest Google Doc as PDF and DOCX, both exports at once
+    results = export_gdoc_files(doc_id, creds, {
+        PDF_MIME_TYPE: PDF_CACHE_PATH,
+        DOCX_MIME_TYPE: DOCX_LOCAL_PATH,
+    }, drive_service)
 
-    if not (pdf_success and docx_success):
-       st.error("Failed to download Google Doc as PDF or DOCX.")
+    if not all(result is True for result in results.values()):
+       notify("error", "Failed to download Google Doc as PDF or DOCX.")
        return False
 
     # Extract labeled images from DOCX
     extract_images_and_labels_from_docx(DOCX_LOCAL_PATH, IMAGE_DIR, IMAGE_MAP_PATH, debug=True)
 
-    # Update map.json on GitHub
-    success = update_json_on_github(
-       IMAGE_MAP_PATH,
-       "map.json",
-       "Update map.json from SOP DOCX",
-       GITHUB_REPO,
-       GITHUB_TOKEN
-   )
-    if not success:
-       st.error("❌ Failed to update map.json on GitHub!")
-
-    # Upload images to GitHub
-    for file in os.listdir(IMAGE_DIR):
-       local_path = os.path.join(IMAGE_DIR, file)
-       github_path = f"images/{file}"
-       upload_file_to_github(
-          local_path,
-          github_path,
-          f"Update {file} from SOP DOCX"
-          )
-
-    # Upload PDF and DOCX to GitHub
-    pdf_uploaded = update_pdf_on_github(PDF_CACHE_PATH)
-    docx_uploaded = update_docx_on_github(DOCX_LOCAL_PATH)
-    # Upload enriched_chunks.json if it exists
-    if os.path.exists(ENRICHED_CHUNKS_PATH):
-        upload_file_to_github(
-            local_path=ENRICHED_CHUNKS_PATH,
-            github_path="enriched_chunks.json",
-            commit_message="Update enriched chunks"
-        )
-    else:
-        st.warning(f"enriched_chunks.json not found at {ENRICHED_CHUNKS_PATH}, skipping upload.")
-
-    if pdf_uploaded and docx_uploaded:
-        st.success("PDF and DOCX updated on GitHub with the latest from Google Doc!")
-        set_last_gdoc_synced_time(modified_time)
-        return True
-    elif pdf_uploaded:
-        st.error("PDF uploaded, but failed to update DOCX on GitHub.")
-        return False
-    elif docx_uploaded:
-        st.error("DOCX uploaded, but failed to update PDF on GitHub.")
-        return False
-    else:
-        st.error("Failed to update both PDF and DOCX on GitHub.")
+    # Rebuild enriched_chunks.json; only sections edited since the last sync are re-chunked
+    stats = build_chunks(DOCX_LOCAL_PATH)
+    notify("info", f"{stats['chunks']} chunks from {stats['sections']} sections ({stats['rebuilt']} sections changed).")
+
+    # Embed the new or edited chunks so query-time semantic search only has to mmap the matrix
+    try:
+        build_embedding_index()
+    except Exception as e:
+        notify("warning", f"Could not build the chunk embedding index: {e}")
+
+    # Pack chunks, facets, image map, embeddings and thumbnails for fast, shared startup
+    try:
+        build_bundle(revision=modified_time)
+    except Exception as e:
+        notify("warning", f"Could not build the knowledge bundle: {e}")
+
+    # Publish map.json, images, PDF and DOCX in one commit - only the files whose contents changed
+    result = sync_assets_to_github(get_sync_assets(), "Update SOP assets from Google Doc")
+    if result["failed"]:
+        notify("error", f"❌ Failed to update on GitHub: {', '.join(result['failed'])}")
         return False
+
+    notify(
+        "success",
+        f"GitHub updated with the latest from Google Doc! "
+        f"{len(result['uploaded'])} files changed, {result['skipped']} unchanged."
+    )
+    set_last_gdoc_synced_time(modified_time)
+    return True
@@ -2,6 +2,7 @@ import streamlit as st
 from openai import OpenAI
 import time
 import os
+import threading
 import uuid
 from datetime import datetime
 import json
@@ -12,7 +13,11 @@ from google.oauth2.service_account import Credentials
 from googleapiclient.discovery import build
 import io # Needed for handling the in-memory file download
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
 import base64
+import hashlib
 import unicodedata
 from utils.config import (
     CACHE_DIR,
@@ -26,60 +31,134 @@ from utils.config import (
     DOCX_LOCAL_PATH,
     IMAGE_DIR,
     IMAGE_MAP_PATH,
+    GITHUB_MAP_CACHE_PATH,
     ENRICHED_CHUNKS_PATH,
+    BUNDLE_PATH,
+    ASSET_MANIFEST_PATH,
+    GITHUB_DOCX_NAME,
+    GITHUB_BRANCH,
 )
+from utils.bundle import get_bundle
+from utils.log import logger
+
+# === GitHub client ===
+GITHUB_API_URL = "https://api.github.com"
+# (connect, read) seconds; uploads of the PDF/DOCX need the longer read timeout
+GITHUB_TIMEOUT_SECONDS = (5, 60)
+GITHUB_MAX_WORKERS = 8
+# Transient 5xx errors are retried inside the connection pool
+GITHUB_RETRIES = 3
+# 403/429 rate-limit responses are waited out at most this many times, this long each
+GITHUB_RATE_LIMIT_RETRIES = 3
+GITHUB_RATE_LIMIT_MAX_WAIT = 60
+
+
+class GitHubClient:
+    """
+    GitHub REST client for one repo: a pooled requests.Session with retries,
+    timeouts and rate-limit backoff, plus a bounded thread pool for bulk calls.
+    """
+
+    def __init__(self, repo=GITHUB_REPO, token=GITHUB_TOKEN, max_workers=GITHUB_MAX_WORKERS,
+                 timeout=GITHUB_TIMEOUT_SECONDS):
+        self.repo = repo
+        self.max_workers = max_workers
+        self.timeout = timeout
+        retry = Retry(
+            total=GITHUB_RETRIES,
+            backoff_factor=0.5,
+            status_forcelist=(500, 502, 503, 504),
+            allowed_methods=None,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.headers.update({
+            "Authorization": f"token {token}",
+            "Accept": "application/vnd.github+json",
+        })
+
+    def _rate_limit_wait(self, resp, attempt):
+        """Seconds to wait before retrying a 403/429, or None if it isn't a rate limit."""
+        retry_after = resp.headers.get("Retry-After")
+        if retry_after:
+            return min(float(retry_after), GITHUB_RATE_LIMIT_MAX_WAIT)
+        if resp.headers.get("X-RateLimit-Remaining") == "0":
+            reset = int(resp.headers.get("X-RateLimit-Reset", time.time() + 1))
+            return min(max(reset - time.time(), 1), GITHUB_RATE_LIMIT_MAX_WAIT)
+        if resp.status_code == 429:
+            return min(2 ** attempt, GITHUB_RATE_LIMIT_MAX_WAIT)
+        # A plain 403 is a permissions problem, retrying won't help
+        return None
+
+    def request(self, method, path, **kwargs):
+        """
+        Sends a request to /repos/{repo}/{path} (or to path itself if it is a full URL).
+        """
+        url = path if path.startswith("https://") else f"{GITHUB_API_URL}/repos/{self.repo}/{path}"
+        kwargs.setdefault("timeout", self.timeout)
+        for attempt in range(GITHUB_RATE_LIMIT_RETRIES + 1):
+            resp = self.session.request(method, url, **kwargs)
+            if resp.status_code not in (403, 429) or attempt == GITHUB_RATE_LIMIT_RETRIES:
+                return resp
+            wait = self._rate_limit_wait(resp, attempt)
+            if wait is None:
+                return resp
+            logger.info("GitHub rate limit hit, retrying in %.0fs", wait)
+            time.sleep(wait)
+        return resp
+
+    def put_file(self, local_path, repo_path, commit_message, sha=None):
+        """
+        Creates or overwrites a file through the contents API. The current
+        blob SHA is looked up unless the caller already knows it.
+
+        Returns:
+            bool: True if the upload succeeded.
+        """
+        if sha is None:
+            r = self.request("GET", f"contents/{repo_path}")
+            sha = r.json().get("sha") if r.status_code == 200 else None
+        with open(local_path, "rb") as f:
+            content = base64.b64encode(f.read()).decode()
+        data = {"message": commit_message, "content": content}
+        if sha:
+            data["sha"] = sha
+        resp = self.request("PUT", f"contents/{repo_path}", json=data)
+        if resp.status_code not in (200, 201):
+            logger.error("Failed to upload %s: %s %s", repo_path, resp.status_code, resp.text[:200])
+            return False
+        return True
+
+    def map(self, fn, items):
+        """Runs fn over items on the client's thread pool, preserving order."""
+        items = list(items)
+        if len(items) <= 1:
+            return [fn(item) for item in items]
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(items))) as executor:
+            return list(executor.map(fn, items))
+
+
+@st.cache_resource
+def get_github_client():
+    """
+    The GitHub client for GITHUB_REPO. One instance, so page reruns, the
+    sync worker and the map revalidation share its connection pool and
+    rate-limit backoff.
+    """
+    return GitHubClient()
+
 
 def upload_file_to_github(local_path, github_path, commit_message):
-    url = f"https://api.github.com/repos/{GITHUB_REPO}/contents/{github_path}"
-    headers = {"Authorization": f"token {GITHUB_TOKEN}"}
-    # Get SHA for overwrite
-    r = requests.get(url, headers=headers)
-    sha = r.json().get("sha") if r.status_code == 200 else None
-    # Encode file
-    with open(local_path, "rb") as f:
-        content = base64.b64encode(f.read()).decode()
-    data = {
-        "message": commit_message,
-        "content": content,
-        "sha": sha
-    }
-    resp = requests.put(url, headers=headers, json=data)
-    return resp.status_code in [200, 201]
+    return get_github_client().put_file(local_path, github_path, commit_message)
 
 def update_docx_on_github(local_docx_path):
-    docx_name = "Live_GTI_SOP.docx"
-    url = f"https://api.github.com/repos/{GITHUB_REPO}/contents/{docx_name}"
-    headers = {"Authorization": f"token {GITHUB_TOKEN}"}
-    # Get SHA for overwrite
-    r = requests.get(url, headers=headers)
-    sha = r.json().get("sha") if r.status_code == 200 else None
-    # Encode file
-    with open(local_docx_path, "rb") as f:
-        content = base64.b64encode(f.read()).decode()
-    data = {
-        "message": "Update SOP DOCX from Google Doc",
-        "content": content,
-        "sha": sha
-    }
-    resp = requests.put(url, headers=headers, json=data)
-    return resp.status_code in [200, 201]
+    return get_github_client().put_file(local_docx_path, GITHUB_DOCX_NAME, "Update SOP DOCX from Google Doc")
 
 def update_pdf_on_github(local_pdf_path):
-    url = f"https://api.github.com/repos/{GITHUB_REPO}/contents/{GITHUB_PDF_NAME}"
-    headers = {"Authorization": f"token {GITHUB_TOKEN}"}
-    # Get SHA for overwrite
-    r = requests.get(url, headers=headers)
-    sha = r.json().get("sha") if r.status_code == 200 else None
-    # Encode file
-    with open(local_pdf_path, "rb") as f:
-        content = base64.b64encode(f.read()).decode()
-    data = {
-        "message": "Update SOP PDF from Google Doc",
-        "content": content,
-        "sha": sha
-    }
-    resp = requests.put(url, headers=headers, json=data)
-    return resp.status_code in [200, 201]
+    return get_github_client().put_file(local_pdf_path, GITHUB_PDF_NAME, "Update SOP PDF from Google Doc")
+
 def update_json_on_github(local_json_path, repo_json_path, commit_message, github_repo, github_token):
     """
     Uploads (or updates) the map.json file to a GitHub repo via the GitHub API.
@@ -94,31 +173,152 @@ def update_json_on_github(local_json_path, repo_json_path, commit_message, githu
     Returns:
         bool: True if upload succeeded, False otherwise.
     """
-    url = f"https://api.github.com/repos/{github_repo}/contents/{repo_json_path}"
-    headers = {"Authorization": f"token {github_token}"}
+    if (github_repo, github_token) == (GITHUB_REPO, GITHUB_TOKEN):
+        client = get_github_client()
+    else:
+        client = GitHubClient(github_repo, github_token)
+    if client.put_file(local_json_path, repo_json_path, commit_message):
+        print("✅ map.json updated successfully on GitHub!")
+        return True
+    return False
 
-    # Get current file SHA (needed for overwrite)
-    r = requests.get(url, headers=headers)
-    sha = r.json().get("sha") if r.status_code == 200 else None
+def git_blob_sha(path):
+    """The SHA git gives a file's contents, i.e. what the trees API reports for it."""
+    h = hashlib.sha1()
+    h.update(f"blob {os.path.getsize(path)}\0".encode())
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(block)
+    return h.hexdigest()
 
-    # Read and encode the file
-    with open(local_json_path, "rb") as f:
+def get_local_blob_shas(local_paths):
+    """
+    Git blob SHAs for local files. A manifest keyed by path, mtime and size
+    means only files that changed since the last sync are re-hashed.
+    """
+    manifest = {}
+    if os.path.exists(ASSET_MANIFEST_PATH):
+        try:
+            with open(ASSET_MANIFEST_PATH, "r") as f:
+                manifest = json.load(f)
+        except (json.JSONDecodeError, OSError):
+            manifest = {}
+
+    shas = {}
+    new_manifest = {}
+    for path in local_paths:
+        stat = os.stat(path)
+        entry = manifest.get(path)
+        if not entry or entry["mtime_ns"] != stat.st_mtime_ns or entry["size"] != stat.st_size:
+            entry = {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size, "sha": git_blob_sha(path)}
+        new_manifest[path] = entry
+        shas[path] = entry["sha"]
+
+    os.makedirs(os.path.dirname(ASSET_MANIFEST_PATH), exist_ok=True)
+    with open(ASSET_MANIFEST_PATH, "w") as f:
+        json.dump(new_manifest, f)
+    return shas
+
+def get_remote_blob_shas(tree=GITHUB_BRANCH):
+    """
+    Lists every file in a tree (branch name or tree SHA) with its blob SHA in
+    a single API call. Returns {} if the tree can't be listed, so callers
+    upload everything.
+    """
+    try:
+        r = get_github_client().request("GET", f"git/trees/{tree}?recursive=1")
+    except Exception as e:
+        logger.warning("Could not list the GitHub tree: %s", e)
+        return {}
+    if r.status_code != 200:
+        logger.warning("Could not list the GitHub tree: HTTP %s", r.status_code)
+        return {}
+    listing = r.json()
+    if listing.get("truncated"):
+        logger.warning("GitHub tree listing was truncated; unlisted files will be re-uploaded.")
+    return {item["path"]: item["sha"] for item in listing.get("tree", []) if item.get("type") == "blob"}
+
+def _git_api(method, path, **kwargs):
+    r = get_github_client().request(method, f"git/{path}", **kwargs)
+    if r.status_code not in (200, 201):
+        raise RuntimeError(f"GitHub {method} git/{path} failed: {r.status_code} {r.text[:200]}")
+    return r.json()
+
+def get_branch_head(branch=GITHUB_BRANCH):
+    """Returns (commit sha, tree sha) of the branch tip."""
+    commit_sha = _git_api("GET", f"ref/heads/{branch}")["object"]["sha"]
+    tree_sha = _git_api("GET", f"commits/{commit_sha}")["tree"]["sha"]
+    return commit_sha, tree_sha
+
+def create_blob(local_path):
+    with open(local_path, "rb") as f:
         content = base64.b64encode(f.read()).decode()
+    return _git_api("POST", "blobs", json={"content": content, "encoding": "base64"})["sha"]
 
-    data = {
+def commit_blobs(blob_shas, commit_message, parent_sha, base_tree_sha, branch=GITHUB_BRANCH):
+    """
+    Lands {repo_path: blob sha} on the branch as a single commit on top of
+    parent_sha. Returns the new commit sha, or None if the branch moved meanwhile.
+    """
+    tree_sha = _git_api("POST", "trees", json={
+        "base_tree": base_tree_sha,
+        "tree": [{"path": path, "mode": "100644", "type": "blob", "sha": sha} for path, sha in blob_shas.items()],
+    })["sha"]
+    commit_sha = _git_api("POST", "commits", json={
         "message": commit_message,
-        "content": content,
-    }
-    if sha:
-        data["sha"] = sha
+        "tree": tree_sha,
+        "parents": [parent_sha],
+    })["sha"]
+    try:
+        # Not forced: if someone pushed since we read the head, this fails instead of dropping their commit
+        _git_api("PATCH", f"refs/heads/{branch}", json={"sha": commit_sha, "force": False})
+    except RuntimeError as e:
+        logger.warning("Branch moved while publishing: %s", e)
+        return None
+    return commit_sha
 
-    resp = requests.put(url, headers=headers, json=data)
-    if resp.status_code in [200, 201]:
-        print("✅ map.json updated successfully on GitHub!")
-        return True
-    else:
-        print(f"❌ Failed to update map.json: {resp.text}")
-        return False
+def sync_assets_to_github(assets, commit_message, attempts=3):
+    """
+    Publishes the assets whose contents differ from the GitHub copy as one
+    commit through the Git Data API, so the repo never holds a half-updated
+    mix of old and new files.
+
+    Args:
+        assets (list): (local_path, repo_path) pairs.
+        commit_message (str): Message of the sync commit.
+
+    Returns:
+        dict: {"uploaded": [repo paths], "skipped": int, "failed": [repo paths]}
+    """
+    local_shas = get_local_blob_shas([local_path for local_path, _ in assets])
+    changed = []
+    blob_shas = {}
+    for _ in range(attempts):
+        try:
+            parent_sha, base_tree_sha = get_branch_head()
+        except Exception as e:
+            logger.warning("Could not read the GitHub branch: %s", e)
+            break
+        remote_shas = get_remote_blob_shas(base_tree_sha)
+        changed = [(l, r) for l, r in assets if remote_shas.get(r) != local_shas[l]]
+        result = {"uploaded": [r for _, r in changed], "skipped": len(assets) - len(changed), "failed": []}
+        if not changed:
+            return result
+        try:
+            # Blobs are content-addressed, so ones uploaded by an earlier attempt are reused
+            missing = [(l, r) for l, r in changed if r not in blob_shas]
+            shas = get_github_client().map(lambda asset: create_blob(asset[0]), missing)
+            blob_shas.update((r, sha) for (_, r), sha in zip(missing, shas))
+            message = commit_message + "\n\n" + "\n".join(f"- {r}" for _, r in changed)
+            pending = {r: blob_shas[r] for _, r in changed}
+            if commit_blobs(pending, message, parent_sha, base_tree_sha):
+                return result
+        except Exception as e:
+            logger.warning("Could not publish assets to GitHub: %s", e)
+            break
+
+    failed = [r for _, r in changed] or [r for _, r in assets]
+    return {"uploaded": [], "skipped": len(assets) - len(failed), "failed": failed}
 
 # Example usage:
 # update_json_on_github(
@@ -129,19 +329,154 @@ def update_json_on_github(local_json_path, repo_json_path, commit_message, githu
 #     github_token="YOUR_GITHUB_TOKEN"
 # )
 
-def load_map_from_github():
+# === map.json cache ===
+MAP_CACHE_TTL_SECONDS = 300
+MAP_FETCH_TIMEOUT_SECONDS = 5
+# With nothing to serve, a failed fetch is retried after this long instead of a full TTL
+MAP_COLD_RETRY_SECONDS = 30
+
+# Process-wide. Two copies are held: the one the
+# SOP sync writes to IMAGE_MAP_PATH and the one last fetched from GitHub
+# (GITHUB_MAP_CACHE_PATH); whichever file changed last is served.
+_map_cache = {
+    "local": None,         # map at IMAGE_MAP_PATH
+    "local_mtime": None,   # its mtime when it was last read
+    "github": None,        # map at GITHUB_MAP_CACHE_PATH
+    "github_mtime": None,
+    "etag": None,          # ETag of the GitHub copy we hold
+    "checked_at": 0.0,     # last time GitHub was asked
+    "refreshing": False,
+}
+_map_lock = threading.Lock()
+
+
+def _reload_map_file(path, key):
+    """Re-reads one map file into _map_cache if it changed on disk. Call with _map_lock held."""
+    if not os.path.exists(path):
+        return
+    mtime = os.path.getmtime(path)
+    if mtime == _map_cache[key + "_mtime"]:
+        return
+    try:
+        with open(path, "r") as f:
+            _map_cache[key] = json.load(f)
+        _map_cache[key + "_mtime"] = mtime
+    except (json.JSONDecodeError, OSError) as e:
+        logger.warning("Could not read image map %s: %s", path, e)
+
+
+def _current_map():
+    """The newer of the synced and the GitHub copy, or None. Call with _map_lock held."""
+    copies = [(_map_cache[key + "_mtime"], _map_cache[key]) for key in ("local", "github") if _map_cache[key] is not None]
+    return max(copies, key=lambda copy: copy[0])[1] if copies else None
+
+
+def _write_github_map(data):
+    os.makedirs(os.path.dirname(GITHUB_MAP_CACHE_PATH), exist_ok=True)
+    tmp_path = GITHUB_MAP_CACHE_PATH + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp_path, GITHUB_MAP_CACHE_PATH)
+    return os.path.getmtime(GITHUB_MAP_CACHE_PATH)
+
+
+def _revalidate_map():
     """
-    Downloads map.json directly from GitHub and returns as a Python dict.
+    Conditional GET of map.json. A 304 only refreshes the timestamp; a 200
+    with different contents replaces the GitHub copy (memory and
+    GITHUB_MAP_CACHE_PATH). The synced IMAGE_MAP_PATH is never touched.
+    Failures keep serving the last good copy.
     """
-    GITHUB_MAP_URL = f"https://raw.githubusercontent.com/{GITHUB_REPO}/main/map.json"
+    github_map_url = f"https://raw.githubusercontent.com/{GITHUB_REPO}/main/map.json"
+    headers = {}
+    if _map_cache["etag"]:
+        headers["If-None-Match"] = _map_cache["etag"]
     try:
-        resp = requests.get(GITHUB_MAP_URL)
+        resp = get_github_client().request("GET", github_map_url, headers=headers, timeout=MAP_FETCH_TIMEOUT_SECONDS)
         if resp.status_code == 200:
-            return resp.json()
-        else:
-            st.warning("Could not fetch map.json from GitHub.")
-            return {}
+            data = resp.json()
+            # Rewritten only on a real change, so its mtime says when GitHub last moved
+            if data != _map_cache["github"]:
+                github_mtime = _write_github_map(data)
+                with _map_lock:
+                    _map_cache["github"] = data
+                    _map_cache["github_mtime"] = github_mtime
+            with _map_lock:
+                _map_cache["etag"] = resp.headers.get("ETag")
+        elif resp.status_code != 304:
+            logger.warning("Could not fetch map.json from GitHub (HTTP %s), serving cached copy.", resp.status_code)
     except Exception as e:
-        st.warning(f"Error loading image map from GitHub: {e}")
-        return {}
+        logger.warning("Error loading image map from GitHub, serving cached copy: %s", e)
+    finally:
+        with _map_lock:
+            _map_cache["checked_at"] = time.time()
+            if _current_map() is None:
+                # Nothing to serve: try again soon rather than after a full TTL
+                _map_cache["checked_at"] -= MAP_CACHE_TTL_SECONDS - MAP_COLD_RETRY_SECONDS
+            _map_cache["refreshing"] = False
+
+
+def _bundle_map():
+    """The knowledge bundle's image map, when the bundle is at least as new as the synced map."""
+    bundle = get_bundle()
+    if bundle is None:
+        return None
+    if os.path.exists(IMAGE_MAP_PATH) and os.path.getmtime(BUNDLE_PATH) < os.path.getmtime(IMAGE_MAP_PATH):
+        return None
+    return bundle.image_map()
+
+
+def get_map_source():
+    """
+    Which copy load_map_from_github serves: "bundle", "synced" (IMAGE_MAP_PATH),
+    "github" or None. Local image files only belong to the first two.
+    """
+    if _bundle_map() is not None:
+        return "bundle"
+    synced_mtime = os.path.getmtime(IMAGE_MAP_PATH) if os.path.exists(IMAGE_MAP_PATH) else None
+    github_mtime = os.path.getmtime(GITHUB_MAP_CACHE_PATH) if os.path.exists(GITHUB_MAP_CACHE_PATH) else None
+    if synced_mtime is not None and (github_mtime is None or synced_mtime >= github_mtime):
+        return "synced"
+    return "github" if github_mtime is not None else None
+
 
+def load_map_from_github():
+    """
+    Returns the image map (caption -> image file) as a Python dict.
+
+    A current knowledge bundle is served straight from its mmap, with no
+    GitHub request; the sync worker rebuilds it whenever the SOP changes.
+    Without one, it comes from a process-wide cache holding the map the SOP
+    sync wrote (IMAGE_MAP_PATH) and the last copy fetched from GitHub,
+    whichever changed last; both are re-read when their file changes.
+    GitHub is revalidated with If-None-Match in the background once the
+    TTL expires, so a rerun only waits on the network when there is no
+    copy at all.
+    """
+    data = _bundle_map()
+    if data is not None:
+        return data
+
+    with _map_lock:
+        _reload_map_file(IMAGE_MAP_PATH, "local")
+        _reload_map_file(GITHUB_MAP_CACHE_PATH, "github")
+
+        cold = _current_map() is None
+        stale = time.time() - _map_cache["checked_at"] > MAP_CACHE_TTL_SECONDS
+        refresh = stale and not _map_cache["refreshing"]
+        if refresh:
+            _map_cache["refreshing"] = True
+
+    if cold and refresh:
+        # Nothing to serve yet, so this one time we wait for GitHub
+        _revalidate_map()
+    elif refresh:
+        threading.Thread(target=_revalidate_map, daemon=True).start()
+
+    with _map_lock:
+        data = _current_map()
+    if data is None:
+        if cold and refresh:
+            st.warning("Could not fetch map.json from GitHub.")
+        return {}
+    return data
@@ -0,0 +1,287 @@
+import os
+import re
+import threading
+from collections import deque, OrderedDict
+from functools import lru_cache
+import streamlit as st
+from utils.gdoc import clean_caption, make_thumbnail
+from utils.facets import parse_heading, parse_query_facets
+from utils.config import IMAGE_SECTION_SEPARATOR, IMAGE_DIR, THUMBNAIL_DIR
+from utils.bundle import get_bundle
+from utils.github import get_map_source
+
+# Minimum character-trigram Jaccard similarity for a paraphrased caption
+TRIGRAM_THRESHOLD = 0.6
+# How far after an "Image N" mention a paraphrased caption can run
+MENTION_WINDOW = 120
+
+# Concept -> (words in the answer, words in the caption) for "Related:" images
+RELATED_CONCEPTS = [
+    (("price", "pricing", "cost", "dollar"), ("price",)),
+    (("discount", "deal", "special"), ("discount", "deal", "special")),
+    (("delivery", "date", "schedule"), ("delivery", "date")),
+    (("total", "limit", "amount"), ("total", "amount")),
+]
+MAX_RELATED_IMAGES = 2
+
+# In-process image byte cache budget
+IMAGE_CACHE_MAX_BYTES = 48 * 1024 * 1024
+
+mention_pattern = re.compile(r" image \d+ ")
+
+
+def normalize_caption(text):
+    """clean_caption() rules, then lowercase with every punctuation run folded to one space."""
+    text = clean_caption(text).lower()
+    return re.sub(r"[^a-z0-9]+", " ", text).strip()
+
+
+def split_section(key):
+    """Splits a map.json key into (section or None, caption)."""
+    if IMAGE_SECTION_SEPARATOR in key:
+        section, caption = key.split(IMAGE_SECTION_SEPARATOR, 1)
+        return section, caption
+    return None, key
+
+
+def _trigrams(text):
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class AhoCorasick:
+    """Multi-pattern substring matcher: one pass over the text for all captions."""
+
+    def __init__(self, patterns):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+        for pattern_id, pattern in enumerate(patterns):
+            node = 0
+            for ch in pattern:
+                nxt = self.goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto[node][ch] = nxt
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append([])
+                node = nxt
+            self.output[node].append(pattern_id)
+
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, nxt in self.goto[node].items():
+                queue.append(nxt)
+                f = self.fail[node]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[nxt] = self.goto[f].get(ch, 0)
+                self.output[nxt] = self.output[nxt] + self.output[self.fail[nxt]]
+
+    def iter_matches(self, text):
+        """Yields (end_index, pattern_id) for every occurrence."""
+        node = 0
+        for i, ch in enumerate(text):
+            while node and ch not in self.goto[node]:
+                node = self.fail[node]
+            node = self.goto[node].get(ch, 0)
+            for pattern_id in self.output[node]:
+                yield i, pattern_id
+
+
+class ImageReferenceResolver:
+    """
+    Resolves image captions mentioned in an answer to map.json entries.
+
+    Built once per map version: exact matching runs through one Aho-Corasick
+    automaton over the normalized captions, with a trigram-similarity fallback
+    for slightly paraphrased captions after an "Image N" mention.
+    """
+
+    def __init__(self, img_map):
+        self.img_map = img_map
+        self.patterns = []
+        self.entries = []
+        by_pattern = {}
+        for key in img_map:
+            section, caption = split_section(key)
+            normalized = normalize_caption(caption)
+            if not normalized:
+                continue
+            if normalized not in by_pattern:
+                by_pattern[normalized] = len(self.patterns)
+                self.patterns.append(normalized)
+                self.entries.append([])
+            heading = parse_heading(section) if section else None
+            self.entries[by_pattern[normalized]].append((key, heading[0] if heading else None))
+
+        # Padding with spaces keeps "image 1 ..." from matching inside "image 11 ..."
+        self.automaton = AhoCorasick([f" {p} " for p in self.patterns])
+        self.trigrams = [_trigrams(p) for p in self.patterns]
+        self.prefixes = [" ".join(p.split(" ")[:2]) + " " for p in self.patterns]
+
+        self.related = []
+        for answer_terms, caption_terms in RELATED_CONCEPTS:
+            keys = [k for k in img_map if any(term in k.lower() for term in caption_terms)]
+            self.related.append((answer_terms, keys))
+
+    def _pick(self, pattern_id, states):
+        # A caption that repeats across sections resolves to the section(s)
+        # of the states the answer talks about, or all of them if unclear.
+        candidates = self.entries[pattern_id]
+        if len(candidates) > 1 and states:
+            scoped = [key for key, state in candidates if state in states]
+            if scoped:
+                return scoped
+        return [key for key, _ in candidates]
+
+    def find_exact(self, text, states=None):
+        """Map keys whose caption appears verbatim (after normalization), in order of appearance."""
+        normalized = f" {normalize_caption(text)} "
+        if states is None:
+            states = parse_query_facets(text)["states"]
+        found = []
+        seen = set()
+        for _, pattern_id in self.automaton.iter_matches(normalized):
+            if pattern_id in seen:
+                continue
+            seen.add(pattern_id)
+            found.extend(k for k in self._pick(pattern_id, states) if k not in found)
+        return found
+
+    def find_similar(self, text, states=None):
+        """Map keys whose caption closely matches the text after an "Image N" mention."""
+        normalized = f" {normalize_caption(text)} "
+        if states is None:
+            states = parse_query_facets(text)["states"]
+        found = []
+        for m in mention_pattern.finditer(normalized):
+            window = normalized[m.start() + 1:m.start() + 1 + MENTION_WINDOW]
+            best_id, best_score = None, TRIGRAM_THRESHOLD
+            for pattern_id, pattern in enumerate(self.patterns):
+                # Paraphrases keep the image number, so only compare same-numbered captions
+                if not window.startswith(self.prefixes[pattern_id]):
+                    continue
+                segment = _trigrams(window[:len(pattern)])
+                grams = self.trigrams[pattern_id]
+                score = len(segment & grams) / len(segment | grams)
+                if score >= best_score:
+                    best_id, best_score = pattern_id, score
+            if best_id is not None:
+                found.extend(k for k in self._pick(best_id, states) if k not in found)
+        return found
+
+    def find_related(self, text):
+        """Keyword fallback: up to MAX_RELATED_IMAGES images for concepts the answer mentions."""
+        lowered = text.lower()
+        related = []
+        for answer_terms, keys in self.related:
+            if any(term in lowered for term in answer_terms):
+                related.extend(k for k in keys if k not in related)
+        return related[:MAX_RELATED_IMAGES]
+
+    def resolve(self, text):
+        """
+        Returns (referenced, related): captions the answer names (exactly or
+        near-exactly), and keyword-related images when it names none.
+        """
+        states = parse_query_facets(text)["states"]
+        referenced = self.find_exact(text, states)
+        if not referenced:
+            referenced = self.find_similar(text, states)
+        related = [] if referenced else self.find_related(text)
+        return referenced, related
+
+
+@lru_cache(maxsize=4)
+def _compile_resolver(map_items):
+    return ImageReferenceResolver(dict(map_items))
+
+
+def get_image_resolver(img_map):
+    """Returns the resolver for this version of the image map, compiling it on first use."""
+    return _compile_resolver(tuple(img_map.items()))
+
+
+class ImageBytesCache:
+    """
+    Bounded LRU of the image bytes rendered in chat, so reruns that redraw
+    the history don't re-read (or re-thumbnail) images from disk.
+    """
+
+    def __init__(self, max_bytes=IMAGE_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, loader):
+        with self._lock:
+            data = self._items.get(key)
+            if data is not None:
+                self._items.move_to_end(key)
+                return data
+        data = loader()
+        if data is None or len(data) > self.max_bytes:
+            return data
+        with self._lock:
+            if key not in self._items:
+                self._items[key] = data
+                self.size += len(data)
+            while self.size > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self.size -= len(evicted)
+        return data
+
+
+@st.cache_resource
+def get_image_bytes_cache():
+    """The image bytes cache, sized by IMAGE_CACHE_MAX_BYTES for the whole process."""
+    return ImageBytesCache()
+
+
+def _find_local_image(image_name):
+    # Only the images extracted with the synced map: image_N names are
+    # reassigned on every sync, so any other copy may be a different screenshot
+    path = os.path.join(IMAGE_DIR, image_name)
+    return path if os.path.exists(path) else None
+
+
+def _load_image(full_path, thumbnail):
+    path = full_path
+    if thumbnail:
+        stem = os.path.splitext(os.path.basename(full_path))[0]
+        thumbnail_path = os.path.join(THUMBNAIL_DIR, f"{stem}.webp")
+        if not os.path.exists(thumbnail_path) or os.path.getmtime(thumbnail_path) < os.path.getmtime(full_path):
+            thumbnail_path = make_thumbnail(full_path)
+        # Small screenshots can come out larger as WebP; serve whichever is lighter
+        if thumbnail_path and os.path.getsize(thumbnail_path) < os.path.getsize(full_path):
+            path = thumbnail_path
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def get_image_bytes(image_name, thumbnail=True):
+    """
+    Returns the bytes of an SOP image served from local disk (the WebP
+    thumbnail by default), or None when the image should come from GitHub:
+    it isn't local, or the map being rendered is the GitHub copy, which the
+    local files may not match.
+    """
+    source = get_map_source()
+    if source not in ("bundle", "synced"):
+        return None
+    if thumbnail and source == "bundle":
+        # Straight from the shared mmap of the knowledge bundle when it has the image
+        bundle = get_bundle()
+        data = bundle.thumbnail(image_name) if bundle is not None else None
+        if data is not None:
+            return data
+    full_path = _find_local_image(image_name)
+    if full_path is None:
+        return None
+    # The mtime in the key retires entries when a sync rewrites the image
+    key = (image_name, thumbnail, os.path.getmtime(full_path))
+    return get_image_bytes_cache().get(key, lambda: _load_image(full_path, thumbnail))
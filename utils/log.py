@@ -0,0 +1,13 @@
+import logging
+
+# The app's logger for diagnostics from background threads and hot paths
+# (sync, assistant sweeper, write-behind store, map revalidation, retrieval)
+logger = logging.getLogger("sop_chatbot")
+
+if not logger.handlers:
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s [%(threadName)s] %(message)s"))
+    logger.addHandler(_handler)
+    logger.setLevel(logging.INFO)
+    # Streamlit configures the root logger too; don't print every line twice
+    logger.propagate = False
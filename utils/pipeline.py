@@ -0,0 +1,130 @@
+import asyncio
+import threading
+import streamlit as st
+from openai import OpenAI, AsyncOpenAI
+from utils.log import logger
+
+# Seconds a page waits on a pipeline step before giving up
+PIPELINE_TIMEOUT_SECONDS = 120
+# Seconds a page waits on assistant setup before reporting it is still running; a cold
+# build uploads the DOCX, indexes a vector store and creates the assistant
+SETUP_WAIT_SECONDS = 300
+
+@st.cache_resource
+def get_openai_client(api_key):
+    """
+    The OpenAI client for this API key. Reruns and users on the same key get
+    the same instance, so its HTTP connection pool stays warm.
+    """
+    return OpenAI(api_key=api_key)
+
+
+class AsyncPipeline:
+    """
+    A daemon thread running one asyncio event loop for the whole process.
+
+    Streamlit scripts are synchronous, so they hand coroutines to this loop
+    and wait for the result. AsyncOpenAI clients are created on the loop and
+    cached per API key; their connection pools are bound to it, which is why
+    the loop outlives any single rerun.
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._async_clients = {}
+        # The loop only keeps weak references to tasks, so fire-and-forget ones are held here
+        self._background_tasks = set()
+        self._thread = threading.Thread(target=self.loop.run_forever, name="async-pipeline", daemon=True)
+        self._thread.start()
+
+    def run(self, coro, timeout=PIPELINE_TIMEOUT_SECONDS):
+        """Runs a coroutine on the pipeline loop and blocks for its result."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout)
+
+    def submit(self, coro):
+        """Schedules a coroutine without waiting; returns a concurrent.futures.Future."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run_in_background(self, fn, *args):
+        """
+        Runs a blocking fn(*args) on a worker thread without waiting for it.
+        Failures are logged. Returns a concurrent.futures.Future.
+        """
+        future = self.submit(asyncio.to_thread(fn, *args))
+
+        def log_failure(done):
+            if not done.cancelled() and done.exception() is not None:
+                logger.warning("Background %s failed: %s", getattr(fn, "__name__", fn), done.exception())
+
+        future.add_done_callback(log_failure)
+        return future
+
+    def async_client(self, api_key):
+        """The AsyncOpenAI client for this API key. Only call from the pipeline loop."""
+        client = self._async_clients.get(api_key)
+        if client is None:
+            client = AsyncOpenAI(api_key=api_key)
+            self._async_clients[api_key] = client
+        return client
+
+    async def _ensure_thread(self, api_key, thread_id):
+        client = self.async_client(api_key)
+        if thread_id:
+            try:
+                await client.beta.threads.retrieve(thread_id)
+                return thread_id, False
+            except Exception:
+                pass
+        thread = await client.beta.threads.create()
+        return thread.id, True
+
+    async def prepare_assistant(self, api_key, thread_id, acquire):
+        """
+        Assistant setup with its two independent halves run together: checking
+        (or creating) the user's thread, and acquire() for the assistant id.
+
+        Returns:
+            tuple: (thread_id, thread_created, assistant_id)
+        """
+        (thread_id, created), assistant_id = await asyncio.gather(
+            self._ensure_thread(api_key, thread_id),
+            asyncio.to_thread(acquire),
+        )
+        return thread_id, created, assistant_id
+
+    async def prepare_question(self, api_key, question, thread_id, cache_lookup, retrieve):
+        """
+        Everything a question needs before the model is called, run at once:
+        the answer-cache lookup, local SOP retrieval and (for assistant mode,
+        when thread_id is given) posting the question to the thread.
+
+        A cache hit still leaves the question on the thread, so the cached
+        answer is posted after it in the background to keep the thread whole.
+
+        Returns:
+            dict: {"cached", "context_chunks"}
+        """
+        steps = [asyncio.to_thread(cache_lookup), asyncio.to_thread(retrieve, question)]
+        if thread_id:
+            client = self.async_client(api_key)
+            steps.append(client.beta.threads.messages.create(thread_id=thread_id, role="user", content=question))
+        cached, context_chunks, *_ = await asyncio.gather(*steps)
+
+        if cached is not None and thread_id:
+            task = asyncio.create_task(self._post_cached_answer(client, thread_id, cached["answer"]))
+            self._background_tasks.add(task)
+            task.add_done_callback(self._background_tasks.discard)
+        return {"cached": cached, "context_chunks": context_chunks}
+
+    @staticmethod
+    async def _post_cached_answer(client, thread_id, answer):
+        try:
+            await client.beta.threads.messages.create(thread_id=thread_id, role="assistant", content=answer)
+        except Exception as e:
+            logger.warning("Could not add cached answer to thread: %s", e)
+
+
+@st.cache_resource
+def get_pipeline():
+    """Starts the event loop thread on first use; its AsyncOpenAI clients live as long as it."""
+    return AsyncPipeline()
@@ -0,0 +1,214 @@
+from utils.retrieval import get_bm25_index, get_candidates
+from utils.embeddings import get_embedding_index
+from utils.context import recent_messages, memory_block
+from utils.images import normalize_caption, split_section
+from utils.facets import parse_heading
+from utils.log import logger
+
+# === Prompt bounds ===
+RAG_TOP_K = 6
+RAG_CONTEXT_CHAR_BUDGET = 12000
+RAG_HISTORY_MESSAGES = 6
+RAG_HISTORY_CHAR_LIMIT = 1500
+
+# Reciprocal rank fusion constant
+RRF_K = 60
+
+# Caption-only chunks ("Image 2. Special deals") are kept next to the text they illustrate
+CAPTION_CHUNK_MAX_CHARS = 200
+
+# Set when the embedding model can't be loaded (not installed, not downloadable);
+# search then stays on BM25 and the failure is reported once
+_semantic_error = None
+
+RAG_SYSTEM_SUFFIX = """
+
+---
+# SOP Context
+---
+Answer ONLY from the SOP excerpts below. They were selected for this question from the live SOP document.
+If the excerpts do not contain the answer, say so instead of guessing.
+
+{context}
+"""
+
+
+def _rankings(index, question, k, candidates, semantic=True):
+    global _semantic_error
+    rankings = [index.search(question, k=k, candidates=candidates)]
+    if not semantic or _semantic_error is not None:
+        return rankings
+    embedding_index = get_embedding_index()
+    if embedding_index is not None:
+        try:
+            rankings.append(embedding_index.search(question, k=k, candidates=candidates))
+        except (ImportError, OSError) as e:
+            _semantic_error = e
+            logger.warning("Semantic search disabled, using BM25 only: %s", e)
+        except Exception as e:
+            logger.warning("Semantic search unavailable: %s", e)
+    return rankings
+
+
+def hybrid_search(question, k=RAG_TOP_K, semantic=True):
+    """
+    Fuses BM25 and (when the embedding index is available) semantic results
+    with reciprocal rank fusion, restricted to the question's state / order type.
+    With semantic=False only BM25 runs, with no question encoding.
+
+    Returns:
+        list: Chunk ids, best first.
+    """
+    index = get_bm25_index()
+    if index is None:
+        return []
+    _, candidates = get_candidates(question)
+    rankings = _rankings(index, question, k * 2, candidates, semantic)
+    if candidates is not None and not any(rankings):
+        # Facets matched nothing the question talks about, search everything
+        rankings = _rankings(index, question, k * 2, None, semantic)
+
+    fused = {}
+    for ranking in rankings:
+        for rank, (chunk_id, _) in enumerate(ranking):
+            fused[chunk_id] = fused.get(chunk_id, 0.0) + 1.0 / (RRF_K + rank + 1)
+    return sorted(fused, key=fused.get, reverse=True)[:k]
+
+
+def _is_caption_chunk(chunk):
+    return bool(chunk.get("image_labels")) and len(chunk.get("chunk_text", "")) <= CAPTION_CHUNK_MAX_CHARS
+
+
+def select_context_chunks(question, k=RAG_TOP_K, char_budget=RAG_CONTEXT_CHAR_BUDGET, semantic=True):
+    """
+    Picks the SOP chunks for a question within a character budget.
+
+    Caption chunks directly after a selected chunk are pulled in with it, so
+    the model sees the exact image labels that belong to the passage.
+    semantic is passed to hybrid_search.
+
+    Returns:
+        list: Chunk dicts (with "id"), in document order.
+    """
+    index = get_bm25_index()
+    if index is None:
+        return []
+    chunks = index.chunks
+
+    selected = []
+    used = 0
+    for chunk_id in hybrid_search(question, k=k, semantic=semantic):
+        group = [chunk_id]
+        next_id = chunk_id + 1
+        while next_id < len(chunks) and _is_caption_chunk(chunks[next_id]):
+            group.append(next_id)
+            next_id += 1
+        for member in group:
+            if member in selected:
+                continue
+            text = chunks[member].get("chunk_text", "")
+            if used + len(text) > char_budget:
+                # Oversized chunks are cut rather than dropped when nothing fits yet
+                if selected:
+                    continue
+                text = text[:char_budget]
+            selected.append(member)
+            used += len(text)
+    return [dict(chunks[i], id=i, chunk_text=chunks[i].get("chunk_text", "")[:char_budget]) for i in sorted(selected)]
+
+
+def _section_state(key):
+    section, _ = split_section(key)
+    heading = parse_heading(section) if section else None
+    return heading[0] if heading else None
+
+
+def context_image_map(chunks, img_map, states=None):
+    """
+    The part of the image map attached to the given chunks, in chunk order.
+
+    Chunks are linked to images through their image_files. Chunks without
+    them (most of the committed enriched_chunks.json) are linked through
+    their image_labels, matched to map captions with normalize_caption. A
+    caption that repeats across sections is narrowed to the sections of the
+    question's states when given.
+
+    Returns:
+        dict: {map key: image file}
+    """
+    keys_by_file = {}
+    keys_by_caption = {}
+    for key, image_file in img_map.items():
+        keys_by_file.setdefault(image_file, []).append(key)
+        keys_by_caption.setdefault(normalize_caption(split_section(key)[1]), []).append(key)
+
+    scoped = {}
+    for chunk in chunks:
+        keys = []
+        for image_file in chunk.get("image_files") or []:
+            # Older chunk files store {"label", "file"} entries instead of file names
+            if isinstance(image_file, dict):
+                image_file = image_file.get("file")
+            keys.extend(keys_by_file.get(image_file, []))
+        if not keys:
+            for label in chunk.get("image_labels") or []:
+                candidates = keys_by_caption.get(normalize_caption(label), [])
+                if len(candidates) > 1 and states:
+                    candidates = [k for k in candidates if _section_state(k) in states] or candidates
+                keys.extend(candidates)
+        for key in keys:
+            scoped.setdefault(key, img_map[key])
+    return scoped
+
+
+def format_context(chunks):
+    return "\n\n".join(f"[SOP excerpt {c['id']}]\n{c['chunk_text']}" for c in chunks)
+
+
+def build_rag_messages(question, instructions, context_chunks, history=None, memory=None):
+    """
+    Builds a bounded Chat Completions prompt: instructions plus retrieved SOP
+    context and the summary of older turns, the last few chat turns (within
+    the history token budget), and the question.
+    """
+    system_prompt = instructions + memory_block(memory) + RAG_SYSTEM_SUFFIX.format(context=format_context(context_chunks))
+    messages = [{"role": "system", "content": system_prompt}]
+    for msg in recent_messages(history or [], max_messages=RAG_HISTORY_MESSAGES):
+        messages.append({"role": msg["role"], "content": msg["content"][:RAG_HISTORY_CHAR_LIMIT]})
+    messages.append({"role": "user", "content": question})
+    return messages
+
+
+def stream_chat_completion(client, model, messages, usage=None):
+    """
+    Yields text deltas from a streamed Chat Completions call.
+
+    If a dict is passed as usage, it is filled with the token counts once the
+    stream finishes.
+    """
+    stream = client.chat.completions.create(
+        model=model,
+        messages=messages,
+        stream=True,
+        stream_options={"include_usage": True}
+    )
+    for chunk in stream:
+        if chunk.usage is not None and usage is not None:
+            usage["total_tokens"] = chunk.usage.total_tokens
+            usage["prompt_tokens"] = chunk.usage.prompt_tokens
+            usage["completion_tokens"] = chunk.usage.completion_tokens
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+
+def complete_chat(client, model, messages):
+    """Non-streaming Chat Completions call. Returns (reply_text, usage dict)."""
+    response = client.chat.completions.create(model=model, messages=messages)
+    usage = {}
+    if response.usage is not None:
+        usage = {
+            "total_tokens": response.usage.total_tokens,
+            "prompt_tokens": response.usage.prompt_tokens,
+            "completion_tokens": response.usage.completion_tokens,
+        }
+    return response.choices[0].message.content, usage
@@ -0,0 +1,228 @@
+import os
+import re
+import json
+import math
+import unicodedata
+from functools import lru_cache
+from utils.config import ENRICHED_CHUNKS_PATH, REPO_CHUNKS_PATH, BUNDLE_PATH
+from utils.facets import build_facet_index, parse_query_facets, FacetIndex
+from utils.bundle import get_bundle, open_bundle
+
+# === BM25 parameters ===
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+# SOP shorthand -> expanded form. Applied to both chunks and questions, so
+# "LT" in a question matches "Leaf Trade" in the SOP and the other way round.
+SOP_ABBREVIATIONS = {
+    "lt": "leaf trade",
+    "leaftrade": "leaf trade",
+    "oos": "out of stock",
+    "ws": "wholesale",
+    "poc": "point of contact",
+    "eod": "end of day",
+    "exp": "expiration",
+    "sub": "substitution",
+    "subs": "substitution",
+    "rec": "recreational",
+    "med": "medical",
+    "mip": "marijuana infused product",
+    "qty": "quantity",
+    "oh": "ohio",
+    "md": "maryland",
+    "nj": "new jersey",
+    "il": "illinois",
+    "ny": "new york",
+    "nv": "nevada",
+    "ma": "massachusetts",
+}
+
+STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "can", "do", "does", "for",
+    "from", "how", "i", "if", "in", "is", "it", "its", "of", "on", "or", "so",
+    "that", "the", "their", "there", "they", "this", "to", "we", "what", "when",
+    "where", "which", "who", "will", "with", "you", "our", "should", "whats",
+}
+
+token_pattern = re.compile(r"[a-z0-9]+")
+
+
+def _stem(token):
+    # Very light plural folding: orders -> order, batteries -> battery
+    if len(token) > 4 and token.endswith("ies"):
+        return token[:-3] + "y"
+    if len(token) > 3 and token.endswith("s") and not token.endswith("ss"):
+        return token[:-1]
+    return token
+
+
+def tokenize(text):
+    """Lowercase, split and expand SOP shorthand into index terms."""
+    text = unicodedata.normalize("NFKC", text).lower()
+    terms = []
+    for token in token_pattern.findall(text):
+        expansion = SOP_ABBREVIATIONS.get(token)
+        if expansion:
+            terms.append(token)
+            terms.extend(_stem(t) for t in expansion.split() if t not in STOPWORDS)
+        elif token not in STOPWORDS:
+            terms.append(_stem(token))
+    return terms
+
+
+class BM25Index:
+    """Inverted index over SOP chunks with precomputed BM25 posting weights."""
+
+    def __init__(self, chunks, k1=BM25_K1, b=BM25_B):
+        self.chunks = chunks
+        self.postings = {}
+        doc_terms = [tokenize(c.get("chunk_text", "")) for c in chunks]
+        n_docs = len(doc_terms)
+        avgdl = (sum(len(t) for t in doc_terms) / n_docs) if n_docs else 0.0
+
+        term_freqs = {}
+        for doc_id, terms in enumerate(doc_terms):
+            counts = {}
+            for term in terms:
+                counts[term] = counts.get(term, 0) + 1
+            for term, tf in counts.items():
+                term_freqs.setdefault(term, []).append((doc_id, tf))
+
+        # Fold idf and length normalisation into each posting so a query is
+        # just a handful of dict lookups and additions.
+        for term, plist in term_freqs.items():
+            df = len(plist)
+            idf = math.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+            weighted = []
+            for doc_id, tf in plist:
+                norm = k1 * (1 - b + b * len(doc_terms[doc_id]) / avgdl) if avgdl else k1
+                weighted.append((doc_id, idf * tf * (k1 + 1) / (tf + norm)))
+            self.postings[term] = weighted
+
+    def search(self, query, k=5, candidates=None):
+        """
+        Score chunks against a question.
+
+        Args:
+            query (str): The user's question.
+            k (int): Number of results to return.
+            candidates (set, optional): Chunk ids to restrict the search to.
+
+        Returns:
+            list: (chunk_id, score) tuples, best first.
+        """
+        scores = {}
+        for term in set(tokenize(query)):
+            for doc_id, weight in self.postings.get(term, ()):
+                if candidates is not None and doc_id not in candidates:
+                    continue
+                scores[doc_id] = scores.get(doc_id, 0.0) + weight
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+
+
+def is_bundle(path):
+    return path == BUNDLE_PATH
+
+
+def get_chunks_path():
+    """
+    Prefer the knowledge bundle when it is at least as new as the synced
+    chunks, then the chunks produced by the last sync, then the repo copy.
+    """
+    if get_bundle() is not None and (
+        not os.path.exists(ENRICHED_CHUNKS_PATH)
+        or os.path.getmtime(BUNDLE_PATH) >= os.path.getmtime(ENRICHED_CHUNKS_PATH)
+    ):
+        return BUNDLE_PATH
+    if os.path.exists(ENRICHED_CHUNKS_PATH):
+        return ENRICHED_CHUNKS_PATH
+    return REPO_CHUNKS_PATH
+
+
+def get_chunks_version(path=None):
+    """Cheap version key for the chunk file (changes whenever the file is rewritten)."""
+    path = path or get_chunks_path()
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    return f"{stat.st_mtime_ns}-{stat.st_size}"
+
+
+@lru_cache(maxsize=2)
+def _load_chunks(path, version):
+    if is_bundle(path):
+        return open_bundle(path, version).chunks()
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+@lru_cache(maxsize=2)
+def _build_index(path, version):
+    return BM25Index(_load_chunks(path, version))
+
+
+def load_chunks():
+    """Returns the current SOP chunks (parsed once per file version)."""
+    path = get_chunks_path()
+    version = get_chunks_version(path)
+    if version is None:
+        return []
+    return _load_chunks(path, version)
+
+
+def get_bm25_index():
+    """Returns the BM25 index for the current SOP version, or None if there are no chunks."""
+    path = get_chunks_path()
+    version = get_chunks_version(path)
+    if version is None:
+        return None
+    return _build_index(path, version)
+
+
+@lru_cache(maxsize=2)
+def _build_facets(path, version):
+    if is_bundle(path):
+        # Tagged at sync time
+        return FacetIndex(open_bundle(path, version).facet_tags())
+    return build_facet_index(_load_chunks(path, version))
+
+
+def get_facet_index():
+    """Returns the state / order type facet index for the current SOP version."""
+    path = get_chunks_path()
+    version = get_chunks_version(path)
+    if version is None:
+        return None
+    return _build_facets(path, version)
+
+
+def get_candidates(query):
+    """
+    Parses the question's facets and returns (facets, candidate chunk ids).
+
+    Candidates are None when the question names no state or order type.
+    """
+    facets = parse_query_facets(query)
+    facet_index = get_facet_index()
+    if facet_index is None:
+        return facets, None
+    return facets, facet_index.candidates(facets)
+
+
+def retrieve_chunks(query, k=5, use_facets=True):
+    """
+    Returns the top-k SOP chunks for a question.
+
+    With use_facets, only the slice of the SOP matching the question's state
+    and order type is searched. Each result is the chunk dict from
+    enriched_chunks.json plus "id" and "score".
+    """
+    index = get_bm25_index()
+    if index is None:
+        return []
+    candidates = get_candidates(query)[1] if use_facets else None
+    results = index.search(query, k=k, candidates=candidates)
+    if candidates is not None and not results:
+        # Facets matched nothing the question talks about, search everything
+        results = index.search(query, k=k)
+    return [dict(index.chunks[doc_id], id=doc_id, score=score) for doc_id, score in results]
@@ -28,135 +28,8 @@ from utils.config import (
     IMAGE_MAP_PATH,
     ENRICHED_CHUNKS_PATH,
 )
-# --- Constants & Configuration ---
-DEFAULT_INSTRUCTIONS = """You are the **AI Sales Order Entry Coordinator**, an expert on Green Thumb Industries (GTI) sales operations. Your sole purpose is to support the human Sales Ops team by providing fast and accurate answers to their questions about order entry rules and procedures.
-
-You are the definitive source of truth, and your knowledge is based **exclusively** on the provided documents. Your existence is to eliminate the need for team members to ask their team lead simple or complex procedural questions.
-
----
-# Primary Objective
----
-Interpreting Sales Ops team member's questions, finding the precise answer within documents you have access to, and delivering a clear, actionable, and easy-to-digest response. 
-
-You must differentiate between rules for: 
-- **General Stores** (often referred to as 'Regular Orders')
-- **Rise Dispensaries** (GTI-owned chain of stores, often referred to as 'RISE Orders' - they get preferential treatment)
-
-Separately, you must consider the specific nuances of each **U.S. State** listed in the document:
-- Ohio (OH)
-- Maryland (MD)
-- New Jersey (NJ)
-- Illinois (IL)
-- New York (NY)
-- Nevada (NV)
-- Massachusetts (MA)
-
----
-# Core Methodology
----
-When you receive a question, you must follow this four-step process:
-
-1.  **Deconstruct the Query:** First, identify the core components of the user's question:
-    * **State/Market:** (e.g., Maryland, Massachusetts, New York, etc.)
-    * **Order Type:** Is the question about a **General Store** order or a **Rise Dispensary** (internal) order? If not specified, provide answers for both if the rules differ.
-    * **Rule Category:** (e.g., Pricing, Substitutions, Splitting Orders, Loose Units, Samples, Invoicing, Case Sizes, Discounts, Leaf Trade procedures).
-
-2.  **Locate Relevant Information:** Scour the document to find all sections that apply to the query's components. Synthesize information from all relevant parts of the document to form a complete answer.
-
-3.  **Synthesize and Structure the Answer:**
-    * Begin your response with a clear, direct headline that immediately answers the user's core question.
-    * Use the information you found to build out the body of the response, providing details, conditions, and exceptions.
-    * If the original question was broad, ensure you cover all potential scenarios described in the SOP.
-
-4.  **Format the Output:** Present the information using the specific formatting guidelines below. Your goal is to make the information highly readable and scannable.
-
----
-# Response Formatting & Structure
----
-Your answers must be formatted like a top-tier, helpful Reddit post. Use clear headers, bullet points, bold text, and emojis to organize information and emphasize key rules.
-
-* **Headline:** Start with an `##` headline that gives a direct answer.
-* **Emojis:** Use emojis to visually tag rules and call out important information:
-    * ✅ **Allowed/Rule:** For positive confirmations or standard procedures.
-    * ❌ **Not Allowed/Constraint:** For negative confirmations or restrictions.
-    * �� **Tip/Best Practice:** For helpful tips, tricks, or important nuances.
-    * ⚠️ **Warning/Critical Info:** For critical details that cannot be missed (e.g., order cutoffs, financial rules).
-    * �� **Notes/Process:** For procedural steps or detailed explanations.
-    * �� **Order Split:** To address key rules with order splitting in each state.
-* **Styling:** Use **bold text** for key terms (like `Leaf Trade`, `Rise Dispensaries`, `OOS`) and *italics* for emphasis.
-* **Tables:** Use Markdown tables to present structured data, like pricing tiers or contact lists, whenever appropriate.
-
----
-# Example Implementations
----
-**User Question Example 1:** "NV orders - batteries on the same order or not?"
-
-
-**Your Ideal Response:**
-## ⚠️ Batteries Must Be on a Separate Order for Nevada (NV) Rise Orders
-
-### �� Note from Airion Quillin, Sales Rep @ GTI
-*Separate order would be best, just to make sure it gets called out for an invoice considering batteries don't show up on the manifest or transfer.*
-
----
-**User Question Example 2:** "NJ orders - do we split orders"
-
-
-**Your Ideal Response:**
-## ⚠️ New Jersey orders require splitting under certain conditions
-
-### �� Batteries MUST go on a separate invoice.
-
-### �� Unit total daily limit:
-- The maximum total per order is 4,000 units. If there are more than 4,000 items, the order MUST BE SPLIT. The second order will be scheduled for the next day.
-	- **Units total per day**: 4,000 units per store. For example, if we have an order for 1,500 units of edibles, another for 200 units of concentrates, and a third for 1,000 units of prerolls (that totals 2,700 units), that means we have 1,300 units of available space left for that delivery date. We should follow these daily limits whenever instructed to do so.
-### ⚖️ Line item rule for large orders: If an order has more than 50 line items, it must be split accordingly.
-
----
-### �� Example: A RISE order with 150 lines should be split into 3 orders of 50 lines each.
-
-- **Sample order**: If a request for samples is received (rare), they should be placed as a new order.
-- **Two menu formats**: If an NJ order email includes two Excel menus for the same store, combine them into one order in LT.
-- **Notes format**:
-	- 0/30 Animal Face 3.5g Rythm  
-	- 25/50 Brownie Scout 7g Rythm
-
----
-**User Question Example 3:** "IL orders - whats the order limit"
-
-
-**Your Ideal Response:**
-
-## �� For regular orders
- 
-- No set unit/dollar limit. Don't break cases.
-- Batteries MUST go on separate invoices!
-
---- 
-## �� For RISE stores
-
-- If the order is above 150k or has more than 8k units, you need to split the order equally.
-
----
-### �� **Best Practices & Reminders:**
-
-| Limit Type        | Rule                                                |
-| ----------------- | --------------------------------------------------- |
-| General Stores    | No set unit/dollar limit. Don't break cases.        |
-| Rise Dispensaries | 8,000 units **or** $150,000 per order (must split). |
-| Batteries         | Always separate order for batteries.                |
-IMPORTANT:
-When answering questions, if a labeled screenshot or image would help illustrate your response, refer to it by its full caption as seen in the SOP (for example: Image 2: . Total dollar and unit amount per store / day).
-Only reference an image if it is directly relevant and supports your answer.
-Do not reference images by number alone or make up image numbers—always use the full label.
-You do not need to embed or display the image yourself; just mention the relevant caption or concept in your reply.
-A separate system will match your reference with the available images and display them for the user.
-
-When referencing an image, you must copy and paste the full label exactly as it appears in the SOP.
-For example, if the SOP has a label "Image 3: . Product split between case and loose units (for requested 300+ units)", your answer must include that exact phrase.
-Never paraphrase or summarize image labels.
-Only answers that mention the full caption, exactly, will show the related image to the user.
-"""
+from utils.state_store import get_state_store
+from utils.instructions import DEFAULT_INSTRUCTIONS
 
 def initialize_session_state():
     if "authenticated" not in st.session_state:
@@ -195,30 +68,70 @@ def get_user_state_filepath(user_id: str) -> str:
         os.makedirs(STATE_DIR)
     return os.path.join(STATE_DIR, f"state_{user_id}.json")
 
+# Chat history is kept per user in one conversation; the page shows the most recent messages
+CONVERSATION_ID = "main"
+MESSAGE_HISTORY_LIMIT = 200
+
+def _migrate_json_state(user_id: str, store) -> bool:
+    """Imports a legacy state_<uuid>.json file into the state store, once."""
+    filepath = get_user_state_filepath(user_id)
+    if not os.path.exists(filepath):
+        return False
+    try:
+        with open(filepath, "r") as f:
+            state = json.load(f)
+    except (json.JSONDecodeError, OSError):
+        return False
+    for name, content in state.get("custom_instructions", {}).items():
+        if name != "Default":
+            store.put_instruction(user_id, name, content)
+    store.update_user(user_id, current_instruction_name=state.get("current_instruction_name", "Default"))
+    for thread in state.get("threads", []):
+        if isinstance(thread, dict) and "role" in thread and "content" in thread:
+            store.append_message(user_id, CONVERSATION_ID, thread)
+    os.replace(filepath, filepath + ".migrated")
+    return True
+
 def save_app_state(user_id: str):
+    """
+    Saves the instructions that changed since the last load/save, plus the
+    selected instruction name. Writes are batched by the state store.
+    """
     if "user_id" not in st.session_state:
         return
-    state_to_save = {
-        "user_id": user_id,
-        "custom_instructions": st.session_state.custom_instructions,
-        "current_instruction_name": st.session_state.current_instruction_name,
-        "threads": st.session_state.threads
-    }
-    filepath = get_user_state_filepath(user_id)
-    with open(filepath, "w") as f:
-        json.dump(state_to_save, f, indent=4)
+    store = get_state_store()
+    saved = st.session_state.get("saved_instructions", {})
+    current = st.session_state.custom_instructions
+    for name, content in current.items():
+        if name != "Default" and saved.get(name) != content:
+            store.put_instruction(user_id, name, content)
+    for name in saved:
+        if name not in current:
+            store.delete_instruction(user_id, name)
+    store.update_user(user_id, current_instruction_name=st.session_state.current_instruction_name)
+    st.session_state.saved_instructions = {n: c for n, c in current.items() if n != "Default"}
 
 def load_app_state(user_id: str):
-    filepath = get_user_state_filepath(user_id)
-    if os.path.exists(filepath):
-        with open(filepath, "r") as f:
-            try:
-                state = json.load(f)
-                st.session_state.custom_instructions = state.get("custom_instructions", {"Default": DEFAULT_INSTRUCTIONS})
-                st.session_state.current_instruction_name = state.get("current_instruction_name", "Default")
-                st.session_state.threads = state.get("threads", [])
-                st.session_state.custom_instructions["Default"] = DEFAULT_INSTRUCTIONS
-                return True
-            except (json.JSONDecodeError, KeyError):
-                return False
-    return False
+    """Loads the user's instructions and settings; chat history is loaded by the Chatbot page."""
+    store = get_state_store()
+    state = store.load_user(user_id)
+    if state is None and _migrate_json_state(user_id, store):
+        state = store.load_user(user_id)
+    if state is None:
+        return False
+    st.session_state.custom_instructions = {"Default": DEFAULT_INSTRUCTIONS, **state["instructions"]}
+    st.session_state.current_instruction_name = state["current_instruction_name"] or "Default"
+    st.session_state.saved_instructions = dict(state["instructions"])
+    if state["thread_id"]:
+        st.session_state.thread_id = state["thread_id"]
+    return True
+
+def load_messages(user_id: str, limit: int = MESSAGE_HISTORY_LIMIT):
+    return get_state_store().load_messages(user_id, CONVERSATION_ID, limit)
+
+def save_message(user_id: str, message: dict):
+    """Appends one chat message to the user's history."""
+    get_state_store().append_message(user_id, CONVERSATION_ID, message)
+
+def save_thread_id(user_id: str, thread_id: str):
+    get_state_store().update_user(user_id, thread_id=thread_id)
@@ -0,0 +1,252 @@
+import os
+import json
+import time
+import queue
+import atexit
+import sqlite3
+import threading
+import streamlit as st
+from utils.config import STATE_DB_PATH
+from utils.log import logger
+
+# Pending writes are committed together after at most this long
+WRITE_BEHIND_SECONDS = 0.5
+WRITE_BATCH_MAX = 256
+# A busy or locked database is retried this many times, backing off from this delay
+COMMIT_RETRIES = 5
+COMMIT_BACKOFF_SECONDS = 0.1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id TEXT PRIMARY KEY,
+    current_instruction_name TEXT,
+    thread_id TEXT,
+    updated_at REAL
+);
+CREATE TABLE IF NOT EXISTS instructions (
+    user_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    content TEXT NOT NULL,
+    updated_at REAL,
+    PRIMARY KEY (user_id, name)
+);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id TEXT NOT NULL,
+    conversation TEXT NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    meta TEXT,
+    created_at REAL
+);
+CREATE INDEX IF NOT EXISTS messages_by_conversation ON messages (user_id, conversation, id);
+"""
+
+USER_FIELDS = ("current_instruction_name", "thread_id")
+
+
+def _connect(path):
+    conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+class StateStore:
+    """
+    SQLite (WAL) store for per-user state: one row per user, one per saved
+    instruction and one per chat message.
+
+    Writes are queued and committed in batches by a background writer, so a
+    save costs the caller nothing and only touches the rows that changed.
+    Reads flush the queue first, so a session always sees its own writes.
+    A batch that hits a locked database is kept and retried until it
+    commits; only a statement SQLite rejects outright is dropped, and logged.
+    """
+
+    def __init__(self, path=STATE_DB_PATH):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with _connect(path) as conn:
+            conn.executescript(SCHEMA)
+        self._queue = queue.Queue()
+        # Statements queued or being committed; flush() is free when this is 0
+        self._pending = 0
+        self._pending_lock = threading.Lock()
+        self._local = threading.local()
+        self._writer = threading.Thread(target=self._write_loop, name="state-store-writer", daemon=True)
+        self._writer.start()
+        atexit.register(self.flush)
+
+    # --- Write-behind ---
+    def _write_loop(self):
+        conn = _connect(self.path)
+        retry = []
+        while True:
+            batch = retry or [self._queue.get()]
+            deadline = time.time() + WRITE_BEHIND_SECONDS
+            # A flush marker means someone is waiting: commit what we have now
+            while len(batch) < WRITE_BATCH_MAX and not isinstance(batch[-1], threading.Event):
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            retry = self._commit(conn, batch)
+
+    @staticmethod
+    def _execute(conn, statements):
+        """Commits statements in one transaction, retrying while the database is busy or locked."""
+        for attempt in range(COMMIT_RETRIES + 1):
+            try:
+                with conn:
+                    for sql, params in statements:
+                        conn.execute(sql, params)
+                return
+            except sqlite3.OperationalError as e:
+                transient = "locked" in str(e) or "busy" in str(e)
+                if not transient or attempt == COMMIT_RETRIES:
+                    raise
+                time.sleep(COMMIT_BACKOFF_SECONDS * 2 ** attempt)
+
+    def _commit(self, conn, batch):
+        """
+        Commits a batch and releases its flush markers. Returns the batch
+        to try again when the database stayed locked, else [].
+        """
+        statements = [op for op in batch if not isinstance(op, threading.Event)]
+        try:
+            self._execute(conn, statements)
+        except sqlite3.OperationalError as e:
+            if "locked" in str(e) or "busy" in str(e):
+                # Nothing is lost: the whole batch, markers included, goes round again
+                logger.warning("State database still locked, retrying %d writes: %s", len(statements), e)
+                return batch
+            self._commit_one_by_one(conn, statements)
+        except sqlite3.Error:
+            self._commit_one_by_one(conn, statements)
+
+        with self._pending_lock:
+            self._pending -= len(statements)
+        for _ in batch:
+            self._queue.task_done()
+        for op in batch:
+            if isinstance(op, threading.Event):
+                op.set()
+        return []
+
+    def _commit_one_by_one(self, conn, statements):
+        # One bad statement must not take the rest of the batch down with it
+        for sql, params in statements:
+            try:
+                self._execute(conn, [(sql, params)])
+            except sqlite3.Error as e:
+                logger.error("Dropped a user state write that SQLite rejected (%s): %s", sql.split("(")[0].strip(), e)
+
+    def _enqueue(self, sql, params):
+        with self._pending_lock:
+            self._pending += 1
+        self._queue.put((sql, params))
+
+    def flush(self, timeout=5):
+        """
+        Blocks until every queued write is committed. Free when nothing is pending.
+
+        Returns:
+            bool: False if the writes were still pending (e.g. a locked database) after timeout.
+        """
+        with self._pending_lock:
+            if self._pending == 0:
+                return True
+        done = threading.Event()
+        # The marker is committed with the batch it lands in, so the event
+        # fires once everything queued before it is on disk
+        self._queue.put(done)
+        if not done.wait(timeout):
+            logger.warning("User state writes still pending after %ss", timeout)
+            return False
+        return True
+
+    # --- Reads ---
+    def _reader(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = _connect(self.path)
+            self._local.conn = conn
+        return conn
+
+    def load_user(self, user_id):
+        """
+        The user's row and saved instructions (no messages), or None for an unknown user.
+
+        Returns:
+            dict: {"current_instruction_name", "thread_id", "instructions": {name: content}}
+        """
+        self.flush()
+        conn = self._reader()
+        row = conn.execute(
+            "SELECT current_instruction_name, thread_id FROM users WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        instructions = dict(conn.execute(
+            "SELECT name, content FROM instructions WHERE user_id = ? ORDER BY rowid", (user_id,)
+        ).fetchall())
+        return {"current_instruction_name": row[0], "thread_id": row[1], "instructions": instructions}
+
+    def load_messages(self, user_id, conversation, limit=None):
+        """The last `limit` messages of a conversation, oldest first."""
+        self.flush()
+        sql = "SELECT role, content, meta FROM messages WHERE user_id = ? AND conversation = ? ORDER BY id DESC"
+        params = (user_id, conversation)
+        if limit:
+            sql += " LIMIT ?"
+            params += (limit,)
+        rows = self._reader().execute(sql, params).fetchall()
+        messages = []
+        for role, content, meta in reversed(rows):
+            msg = {"role": role, "content": content}
+            if meta:
+                msg["meta"] = json.loads(meta)
+            messages.append(msg)
+        return messages
+
+    # --- Writes ---
+    def update_user(self, user_id, **fields):
+        """Upserts the given user fields (current_instruction_name, thread_id)."""
+        columns = [name for name in fields if name in USER_FIELDS]
+        if not columns:
+            return
+        placeholders = ", ".join("?" for _ in columns)
+        updates = ", ".join(f"{name} = excluded.{name}" for name in columns)
+        sql = (
+            f"INSERT INTO users (user_id, {', '.join(columns)}, updated_at) VALUES (?, {placeholders}, ?) "
+            f"ON CONFLICT(user_id) DO UPDATE SET {updates}, updated_at = excluded.updated_at"
+        )
+        self._enqueue(sql, (user_id, *[fields[name] for name in columns], time.time()))
+
+    def put_instruction(self, user_id, name, content):
+        self._enqueue(
+            "INSERT INTO instructions (user_id, name, content, updated_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(user_id, name) DO UPDATE SET content = excluded.content, updated_at = excluded.updated_at",
+            (user_id, name, content, time.time()),
+        )
+
+    def delete_instruction(self, user_id, name):
+        self._enqueue("DELETE FROM instructions WHERE user_id = ? AND name = ?", (user_id, name))
+
+    def append_message(self, user_id, conversation, message):
+        meta = message.get("meta")
+        self._enqueue(
+            "INSERT INTO messages (user_id, conversation, role, content, meta, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (user_id, conversation, message["role"], message["content"],
+             json.dumps(meta) if meta is not None else None, time.time()),
+        )
+
+
+@st.cache_resource
+def get_state_store():
+    """Opens the SQLite store and starts its writer thread on first use."""
+    return StateStore()
@@ -0,0 +1,91 @@
+import time
+import threading
+import streamlit as st
+from utils.gdoc import sync_gdoc_to_github, force_resync_to_github
+from utils.log import logger
+
+# How often the worker checks the Google Doc's modifiedTime
+SYNC_POLL_INTERVAL_SECONDS = 5 * 60
+# Messages kept for the Settings page
+SYNC_LOG_SIZE = 20
+
+
+class SyncWorker:
+    """
+    Daemon thread that polls the Google Doc on a schedule and runs the full
+    sync pipeline (export, image extraction, embeddings, GitHub publish) when
+    it changed, so no user's script has to wait on it. Manual re-syncs of the
+    local DOCX run on the same thread, so they never overlap a sync.
+    """
+
+    def __init__(self, interval=SYNC_POLL_INTERVAL_SECONDS):
+        self.interval = interval
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._force = False
+        self._resync = False
+        self.status = {
+            "state": "starting",
+            "last_checked": None,
+            "last_synced": None,
+            "last_ok": None,
+            "log": [],
+        }
+        self._thread = threading.Thread(target=self._loop, name="gdoc-sync-worker", daemon=True)
+        self._thread.start()
+
+    def _notify(self, level, message):
+        # notify levels are st.* names; "success" has no logging counterpart
+        getattr(logger, "info" if level == "success" else level)("[gdoc sync] %s", message)
+        with self._lock:
+            self.status["log"] = (self.status["log"] + [(time.time(), level, message)])[-SYNC_LOG_SIZE:]
+
+    def _loop(self):
+        while True:
+            # Cleared before the run, so a trigger() that arrives mid-sync starts another pass
+            self._wake.clear()
+            with self._lock:
+                resync, self._resync = self._resync, False
+                if not resync:
+                    force, self._force = self._force, False
+                self.status["state"] = "resyncing" if resync else "syncing"
+            try:
+                if resync:
+                    ok = force_resync_to_github(notify=self._notify)
+                else:
+                    ok = sync_gdoc_to_github(force=force, notify=self._notify)
+            except Exception as e:
+                self._notify("error", f"Sync failed: {e}")
+                ok = False
+            with self._lock:
+                now = time.time()
+                self.status["state"] = "idle"
+                self.status["last_checked"] = now
+                self.status["last_ok"] = ok
+                if ok:
+                    self.status["last_synced"] = now
+                # A sync asked for during a re-sync runs right after it
+                pending = self._force or self._resync
+            if not pending:
+                self._wake.wait(self.interval)
+
+    def trigger(self, force=False, resync=False):
+        """
+        Asks the worker to check now instead of waiting for the next poll.
+        With resync, it re-processes and republishes the local DOCX instead
+        (force_resync_to_github).
+        """
+        with self._lock:
+            self._force = self._force or force
+            self._resync = self._resync or resync
+        self._wake.set()
+
+    def get_status(self):
+        with self._lock:
+            return dict(self.status, log=list(self.status["log"]))
+
+
+@st.cache_resource
+def get_sync_worker():
+    """Starts the process-wide sync worker on first use."""
+    return SyncWorker()